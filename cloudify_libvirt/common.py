@@ -12,15 +12,205 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import os
+import gzip
+import json
+import time
 import uuid
-from pkg_resources import resource_filename
+import base64
+import hashlib
+import libvirt
+import tempfile
+import threading
+import collections
 
 from cloudify import ctx
 from cloudify import exceptions as cfy_exc
-from cloudify_common_sdk import filters
 from cloudify_common_sdk._compat import text_type
 
 
+# keepalive settings for shared connections: ping each 5 seconds and
+# mark connection as dead after 3 lost responses
+KEEPALIVE_INTERVAL = 5
+KEEPALIVE_COUNT = 3
+# drop unused connection after 5 minutes
+CONNECTION_IDLE_TIMEOUT = 300
+# state polling delays used without events
+WAIT_MIN_DELAY = 1
+WAIT_MAX_DELAY = 30
+
+# count of compiled templates kept in process
+TEMPLATES_CACHE_SIZE = 64
+
+_event_loop_lock = threading.Lock()
+_event_loop_thread = None
+
+
+def _run_event_loop():
+    while True:
+        libvirt.virEventRunDefaultImpl()
+
+
+def start_event_loop():
+    """register default libvirt event implementation and run it in
+    background thread, return False if events are unsupported"""
+    global _event_loop_thread
+    with _event_loop_lock:
+        if _event_loop_thread is not None:
+            return True
+        try:
+            libvirt.virEventRegisterDefaultImpl()
+        except (AttributeError, libvirt.libvirtError) as e:
+            ctx.logger.debug("Events are unsupported: {}".format(repr(e)))
+            return False
+        _event_loop_thread = threading.Thread(
+            target=_run_event_loop, name="libvirt-events")
+        _event_loop_thread.daemon = True
+        _event_loop_thread.start()
+        return True
+
+
+def wait_for(check, timeout, event=None, max_delay=WAIT_MAX_DELAY):
+    """call check() until it returns True or timeout is reached, between
+    checks wait for event or sleep with exponential backoff"""
+    deadline = time.time() + timeout
+    delay = WAIT_MIN_DELAY
+    waited = 0
+    while True:
+        if event is not None:
+            event.clear()
+        if check():
+            return True
+        remaining = min(deadline - time.time(), timeout - waited)
+        if remaining <= 0:
+            return False
+        if event is not None:
+            # event can be lost on reconnect, so recheck from time to time
+            event.wait(min(remaining, max_delay))
+        else:
+            delay = min(delay, remaining)
+            time.sleep(delay)
+            waited += delay
+            delay = min(delay * 2, max_delay)
+
+
+class ConnectionPool(object):
+    """Process wide cache of opened connections keyed by libvirt uri"""
+
+    def __init__(self, idle_timeout=CONNECTION_IDLE_TIMEOUT):
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        # uri key => list of (connection, last used time)
+        self._idle = {}
+        # connection => uri key, for connections in use
+        self._used = {}
+
+    @staticmethod
+    def _key(libvirt_auth):
+        return repr(libvirt_auth)
+
+    @staticmethod
+    def _is_alive(conn):
+        try:
+            return conn.isAlive() == 1
+        except libvirt.libvirtError:
+            return False
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except libvirt.libvirtError as e:
+            ctx.logger.debug("Failed to close connection: {}"
+                             .format(repr(e)))
+
+    def _pop_expired(self, now):
+        # should be called under lock
+        expired = []
+        for key in list(self._idle):
+            alive = []
+            for conn, last_used in self._idle[key]:
+                if now - last_used > self.idle_timeout:
+                    expired.append(conn)
+                else:
+                    alive.append((conn, last_used))
+            if alive:
+                self._idle[key] = alive
+            else:
+                del self._idle[key]
+        return expired
+
+    def acquire(self, libvirt_auth):
+        key = self._key(libvirt_auth)
+        with self._lock:
+            expired = self._pop_expired(time.time())
+            candidates = self._idle.pop(key, [])
+        for conn in expired:
+            self._close(conn)
+
+        conn = None
+        while candidates:
+            cached, _ = candidates.pop()
+            if self._is_alive(cached):
+                conn = cached
+                break
+            ctx.logger.debug("Connection to {} is broken, reconnect."
+                             .format(key))
+            self._close(cached)
+
+        if conn is None:
+            # keepalive requires registered event loop before open
+            events = start_event_loop()
+            conn = libvirt.open(libvirt_auth)
+            if conn is None:
+                return None
+            if events:
+                try:
+                    conn.setKeepAlive(KEEPALIVE_INTERVAL, KEEPALIVE_COUNT)
+                except libvirt.libvirtError as e:
+                    ctx.logger.debug("Keepalive is unsupported: {}"
+                                     .format(repr(e)))
+
+        with self._lock:
+            if candidates:
+                # return unchecked connections back
+                self._idle.setdefault(key, []).extend(candidates)
+            self._used[conn] = key
+        return conn
+
+    def release(self, conn):
+        with self._lock:
+            key = self._used.pop(conn, None)
+        if key is None or not self._is_alive(conn):
+            self._close(conn)
+            return
+        with self._lock:
+            self._idle.setdefault(key, []).append((conn, time.time()))
+
+    def clear(self):
+        with self._lock:
+            idle = self._idle
+            self._idle = {}
+        for key in idle:
+            for conn, _ in idle[key]:
+                self._close(conn)
+
+
+connection_pool = ConnectionPool()
+
+
+def get_connection(libvirt_auth):
+    conn = connection_pool.acquire(libvirt_auth)
+    if conn is None:
+        raise cfy_exc.NonRecoverableError(
+            'Failed to open connection to the hypervisor'
+        )
+    return conn
+
+
+def release_connection(conn):
+    connection_pool.release(conn)
+
+
 def get_libvirt_params(**kwargs):
     libvirt_auth = kwargs.get('libvirt_auth')
     if not libvirt_auth:
@@ -91,6 +281,71 @@ def handle_devices(devices):
     return serial_devices, usb_devices, pci_devices, tpm_devices
 
 
+_templates_lock = threading.Lock()
+_templates_env = None
+# key -> (version, compiled template)
+_templates = collections.OrderedDict()
+
+
+# Filter is same as toxml from render_template of
+# cloudify-utilities-plugins-sdk 0.0.130, keep in sync on sdk upgrade.
+def _toxml(value):
+    """toxml filter"""
+    # xmltodict is installed with sdk, imported only on first use
+    import xmltodict
+    xml_prefix = '<?xml version="1.0" encoding="utf-8"?>'
+
+    result = ""
+    for el in value:
+        part_xml = xmltodict.unparse({el: value[el]}, pretty=False)
+        # remove xml prefix
+        if part_xml.startswith(xml_prefix):
+            part_xml = part_xml[len(xml_prefix):]
+        result += part_xml.strip()
+    return result
+
+
+def _get_template(key, version, load):
+    """return compiled template from cache, compile by content from load()
+    if there is no such template or version is changed"""
+    global _templates_env
+    with _templates_lock:
+        cached = _templates.get(key)
+        if cached and cached[0] == version:
+            _templates.move_to_end(key)
+            return cached[1]
+        if not _templates_env:
+            # jinja2 is imported only on first render
+            from jinja2 import Environment
+            # same environment as in filters.render_template
+            _templates_env = Environment()
+            _templates_env.filters["toxml"] = _toxml
+
+    template = _templates_env.from_string(load())
+
+    with _templates_lock:
+        _templates[key] = (version, template)
+        _templates.move_to_end(key)
+        while len(_templates) > TEMPLATES_CACHE_SIZE:
+            _templates.popitem(last=False)
+    return template
+
+
+def _template_path(name):
+    try:
+        from importlib.resources import files
+    except ImportError:
+        # python < 3.9, pkg_resources is slow for import
+        from pkg_resources import resource_filename
+        return os.path.join(resource_filename(__name__, 'templates'), name)
+    return str(files(__package__) / 'templates' / name)
+
+
+def _read_template(path):
+    with open(path) as object_desc:
+        return object_desc.read()
+
+
 def gen_xml_template(kwargs, template_params, default_template):
     # templates
     template_resource = kwargs.get('template_resource')
@@ -99,14 +354,21 @@ def gen_xml_template(kwargs, template_params, default_template):
     if template_resource:
         template_content = ctx.get_resource(template_resource)
 
-    if not (template_resource or template_content):
-        resource_dir = resource_filename(__name__, 'templates')
-        template_resource = '{}/{}.xml'.format(resource_dir, default_template)
-        ctx.logger.info("Will be used internal: %s" % template_resource)
-
-    if not template_content:
-        with open(template_resource) as object_desc:
-            template_content = object_desc.read()
+    if template_content:
+        if not isinstance(template_content, str):
+            template_content = template_content.decode("utf-8")
+        template = _get_template(
+            hashlib.sha256(template_content.encode("utf-8")).hexdigest(),
+            None, lambda: template_content)
+    else:
+        if not template_resource:
+            template_resource = _template_path(
+                '{}.xml'.format(default_template))
+            ctx.logger.info("Will be used internal: %s" % template_resource)
+        # recompile on template file change
+        template = _get_template(
+            template_resource, os.path.getmtime(template_resource),
+            lambda: _read_template(template_resource))
 
     params = {"ctx": ctx}
     if template_params:
@@ -124,9 +386,7 @@ def gen_xml_template(kwargs, template_params, default_template):
             params.update({'pci_devices': pci_devices})
         if tpm_devices:
             params.update({'tpm_devices': tpm_devices})
-    if not isinstance(template_content, str):
-        template_content = template_content.decode("utf-8")
-    xmlconfig = filters.render_template(template_content, params)
+    xmlconfig = template.render(params)
     ctx.logger.debug(repr(xmlconfig))
     return xmlconfig
 
@@ -146,12 +406,50 @@ def get_backupdir(kwargs):
     )
 
 
+def _write_atomic(path, content):
+    # other readers see old or new file, but never partial,
+    # each writer has own temporary file
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(path) or ".",
+        prefix=os.path.basename(path) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb' if isinstance(content, bytes) else 'w') \
+                as file:
+            file.write(content)
+            file.flush()
+            os.fsync(file.fileno())
+        os.rename(tmp_path, path)
+    except BaseException:
+        if os.path.isfile(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _node_state_blob(backup_dir, content):
+    # content addressed place shared by all backups in backup_dir root
+    return "{}/.objects/{}.xml".format(
+        os.path.dirname(backup_dir) or ".",
+        hashlib.sha256(content.encode("utf-8")).hexdigest())
+
+
 def save_node_state(backup_dir, object_name, content):
-    # save object state as string
-    if not os.path.isdir(backup_dir):
-        os.makedirs(backup_dir)
-    with open("{}/{}.xml".format(backup_dir, object_name), 'w') as file:
-        file.write(content)
+    # save object state as string, same content is stored only once
+    # and backup dir has hard links to it
+    blob = _node_state_blob(backup_dir, content)
+    for directory in [backup_dir, os.path.dirname(blob)]:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+    path = "{}/{}.xml".format(backup_dir, object_name)
+    try:
+        if not os.path.isfile(blob):
+            _write_atomic(blob, content)
+        # unique name, other writers can link same path
+        tmp_path = "{}.{}.tmp".format(path, uuid.uuid4().hex)
+        os.link(blob, tmp_path)
+        os.rename(tmp_path, path)
+    except OSError:
+        # no hard links support
+        _write_atomic(path, content)
 
 
 def read_node_state(backup_dir, object_name):
@@ -163,10 +461,19 @@ def read_node_state(backup_dir, object_name):
 
 
 def delete_node_state(backup_dir, object_name):
-    # read object state as string
-    if not os.path.isfile("{}/{}.xml".format(backup_dir, object_name)):
+    # remove object state and unused content
+    content = read_node_state(backup_dir, object_name)
+    if content is None:
         return
     os.remove("{}/{}.xml".format(backup_dir, object_name))
+    blob = _node_state_blob(backup_dir, content)
+    try:
+        if os.stat(blob).st_nlink == 1:
+            # no other backups with same content
+            os.remove(blob)
+    except OSError:
+        # saved without hard link
+        pass
 
 
 def get_binary_place(backup_dir, object_name):
@@ -185,6 +492,19 @@ def create_binary_place(backup_dir):
         os.makedirs(backup_dir)
 
 
+def save_manifest(path, manifest):
+    # save backup description as json
+    _write_atomic(path, json.dumps(manifest, indent=2, sort_keys=True))
+
+
+def read_manifest(path):
+    # read backup description, None if not exists
+    if not os.path.isfile(path):
+        return None
+    with open(path, 'r') as file:
+        return json.loads(file.read())
+
+
 def delete_binary_place(backup_dir, object_name):
     # create binary/directory place
     full_path = get_binary_place(backup_dir, object_name)
@@ -192,15 +512,100 @@ def delete_binary_place(backup_dir, object_name):
         os.remove(full_path)
 
 
+class LocalBackupStore(object):
+    """incremental backups as compressed files in backup_dir"""
+
+    def save(self, snapshot_name, content):
+        # saved path must stay valid after workdir change
+        backup_dir = "{}/incremental".format(
+            os.path.abspath(ctx.node.properties.get('backup_dir', ".")))
+        if not os.path.isdir(backup_dir):
+            os.makedirs(backup_dir)
+        path = "{}/{}.xml.gz".format(backup_dir,
+                                     snapshot_name.replace("/", "_"))
+        _write_atomic(path, gzip.compress(content.encode("utf-8")))
+        return {"store": "local", "path": path}
+
+    def read(self, entry):
+        if not os.path.isfile(entry["path"]):
+            return None
+        with open(entry["path"], 'rb') as file:
+            return gzip.decompress(file.read()).decode("utf-8")
+
+    def delete(self, entry):
+        if os.path.isfile(entry["path"]):
+            os.remove(entry["path"])
+
+
+class RuntimeBackupStore(object):
+    """incremental backups compressed in runtime properties"""
+
+    def save(self, snapshot_name, content):
+        data = gzip.compress(content.encode("utf-8"))
+        return {"store": "runtime",
+                "data": base64.b64encode(data).decode("ascii")}
+
+    def read(self, entry):
+        return gzip.decompress(
+            base64.b64decode(entry["data"])).decode("utf-8")
+
+    def delete(self, entry):
+        pass
+
+
+BACKUP_STORES = {
+    "local": LocalBackupStore,
+    "runtime": RuntimeBackupStore
+}
+
+
+def get_backup_store(name=None):
+    if not name:
+        name = ctx.node.properties.get('backup_store') or "local"
+    if name not in BACKUP_STORES:
+        raise cfy_exc.NonRecoverableError(
+            "Unknown backup store: {}.".format(name))
+    return BACKUP_STORES[name]()
+
+
+def get_backups():
+    """index of incremental backups, backups saved as xml in runtime
+    properties are moved to backup store"""
+    backups = ctx.instance.runtime_properties.get("backups", {})
+    legacy = [
+        snapshot_name for snapshot_name in backups
+        if not isinstance(backups[snapshot_name], dict)
+    ]
+    if legacy:
+        store = get_backup_store()
+        for snapshot_name in legacy:
+            backups[snapshot_name] = store.save(snapshot_name,
+                                                backups[snapshot_name])
+        ctx.logger.info("Moved {} backups to store.".format(len(legacy)))
+        ctx.instance.runtime_properties["backups"] = backups
+    return backups
+
+
+def delete_backups():
+    # remove all incremental backups from store
+    backups = ctx.instance.runtime_properties.get("backups", {})
+    for snapshot_name in backups:
+        entry = backups[snapshot_name]
+        if isinstance(entry, dict):
+            get_backup_store(entry["store"]).delete(entry)
+    ctx.instance.runtime_properties["backups"] = {}
+
+
 def xml_snapshot_create(kwargs, resource_id, current_xmldump):
     snapshot_name = get_backupname(kwargs)
     if kwargs.get("snapshot_incremental"):
-        backups = ctx.instance.runtime_properties.get("backups", {})
+        backups = get_backups()
         if snapshot_name in backups:
             raise cfy_exc.NonRecoverableError(
                 "Snapshot {snapshot_name} already exists."
                 .format(snapshot_name=snapshot_name,))
-        backups[snapshot_name] = current_xmldump
+        backups[snapshot_name] = get_backup_store().save(snapshot_name,
+                                                         current_xmldump)
         ctx.instance.runtime_properties["backups"] = backups
         ctx.logger.info("Snapshot {snapshot_name} is created."
                         .format(snapshot_name=snapshot_name,))
@@ -218,12 +623,16 @@ def xml_snapshot_create(kwargs, resource_id, current_xmldump):
 def xml_snapshot_apply(kwargs, resource_id, current_xmldump):
     snapshot_name = get_backupname(kwargs)
     if kwargs.get("snapshot_incremental"):
-        backups = ctx.instance.runtime_properties.get("backups", {})
-        if snapshot_name not in backups:
+        backups = get_backups()
+        if snapshot_name in backups:
+            entry = backups[snapshot_name]
+            xml_backup = get_backup_store(entry["store"]).read(entry)
+        else:
+            xml_backup = None
+        if not xml_backup:
             raise cfy_exc.NonRecoverableError(
                 "No snapshots found with name: {snapshot_name}."
                 .format(snapshot_name=snapshot_name,))
-        xml_backup = backups[snapshot_name]
     else:
         xml_backup = read_node_state(get_backupdir(kwargs), resource_id)
         if not xml_backup:
@@ -244,12 +653,13 @@ def xml_snapshot_apply(kwargs, resource_id, current_xmldump):
 def xml_snapshot_delete(kwargs, resource_id):
     snapshot_name = get_backupname(kwargs)
     if kwargs.get("snapshot_incremental"):
-        backups = ctx.instance.runtime_properties.get("backups", {})
+        backups = get_backups()
         if snapshot_name not in backups:
             raise cfy_exc.NonRecoverableError(
                 "No snapshots found with name: {snapshot_name}."
                 .format(snapshot_name=snapshot_name,))
-        del backups[snapshot_name]
+        entry = backups.pop(snapshot_name)
+        get_backup_store(entry["store"]).delete(entry)
         ctx.instance.runtime_properties["backups"] = backups
     else:
         if not read_node_state(get_backupdir(kwargs), resource_id):
@@ -13,7 +13,10 @@
 # limitations under the License.
 
 import libvirt
+import os
+import threading
 import time
+import xml.etree.ElementTree as ET
 
 from cloudify import ctx
 from cloudify import exceptions as cfy_exc
@@ -21,6 +24,23 @@ from cloudify.decorators import operation
 from cloudify_common_sdk._compat import text_type
 import cloudify_libvirt.common as common
 
+# default time limit for domain state changes, in seconds
+DEFAULT_WAIT_TIMEOUT = 300
+# guest can miss request for state change, so resend it each 30 seconds
+RETRY_INTERVAL = 30
+# default time limit for block backup job, in seconds
+BLOCK_BACKUP_TIMEOUT = 3600
+# statistics collected by bulk_stats
+BULK_STATS_FLAGS = (
+    libvirt.VIR_DOMAIN_STATS_STATE | libvirt.VIR_DOMAIN_STATS_CPU_TOTAL |
+    libvirt.VIR_DOMAIN_STATS_BALLOON | libvirt.VIR_DOMAIN_STATS_VCPU |
+    libvirt.VIR_DOMAIN_STATS_INTERFACE | libvirt.VIR_DOMAIN_STATS_BLOCK
+)
+
+# one placement at time, so domains don't get same cpus, serializes only
+# operations in current agent process
+_placement_lock = threading.Lock()
+
 
 @operation
 def create(**kwargs):
@@ -42,6 +62,144 @@ def _update_template_params(template_params):
         template_params["domain_type"] = "qemu"
     if not template_params.get("domain_cpu"):
         template_params["domain_cpu"] = "custom"
+    iothreads = int(template_params.get("iothreads") or 0)
+    if iothreads:
+        # spread virtio disks between iothreads
+        disks = [dict(disk) for disk in template_params.get("disks", [])]
+        virtio_disks = [disk for disk in disks
+                        if disk.get("bus") == "virtio"]
+        for pos, disk in enumerate(virtio_disks):
+            if not disk.get("iothread"):
+                disk["iothread"] = pos % iothreads + 1
+        template_params["disks"] = disks
+
+
+def _parse_cpuset(cpuset):
+    """convert libvirt cpuset string like '0-3,^2,6' to set of cpus"""
+    cpus = set()
+    excluded = set()
+    for part in cpuset.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        target = cpus
+        if part.startswith("^"):
+            target = excluded
+            part = part[1:]
+        if "-" in part:
+            start, end = part.split("-")
+            target.update(range(int(start), int(end) + 1))
+        else:
+            target.add(int(part))
+    return cpus - excluded
+
+
+def _host_cells(conn):
+    """numa cells with cpus from host capabilities"""
+    caps = ET.fromstring(conn.getCapabilities())
+    cells = []
+    for cell in caps.findall("./host/topology/cells/cell"):
+        cells.append({
+            'id': int(cell.get('id')),
+            'cpus': [{
+                'id': int(cpu.get('id')),
+                'socket': int(cpu.get('socket_id', 0)),
+                'core': int(cpu.get('core_id', cpu.get('id'))),
+                'siblings': _parse_cpuset(cpu.get('siblings', cpu.get('id'))),
+            } for cpu in cell.findall("./cpus/cpu")]
+        })
+    return cells
+
+
+def _pinned_cpus(conn):
+    """cpus used by vcpus of other domains on host"""
+    used = set()
+    for dom in conn.listAllDomains(0):
+        tune = ET.fromstring(dom.XMLDesc()).find("./cputune")
+        if tune is None:
+            continue
+        for pin in tune.findall("./vcpupin"):
+            used |= _parse_cpuset(pin.get('cpuset', ""))
+    return used
+
+
+def _cell_free_memory(conn, cell_id, template_params):
+    """free memory in KiB usable by domain on host numa cell"""
+    if template_params.get('hugepages'):
+        # memory reserved for hugepages is not free for kernel
+        size = int(template_params.get('hugepages_size') or 2048)
+        pages = conn.getFreePages([size], cell_id, 1)
+        return pages.get(cell_id, {}).get(size, 0) * size
+    # cell ids could be sparse, in bytes
+    return conn.getCellsFreeMemory(cell_id, 1)[0] // 1024
+
+
+def _cpu_placement(conn, template_params):
+    """select numa cell and free cpus for domain
+
+    Caller should hold _placement_lock up to domain define, lock is process
+    local, so placements from different agents/hosts are not serialized.
+    """
+    vcpus = int(template_params.get('vcpu_max') or
+                template_params.get('vcpu') or 1)
+    memory = int(template_params.get('memory_maxsize') or 0)
+    cells = _host_cells(conn)
+    used = _pinned_cpus(conn)
+
+    candidates = []
+    for cell in cells:
+        cell_memory = _cell_free_memory(conn, cell['id'], template_params)
+        free = [cpu for cpu in cell['cpus'] if cpu['id'] not in used]
+        if len(free) < vcpus or cell_memory < memory:
+            continue
+        # prefer cores without other domains on hyper threads
+        free.sort(key=lambda cpu: (
+            bool(cpu['siblings'] & used), cpu['socket'], cpu['core'],
+            cpu['id']))
+        candidates.append((cell_memory, cell['id'], free[:vcpus]))
+
+    if not candidates:
+        raise cfy_exc.NonRecoverableError(
+            "No NUMA cell with {} free cpus and {} KiB free memory."
+            .format(vcpus, memory))
+    cell_memory, cell_id, cpus = max(candidates, key=lambda c: c[0])
+    ctx.logger.info("Domain is placed to NUMA cell {} with cpus {}"
+                    .format(cell_id, repr([cpu['id'] for cpu in cpus])))
+    template_params['numa_node'] = cell_id
+    template_params['vcpu_pins'] = [cpu['id'] for cpu in cpus]
+    template_params['emulator_pin'] = ",".join(
+        str(cpu['id']) for cpu in cpus)
+
+
+def _check_hugepages(conn, template_params):
+    """check that host has enough free hugepages for domain memory"""
+    if template_params.get('hugepages_nodeset') is not None:
+        # template defines only one guest numa cell
+        if _parse_cpuset(
+            str(template_params['hugepages_nodeset'])
+        ) != set([0]):
+            raise cfy_exc.NonRecoverableError(
+                "Domain has only guest NUMA node 0, hugepages_nodeset {} "
+                "is unsupported.".format(template_params['hugepages_nodeset']))
+    size = int(template_params.get('hugepages_size') or 2048)
+    memory = int(template_params.get('memory_maxsize') or 0)
+    required = (memory + size - 1) // size
+    if template_params.get('numa_node') is not None:
+        # memory is allocated only from selected cell
+        pages = conn.getFreePages(
+            [size], int(template_params['numa_node']), 1)
+    else:
+        # cell ids could be sparse
+        pages = {}
+        for cell in _host_cells(conn):
+            pages.update(conn.getFreePages([size], cell['id'], 1))
+    free = sum(cell.get(size, 0) for cell in pages.values())
+    if free < required:
+        raise cfy_exc.NonRecoverableError(
+            "Not enough free hugepages of {} KiB: {} free, {} required."
+            .format(size, free, required))
+    ctx.logger.info("Free hugepages of {} KiB: {}, required: {}"
+                    .format(size, free, required))
 
 
 @operation
@@ -49,11 +207,7 @@ def configure(**kwargs):
     ctx.logger.info("configure")
 
     libvirt_auth, template_params = common.get_libvirt_params(**kwargs)
-    conn = libvirt.open(libvirt_auth)
-    if conn is None:
-        raise cfy_exc.NonRecoverableError(
-            'Failed to open connection to the hypervisor'
-        )
+    conn = common.get_connection(libvirt_auth)
 
     _update_template_params(template_params)
     try:
@@ -83,9 +237,14 @@ def configure(**kwargs):
                     'Failed to find the domain: {}'.format(repr(e))
                 )
         else:
-            xmlconfig = common.gen_xml_template(
-                kwargs, template_params, 'domain')
-            dom = conn.defineXML(xmlconfig)
+            with _placement_lock:
+                if template_params.get('cpu_pinning'):
+                    _cpu_placement(conn, template_params)
+                if template_params.get('hugepages'):
+                    _check_hugepages(conn, template_params)
+                xmlconfig = common.gen_xml_template(
+                    kwargs, template_params, 'domain')
+                dom = conn.defineXML(xmlconfig)
             if dom is None:
                 raise cfy_exc.NonRecoverableError(
                     'Failed to define a domain from an XML definition.'
@@ -94,7 +253,7 @@ def configure(**kwargs):
             ctx.instance.runtime_properties['resource_id'] = dom.name()
             ctx.instance.runtime_properties['params'] = template_params
     finally:
-        conn.close()
+        common.release_connection(conn)
 
 
 def _update_network_list(dom, lease_only=True):
@@ -148,6 +307,53 @@ def _update_network_list(dom, lease_only=True):
                 return
 
 
+def _wait_for_state(conn, dom, check, timeout):
+    """wait until check(state) returns True, use lifecycle events for wake
+    up if libvirt supports them and fallback to polling otherwise"""
+    event = None
+    callback_id = None
+    if common.start_event_loop():
+        event = threading.Event()
+        try:
+            callback_id = conn.domainEventRegisterAny(
+                dom, libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+                lambda *args: event.set(), None)
+        except libvirt.libvirtError as e:
+            ctx.logger.debug("Lifecycle events are unsupported: {}"
+                             .format(repr(e)))
+            event = None
+
+    try:
+        return common.wait_for(
+            lambda: check(dom.state()[0]), timeout, event)
+    finally:
+        if callback_id is not None:
+            try:
+                conn.domainEventDeregisterAny(callback_id)
+            except libvirt.libvirtError as e:
+                ctx.logger.debug("Failed to deregister events: {}"
+                                 .format(repr(e)))
+
+
+def _request_state(conn, dom, request, check, timeout, error_text):
+    """call request() until check(state) returns True or timeout"""
+    deadline = time.time() + timeout
+    while True:
+        if request() < 0:
+            raise cfy_exc.NonRecoverableError(error_text)
+        remaining = deadline - time.time()
+        if _wait_for_state(conn, dom, check,
+                           max(min(RETRY_INTERVAL, remaining), 0)):
+            return True
+        if remaining <= RETRY_INTERVAL:
+            return False
+        ctx.logger.info("Domain state is not changed, retry.")
+
+
+def _get_wait_timeout(template_params):
+    return int(template_params.get('wait_timeout', DEFAULT_WAIT_TIMEOUT))
+
+
 @operation
 def reboot(**kwargs):
     ctx.logger.info("reboot")
@@ -159,11 +365,7 @@ def reboot(**kwargs):
         raise cfy_exc.NonRecoverableError("No servers for reboot")
 
     libvirt_auth, template_params = common.get_libvirt_params(**kwargs)
-    conn = libvirt.open(libvirt_auth)
-    if conn is None:
-        raise cfy_exc.NonRecoverableError(
-            'Failed to open connection to the hypervisor'
-        )
+    conn = common.get_connection(libvirt_auth)
 
     try:
         try:
@@ -178,7 +380,54 @@ def reboot(**kwargs):
                 'Can not reboot guest domain.'
             )
     finally:
-        conn.close()
+        common.release_connection(conn)
+
+
+def _vcpu_hotplug(dom, vcpu):
+    """change cpu count on running domain and in config"""
+    max_vcpu = dom.maxVcpus()
+    if vcpu > max_vcpu:
+        raise cfy_exc.NonRecoverableError(
+            "Can not change cpu count to {} on running vm, maximum is {}."
+            .format(vcpu, max_vcpu))
+    ctx.logger.info("Set cpu count to {} on running vm".format(vcpu))
+    if dom.setVcpusFlags(vcpu, libvirt.VIR_DOMAIN_AFFECT_LIVE |
+                         libvirt.VIR_DOMAIN_AFFECT_CONFIG) < 0:
+        raise cfy_exc.NonRecoverableError(
+            "Can not change cpu count."
+        )
+
+
+def _memory_hotplug(dom, size):
+    """add memory module to running domain for have at least size KiB"""
+    current = dom.maxMemory()
+    if size <= current:
+        return
+    # limits are from defined domain, params could be changed after define
+    domain = ET.fromstring(dom.XMLDesc())
+    max_memory = domain.find('maxMemory')
+    cell = domain.find('cpu/numa/cell')
+    if max_memory is None or cell is None:
+        raise cfy_exc.NonRecoverableError(
+            "Domain is defined without maxMemory and guest NUMA node, "
+            "memory hotplug is unavailable.")
+    # libvirt returns size in KiB
+    max_size = int(max_memory.text)
+    if size > max_size:
+        raise cfy_exc.NonRecoverableError(
+            "Can not change memory amount to {} on running vm, maximum is {}."
+            .format(size, max_size))
+    ctx.logger.info("Add {} KiB of memory to running vm"
+                    .format(size - current))
+    xmlconfig = (
+        "<memory model='dimm'><target>"
+        "<size unit='KiB'>{}</size><node>{}</node>"
+        "</target></memory>".format(size - current, cell.get('id', 0)))
+    if dom.attachDeviceFlags(xmlconfig, libvirt.VIR_DOMAIN_AFFECT_LIVE |
+                             libvirt.VIR_DOMAIN_AFFECT_CONFIG) < 0:
+        raise cfy_exc.NonRecoverableError(
+            "Can not add memory."
+        )
 
 
 @operation
@@ -192,11 +441,7 @@ def update(**kwargs):
         raise cfy_exc.NonRecoverableError("No servers for update")
 
     libvirt_auth, template_params = common.get_libvirt_params(**kwargs)
-    conn = libvirt.open(libvirt_auth)
-    if conn is None:
-        raise cfy_exc.NonRecoverableError(
-            'Failed to open connection to the hypervisor'
-        )
+    conn = common.get_connection(libvirt_auth)
 
     try:
         try:
@@ -206,6 +451,16 @@ def update(**kwargs):
                 'Failed to find the domain: {}'.format(repr(e))
             )
 
+        state, _ = dom.state()
+        running = state == libvirt.VIR_DOMAIN_RUNNING
+        hotplug = template_params.get('memory_hotplug_maxsize')
+
+        if running and hotplug:
+            # add memory before use
+            _memory_hotplug(dom, max(
+                int(template_params.get('memory_size') or 0),
+                int(template_params.get('memory_maxsize') or 0)))
+
         # change memory values
         if template_params.get('memory_size'):
             ctx.logger.info("Set memory to {}"
@@ -215,10 +470,12 @@ def update(**kwargs):
                     "Can not change memory amount."
                 )
 
-        state, _ = dom.state()
-        if state == libvirt.VIR_DOMAIN_RUNNING:
-            ctx.logger.info("CPU/Maximum memory size count should be changed "
-                            "on stopped vm.")
+        if running:
+            if template_params.get('vcpu'):
+                _vcpu_hotplug(dom, int(template_params['vcpu']))
+            if template_params.get('memory_maxsize') and not hotplug:
+                ctx.logger.info("Maximum memory size should be changed "
+                                "on stopped vm.")
             return
 
         # change vcpu values
@@ -240,7 +497,7 @@ def update(**kwargs):
                 )
 
     finally:
-        conn.close()
+        common.release_connection(conn)
 
 
 @operation
@@ -254,11 +511,7 @@ def start(**kwargs):
         raise cfy_exc.NonRecoverableError("No servers for start")
 
     libvirt_auth, template_params = common.get_libvirt_params(**kwargs)
-    conn = libvirt.open(libvirt_auth)
-    if conn is None:
-        raise cfy_exc.NonRecoverableError(
-            'Failed to open connection to the hypervisor'
-        )
+    conn = common.get_connection(libvirt_auth)
 
     # wait for ip on start
     wait_for_ip = template_params.get('wait_for_ip', False)
@@ -271,33 +524,41 @@ def start(**kwargs):
                 'Failed to find the domain: {}'.format(repr(e))
             )
 
-        for i in range(10):
-            state, _ = dom.state()
-            ctx.logger.info("Trying to start vm {}/10".format(i))
-            if wait_for_ip:
-                ctx.logger.info("Waiting for ip.")
-            if state == libvirt.VIR_DOMAIN_RUNNING:
-                _update_network_list(dom)
-                # wait for ip check
-                if not wait_for_ip or (
-                    wait_for_ip and ctx.instance.runtime_properties.get('ip')
-                ):
-                    ctx.logger.info("Looks as running.")
-                    return
-            elif dom.create() < 0:
+        deadline = time.time() + _get_wait_timeout(template_params)
+        state, _ = dom.state()
+        if state != libvirt.VIR_DOMAIN_RUNNING:
+            ctx.logger.info("Trying to start vm.")
+            if dom.create() < 0:
                 raise cfy_exc.NonRecoverableError(
                     'Can not start guest domain.'
                 )
+            if not _wait_for_state(
+                conn, dom, lambda state: state == libvirt.VIR_DOMAIN_RUNNING,
+                deadline - time.time()
+            ):
+                ctx.logger.info("Domain is not running yet.")
+                # still no ip
+                if wait_for_ip:
+                    raise cfy_exc.RecoverableError(
+                        'No ip for now, try later'
+                    )
+                return
 
-            time.sleep(30)
+        def _has_ip():
+            _update_network_list(dom)
+            return bool(ctx.instance.runtime_properties.get('ip'))
 
-        # still no ip
         if wait_for_ip:
-            raise cfy_exc.RecoverableError(
-                'No ip for now, try later'
-            )
+            ctx.logger.info("Waiting for ip.")
+            if not common.wait_for(_has_ip, deadline - time.time()):
+                raise cfy_exc.RecoverableError(
+                    'No ip for now, try later'
+                )
+        else:
+            _update_network_list(dom)
+        ctx.logger.info("Looks as running.")
     finally:
-        conn.close()
+        common.release_connection(conn)
 
 
 @operation
@@ -315,12 +576,8 @@ def stop(**kwargs):
         ctx.logger.info("External resource, skip")
         return
 
-    libvirt_auth, _ = common.get_libvirt_params(**kwargs)
-    conn = libvirt.open(libvirt_auth)
-    if conn is None:
-        raise cfy_exc.NonRecoverableError(
-            'Failed to open connection to the hypervisor'
-        )
+    libvirt_auth, template_params = common.get_libvirt_params(**kwargs)
+    conn = common.get_connection(libvirt_auth)
 
     try:
         try:
@@ -334,20 +591,22 @@ def stop(**kwargs):
         ctx.instance.runtime_properties['ip'] = None
 
         state, _ = dom.state()
-        for i in range(10):
-            if state != libvirt.VIR_DOMAIN_RUNNING:
-                ctx.logger.info("Looks as not run.")
-                return
+        if state != libvirt.VIR_DOMAIN_RUNNING:
+            ctx.logger.info("Looks as not run.")
+            return
 
-            ctx.logger.info("Trying to stop vm {}/10".format(i))
-            if dom.shutdown() < 0:
-                raise cfy_exc.NonRecoverableError(
-                    'Can not shutdown guest domain.'
-                )
-            time.sleep(30)
-            state, _ = dom.state()
+        ctx.logger.info("Trying to stop vm.")
+        if _request_state(
+            conn, dom, dom.shutdown,
+            lambda state: state != libvirt.VIR_DOMAIN_RUNNING,
+            _get_wait_timeout(template_params),
+            'Can not shutdown guest domain.'
+        ):
+            ctx.logger.info("Looks as not run.")
+        else:
+            ctx.logger.info("Domain is still running.")
     finally:
-        conn.close()
+        common.release_connection(conn)
 
 
 @operation
@@ -360,12 +619,8 @@ def resume(**kwargs):
         # not uninstall workflow, raise exception
         raise cfy_exc.NonRecoverableError("No servers for resume")
 
-    libvirt_auth, _ = common.get_libvirt_params(**kwargs)
-    conn = libvirt.open(libvirt_auth)
-    if conn is None:
-        raise cfy_exc.NonRecoverableError(
-            'Failed to open connection to the hypervisor'
-        )
+    libvirt_auth, template_params = common.get_libvirt_params(**kwargs)
+    conn = common.get_connection(libvirt_auth)
 
     try:
         try:
@@ -376,20 +631,24 @@ def resume(**kwargs):
             )
 
         state, _ = dom.state()
-        for i in range(10):
-            if state == libvirt.VIR_DOMAIN_RUNNING:
-                ctx.logger.info("Looks as running.")
-                return
+        if state == libvirt.VIR_DOMAIN_RUNNING:
+            ctx.logger.info("Looks as running.")
+            return
 
-            ctx.logger.info("Trying to resume vm {}/10".format(i))
-            if dom.resume() < 0:
-                raise cfy_exc.NonRecoverableError(
-                    'Can not suspend guest domain.'
-                )
-            time.sleep(30)
-            state, _ = dom.state()
+        ctx.logger.info("Trying to resume vm.")
+        if dom.resume() < 0:
+            raise cfy_exc.NonRecoverableError(
+                'Can not suspend guest domain.'
+            )
+        if _wait_for_state(
+            conn, dom, lambda state: state == libvirt.VIR_DOMAIN_RUNNING,
+            _get_wait_timeout(template_params)
+        ):
+            ctx.logger.info("Looks as running.")
+        else:
+            ctx.logger.info("Domain is not running yet.")
     finally:
-        conn.close()
+        common.release_connection(conn)
 
 
 @operation
@@ -402,12 +661,8 @@ def suspend(**kwargs):
         # not uninstall workflow, raise exception
         raise cfy_exc.NonRecoverableError("No servers for suspend")
 
-    libvirt_auth, _ = common.get_libvirt_params(**kwargs)
-    conn = libvirt.open(libvirt_auth)
-    if conn is None:
-        raise cfy_exc.NonRecoverableError(
-            'Failed to open connection to the hypervisor'
-        )
+    libvirt_auth, template_params = common.get_libvirt_params(**kwargs)
+    conn = common.get_connection(libvirt_auth)
 
     try:
         try:
@@ -418,42 +673,75 @@ def suspend(**kwargs):
             )
 
         state, _ = dom.state()
-        for i in range(10):
-            if state != libvirt.VIR_DOMAIN_RUNNING:
-                ctx.logger.info("Looks as not run.")
-                return
+        if state != libvirt.VIR_DOMAIN_RUNNING:
+            ctx.logger.info("Looks as not run.")
+            return
 
-            ctx.logger.info("Trying to suspend vm {}/10".format(i))
-            if dom.suspend() < 0:
-                raise cfy_exc.NonRecoverableError(
-                    'Can not suspend guest domain.'
-                )
-            time.sleep(30)
-            state, _ = dom.state()
+        ctx.logger.info("Trying to suspend vm.")
+        if _request_state(
+            conn, dom, dom.suspend,
+            lambda state: state != libvirt.VIR_DOMAIN_RUNNING,
+            _get_wait_timeout(template_params),
+            'Can not suspend guest domain.'
+        ):
+            ctx.logger.info("Looks as not run.")
+        else:
+            ctx.logger.info("Domain is still running.")
     finally:
-        conn.close()
+        common.release_connection(conn)
+
+
+def _snapshots_leaves_first(snapshots):
+    """order snapshots for delete: children before parents"""
+    parents = {}
+    for snapshot in snapshots:
+        try:
+            parents[snapshot.getName()] = snapshot.getParent().getName()
+        except libvirt.libvirtError:
+            # root snapshot
+            parents[snapshot.getName()] = None
+
+    depths = {}
+    for name in parents:
+        # go to root or already known snapshot
+        path = []
+        while name is not None and name not in depths:
+            path.append(name)
+            name = parents.get(name)
+        depth = depths.get(name, -1)
+        for name in reversed(path):
+            depth += 1
+            depths[name] = depth
+
+    return sorted(snapshots, key=lambda snapshot: depths[snapshot.getName()],
+                  reverse=True)
 
 
 def _cleanup_snapshots(ctx, dom):
-    snapshots = dom.listAllSnapshots()
-    snapshots_count = len(snapshots)
-
-    for _ in range(snapshots_count):
-        for snapshot in snapshots:
-            # we can delete only snapshot without child
-            if not snapshot.numChildren():
-                ctx.logger.info("Remove {} snapshot."
-                                .format(snapshot.getName()))
-                snapshot.delete()
-        snapshots = dom.listAllSnapshots()
-
-    if len(snapshots):
+    try:
+        # whole snapshot tree by one call for each root
+        for snapshot in dom.listAllSnapshots(
+            libvirt.VIR_DOMAIN_SNAPSHOT_LIST_ROOTS
+        ):
+            ctx.logger.info("Remove {} snapshot with children."
+                            .format(snapshot.getName()))
+            snapshot.delete(libvirt.VIR_DOMAIN_SNAPSHOT_DELETE_CHILDREN)
+    except libvirt.libvirtError as e:
+        ctx.logger.info("Failed to remove snapshots with children: {}"
+                        .format(repr(e)))
+        for snapshot in _snapshots_leaves_first(dom.listAllSnapshots()):
+            ctx.logger.info("Remove {} snapshot."
+                            .format(snapshot.getName()))
+            snapshot.delete()
+
+    if dom.snapshotNum():
         subsnapshots = [
-            snap.getName() for snap in snapshots
+            snap.getName() for snap in dom.listAllSnapshots()
         ]
-        raise cfy_exc.RecoverableError(
-            "Still have several snapshots: {subsnapshots}."
-            .format(subsnapshots=repr(subsnapshots)))
+        if subsnapshots:
+            raise cfy_exc.RecoverableError(
+                "Still have several snapshots: {subsnapshots}."
+                .format(subsnapshots=repr(subsnapshots)))
 
 
 def _delete_force(dom):
@@ -472,7 +760,11 @@ def _delete_force(dom):
             )
 
     try:
-        if dom.undefineFlags(libvirt.VIR_DOMAIN_UNDEFINE_NVRAM) < 0:
+        # checkpoints of block backups are removed together with domain
+        if dom.undefineFlags(
+            libvirt.VIR_DOMAIN_UNDEFINE_NVRAM |
+            getattr(libvirt, 'VIR_DOMAIN_UNDEFINE_CHECKPOINTS_METADATA', 0)
+        ) < 0:
             raise cfy_exc.RecoverableError(
                 'Can not undefine guest domain with NVRAM.'
             )
@@ -500,11 +792,7 @@ def delete(**kwargs):
         return
 
     libvirt_auth, _ = common.get_libvirt_params(**kwargs)
-    conn = libvirt.open(libvirt_auth)
-    if conn is None:
-        raise cfy_exc.NonRecoverableError(
-            'Failed to open connection to the hypervisor'
-        )
+    conn = common.get_connection(libvirt_auth)
 
     try:
         try:
@@ -516,12 +804,352 @@ def delete(**kwargs):
 
         _delete_force(dom)
         ctx.instance.runtime_properties['resource_id'] = None
+        ctx.instance.runtime_properties['live_dump_overlays'] = None
+        ctx.instance.runtime_properties['block_checkpoint'] = None
     finally:
-        conn.close()
+        common.release_connection(conn)
+
+
+def _dump_params(template_params, restore=False):
+    """flags and typed params for save/restore of full dump"""
+    flags = 0
+    params = {}
+    if template_params.get('dump_bypass_cache'):
+        flags |= libvirt.VIR_DOMAIN_SAVE_BYPASS_CACHE
+    if template_params.get('dump_parallel'):
+        if hasattr(libvirt, 'VIR_DOMAIN_SAVE_PARAM_PARALLEL_CHANNELS'):
+            flags |= libvirt.VIR_DOMAIN_SAVE_PARALLEL
+            params[libvirt.VIR_DOMAIN_SAVE_PARAM_PARALLEL_CHANNELS] = int(
+                template_params['dump_parallel'])
+        else:
+            ctx.logger.info("Parallel save is unsupported by libvirt.")
+    if template_params.get('dump_format') and not restore:
+        if hasattr(libvirt, 'VIR_DOMAIN_SAVE_PARAM_IMAGE_FORMAT'):
+            params[libvirt.VIR_DOMAIN_SAVE_PARAM_IMAGE_FORMAT] = \
+                template_params['dump_format']
+        else:
+            ctx.logger.info("Save image format is unsupported by libvirt, "
+                            "save_image_format from qemu.conf is used.")
+    return flags, params
+
+
+def _dump_save(dom, path, template_params):
+    flags, params = _dump_params(template_params)
+    if params:
+        params[libvirt.VIR_DOMAIN_SAVE_PARAM_FILE] = path
+        dom.saveParams(params, flags)
+    elif flags:
+        dom.saveFlags(path, None, flags)
+    else:
+        dom.save(path)
 
 
-def _backup_create(conn, dom, resource_id, snapshot_name, full_dump, kwargs):
-    if full_dump:
+def _dump_restore(conn, path, template_params):
+    flags, params = _dump_params(template_params, restore=True)
+    if params:
+        params[libvirt.VIR_DOMAIN_SAVE_PARAM_FILE] = path
+        conn.restoreParams(params, flags)
+    elif flags:
+        conn.restoreFlags(path, None, flags)
+    else:
+        conn.restore(path)
+
+
+def _dump_size(path):
+    # dump is created on hypervisor side, could be unavailable
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return "unknown"
+
+
+def _disk_sources(dom):
+    """current active file for each disk"""
+    sources = {}
+    for disk in ET.fromstring(dom.XMLDesc()).findall('devices/disk'):
+        target = disk.find('target')
+        source = disk.find('source')
+        if target is not None and source is not None:
+            sources[target.get('dev')] = source.get('file')
+    return sources
+
+
+def _live_dump(dom, dump_path, snapshot_name, template_params, kwargs):
+    """save memory by external snapshot, domain is not stopped"""
+    disks = template_params.get('disks', [])
+    # memory state is consistent only with all disks frozen in base files
+    if not disks or [disk for disk in disks if disk.get('type') != "qcow2"]:
+        raise cfy_exc.NonRecoverableError(
+            "Live dump requires qcow2 type for all disks.")
+    last = ctx.instance.runtime_properties.get('live_dump_overlays')
+    if last:
+        # overlays of previous dump must be merged before new layer
+        raise cfy_exc.NonRecoverableError(
+            "Live dump {name} should be removed or applied before new live "
+            "dump.".format(name=last['name']))
+    params = {
+        'snapshot_name': snapshot_name,
+        'snapshot_description': "live dump",
+    }
+    params.update(template_params)
+    # path is resolved by libvirtd, relative paths are rejected
+    params['memory_file'] = os.path.abspath(dump_path)
+    xmlconfig = common.gen_xml_template(kwargs, params, 'snapshot')
+    started = time.time()
+    # memory file is used as dump, so snapshot metadata is not needed
+    dom.snapshotCreateXML(
+        xmlconfig,
+        libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_LIVE |
+        libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_NO_METADATA)
+    # base files are kept unchanged up to backup delete
+    ctx.instance.runtime_properties['live_dump_overlays'] = {
+        'name': snapshot_name,
+        'disks': {
+            disk['dev']: "{}.{}".format(disk['file'], snapshot_name)
+            for disk in disks
+        },
+    }
+    ctx.logger.info(
+        "Live dump is created in {duration:.1f}s, dump size: {size}"
+        .format(duration=time.time() - started, size=_dump_size(dump_path)))
+
+
+def _live_dump_overlays(snapshot_name):
+    """overlays created by live dump with such name"""
+    last = ctx.instance.runtime_properties.get('live_dump_overlays')
+    if not last or last['name'] != snapshot_name:
+        return None
+    return last['disks']
+
+
+def _live_dump_check(dom, snapshot_name):
+    """check that disks are still on overlays created by live dump"""
+    overlays = _live_dump_overlays(snapshot_name)
+    if not overlays:
+        raise cfy_exc.NonRecoverableError(
+            "Disks of live dump {snapshot_name} are already changed."
+            .format(snapshot_name=snapshot_name,))
+    sources = _disk_sources(dom)
+    for dev in sorted(overlays):
+        if sources.get(dev) != overlays[dev]:
+            raise cfy_exc.NonRecoverableError(
+                "Disk {dev} is switched from {overlay} to {source} after "
+                "live dump {snapshot_name}, base file has children."
+                .format(dev=dev, overlay=overlays[dev],
+                        source=sources.get(dev),
+                        snapshot_name=snapshot_name))
+    return overlays
+
+
+def _live_dump_remove_overlays(conn, overlays):
+    # overlays are created on hypervisor side, local only for local libvirt
+    for dev in sorted(overlays):
+        path = overlays[dev]
+        if os.path.isfile(path):
+            os.remove(path)
+            continue
+        try:
+            conn.storageVolLookupByPath(path).delete(0)
+        except libvirt.libvirtError as e:
+            ctx.logger.info(
+                "Overlay {} is not removed, remove it on hypervisor: {}"
+                .format(path, repr(e)))
+
+
+def _block_job_ready(dom, dev):
+    info = dom.blockJobInfo(dev, 0)
+    return bool(info) and info['cur'] == info['end']
+
+
+def _live_dump_commit(dom, snapshot_name, template_params):
+    """merge overlays created by live dump back to base files"""
+    if not _live_dump_overlays(snapshot_name):
+        # dump is already applied, domain uses base files
+        ctx.logger.info("No overlays to merge for live dump {}."
+                        .format(snapshot_name))
+        return
+    overlays = _live_dump_check(dom, snapshot_name)
+    if not dom.isActive():
+        raise cfy_exc.NonRecoverableError(
+            "Domain should be running for merge live dump disks.")
+    timeout = int(template_params.get('block_backup_timeout',
+                                      BLOCK_BACKUP_TIMEOUT))
+    for dev in sorted(overlays):
+        dom.blockCommit(dev, None, None, 0,
+                        libvirt.VIR_DOMAIN_BLOCK_COMMIT_ACTIVE |
+                        libvirt.VIR_DOMAIN_BLOCK_COMMIT_SHALLOW)
+        if not common.wait_for(
+            lambda: _block_job_ready(dom, dev), timeout
+        ):
+            dom.blockJobAbort(dev, 0)
+            raise cfy_exc.RecoverableError(
+                "Disk {} is not merged in {}s, aborted.".format(dev, timeout))
+        # switch domain back to base file
+        dom.blockJobAbort(dev, libvirt.VIR_DOMAIN_BLOCK_JOB_ABORT_PIVOT)
+    _live_dump_remove_overlays(dom.connect(), overlays)
+    ctx.instance.runtime_properties['live_dump_overlays'] = None
+
+
+def _block_manifest(backup_dir, resource_id):
+    return "{}/{}_blocks.json".format(backup_dir, resource_id)
+
+
+def _block_wait(dom, timeout):
+    """wait for backup job end and check result"""
+    if not common.wait_for(
+        lambda: dom.jobInfo()[0] == libvirt.VIR_DOMAIN_JOB_NONE, timeout
+    ):
+        dom.abortJob()
+        raise cfy_exc.RecoverableError(
+            "Block backup is not finished in {}s, aborted.".format(timeout))
+    stats = dom.jobStats(libvirt.VIR_DOMAIN_JOB_STATS_COMPLETED)
+    if stats.get('type') == libvirt.VIR_DOMAIN_JOB_FAILED:
+        raise cfy_exc.NonRecoverableError(
+            "Block backup is failed: {}".format(stats.get('errmsg')))
+    return stats
+
+
+def _block_backup_create(dom, resource_id, snapshot_name, template_params,
+                         kwargs):
+    """copy disks changed blocks from last checkpoint"""
+    # targets are resolved by libvirtd, not in agent working directory
+    backup_dir = os.path.abspath(common.get_backupdir(kwargs))
+    manifest_path = _block_manifest(backup_dir, resource_id)
+    if os.path.isfile(manifest_path):
+        raise cfy_exc.NonRecoverableError(
+            "Backup {snapshot_name} already exists."
+            .format(snapshot_name=snapshot_name,))
+
+    # only qcow2 can save dirty bitmaps
+    disks = [dict(disk) for disk in template_params.get('disks', [])]
+    for disk in disks:
+        if disk.get('type') == "qcow2":
+            disk['target'] = "{}/{}_{}.qcow2".format(
+                backup_dir, resource_id, disk['dev'])
+    if not [disk for disk in disks if disk.get('target')]:
+        raise cfy_exc.NonRecoverableError(
+            "No qcow2 disks for block backup.")
+
+    # previous backup in chain
+    parent = ctx.instance.runtime_properties.get('block_checkpoint')
+    parent_manifest = None
+    if parent:
+        try:
+            dom.checkpointLookupByName(parent['name'])
+            parent_manifest = common.read_manifest(parent['manifest'])
+        except libvirt.libvirtError as e:
+            ctx.logger.info("Checkpoint {} is unavailable: {}"
+                            .format(parent['name'], repr(e)))
+        if not parent_manifest:
+            ctx.logger.info("Will be created full block backup.")
+
+    params = {
+        'incremental': parent['name'] if parent_manifest else None,
+        'disks': disks,
+        'checkpoint_name': snapshot_name,
+        'checkpoint_description': kwargs.get('snapshot_type'),
+    }
+    backup_xml = common.gen_xml_template({}, params, 'backup')
+    checkpoint_xml = common.gen_xml_template({}, params, 'checkpoint')
+
+    common.create_binary_place(backup_dir)
+    started = time.time()
+    dom.backupBegin(backup_xml, checkpoint_xml)
+    try:
+        stats = _block_wait(dom, int(template_params.get(
+            'block_backup_timeout', BLOCK_BACKUP_TIMEOUT)))
+    except (cfy_exc.RecoverableError, cfy_exc.NonRecoverableError):
+        # checkpoint without backup files, retry will create it again
+        try:
+            dom.checkpointLookupByName(snapshot_name).delete()
+        except libvirt.libvirtError as e:
+            ctx.logger.info("Checkpoint {} is not removed: {}"
+                            .format(snapshot_name, repr(e)))
+        raise
+
+    # files for restore each disk, from full to last incremental
+    chains = {}
+    for disk in disks:
+        if not disk.get('target'):
+            continue
+        chain = []
+        if parent_manifest:
+            chain = parent_manifest['disks'].get(disk['dev'], [])
+        chains[disk['dev']] = chain + [disk['target']]
+    common.save_manifest(manifest_path, {
+        'checkpoint': snapshot_name,
+        'incremental': params['incremental'],
+        'disks': chains,
+    })
+    ctx.instance.runtime_properties['block_checkpoint'] = {
+        'name': snapshot_name,
+        'manifest': manifest_path,
+    }
+    ctx.logger.info(
+        "Block backup is created in {duration:.1f}s, copied: {size}"
+        .format(duration=time.time() - started,
+                size=stats.get('data_processed')))
+
+
+def _block_backup_delete(dom, resource_id, snapshot_name, kwargs):
+    backup_dir = common.get_backupdir(kwargs)
+    manifest_path = _block_manifest(backup_dir, resource_id)
+    manifest = common.read_manifest(manifest_path)
+    if not manifest:
+        raise cfy_exc.NonRecoverableError(
+            "No backups found with name: {snapshot_name}."
+            .format(snapshot_name=snapshot_name,))
+    try:
+        checkpoint = dom.checkpointLookupByName(manifest['checkpoint'])
+    except libvirt.libvirtError as e:
+        ctx.logger.info("Checkpoint is already removed: {}".format(repr(e)))
+        checkpoint = None
+    if checkpoint:
+        subcheckpoints = [
+            child.getName() for child in checkpoint.listAllChildren()
+        ]
+        if subcheckpoints:
+            raise cfy_exc.NonRecoverableError(
+                "Incremental backups {subcheckpoints} found for "
+                "{snapshot_name}. You should remove them before remove "
+                "current."
+                .format(snapshot_name=snapshot_name,
+                        subcheckpoints=repr(subcheckpoints)))
+        # dirty bitmap is merged to parent checkpoint
+        checkpoint.delete()
+    for chain in manifest['disks'].values():
+        if os.path.isfile(chain[-1]):
+            os.remove(chain[-1])
+    os.remove(manifest_path)
+    last = ctx.instance.runtime_properties.get('block_checkpoint')
+    if last and last['name'] == manifest['checkpoint']:
+        # next backup will be full
+        ctx.instance.runtime_properties['block_checkpoint'] = None
+
+
+def _block_backup_apply(resource_id, snapshot_name, kwargs):
+    manifest = common.read_manifest(_block_manifest(
+        common.get_backupdir(kwargs), resource_id))
+    if not manifest:
+        raise cfy_exc.NonRecoverableError(
+            "No backups found with name: {snapshot_name}."
+            .format(snapshot_name=snapshot_name,))
+    # disk images are not replaced under running domain
+    raise cfy_exc.NonRecoverableError(
+        "Block backup {snapshot_name} can't be applied to existing domain, "
+        "restore disks offline from: {chains}."
+        .format(snapshot_name=snapshot_name,
+                chains=", ".join(
+                    "{}: {}".format(dev, repr(manifest['disks'][dev]))
+                    for dev in sorted(manifest['disks']))))
+
+
+def _backup_create(conn, dom, resource_id, snapshot_name, template_params,
+                   kwargs):
+    if template_params.get('block_backup', False):
+        ctx.logger.info("Used block backup")
+        _block_backup_create(dom, resource_id, snapshot_name,
+                             template_params, kwargs)
+    elif template_params.get('full_dump', False):
         ctx.logger.info("Used full raw dump")
         # dump domain with memory and recreate domain
         # all snapshots will be removed
@@ -532,12 +1160,24 @@ def _backup_create(conn, dom, resource_id, snapshot_name, full_dump, kwargs):
                 .format(snapshot_name=snapshot_name,))
         # create place for store
         common.create_binary_place(common.get_backupdir(kwargs))
+        dump_path = common.get_binary_place(common.get_backupdir(kwargs),
+                                            resource_id)
+        if template_params.get('live_dump'):
+            _live_dump(dom, dump_path, snapshot_name, template_params,
+                       kwargs)
+            return
+        started = time.time()
         # save backup to directory (domain will be removed)
-        dom.save(common.get_binary_place(common.get_backupdir(kwargs),
-                                         resource_id))
+        _dump_save(dom, dump_path, template_params)
+        saved = time.time()
         # restore from backup
-        conn.restore(common.get_binary_place(common.get_backupdir(kwargs),
-                                             resource_id))
+        _dump_restore(conn, dump_path, template_params)
+        restored = time.time()
+        ctx.logger.info(
+            "Domain was stopped for {downtime:.1f}s (save: {save:.1f}s, "
+            "restore: {restore:.1f}s), dump size: {size}"
+            .format(downtime=restored - started, save=saved - started,
+                    restore=restored - saved, size=_dump_size(dump_path)))
     else:
         # non-destructive export for domain
         if common.read_node_state(common.get_backupdir(kwargs),
@@ -562,11 +1202,7 @@ def snapshot_create(**kwargs):
     snapshot_name = common.get_backupname(kwargs)
 
     libvirt_auth, template_params = common.get_libvirt_params(**kwargs)
-    conn = libvirt.open(libvirt_auth)
-    if conn is None:
-        raise cfy_exc.NonRecoverableError(
-            'Failed to open connection to the hypervisor'
-        )
+    conn = common.get_connection(libvirt_auth)
 
     try:
         try:
@@ -599,17 +1235,20 @@ def snapshot_create(**kwargs):
             ctx.logger.info("Snapshot name: {}".format(snapshot.getName()))
         else:
             _backup_create(
-                conn, dom, resource_id, snapshot_name,
-                template_params.get('full_dump', False),
+                conn, dom, resource_id, snapshot_name, template_params,
                 kwargs)
             ctx.logger.info("Backup {snapshot_name} is created."
                             .format(snapshot_name=snapshot_name,))
     finally:
-        conn.close()
+        common.release_connection(conn)
 
 
-def _backup_delete(dom, resource_id, snapshot_name, full_dump, kwargs):
-    if full_dump:
+def _backup_delete(dom, resource_id, snapshot_name, template_params,
+                   kwargs):
+    if template_params.get('block_backup', False):
+        ctx.logger.info("Used block backup")
+        _block_backup_delete(dom, resource_id, snapshot_name, kwargs)
+    elif template_params.get('full_dump', False):
         ctx.logger.info("Used full raw dump")
         # remove raw domain state
         if not common.check_binary_place(common.get_backupdir(kwargs),
@@ -617,6 +1256,8 @@ def _backup_delete(dom, resource_id, snapshot_name, full_dump, kwargs):
             raise cfy_exc.NonRecoverableError(
                 "No backups found with name: {snapshot_name}."
                 .format(snapshot_name=snapshot_name,))
+        if template_params.get('live_dump'):
+            _live_dump_commit(dom, snapshot_name, template_params)
         common.delete_binary_place(common.get_backupdir(kwargs),
                                    resource_id)
     else:
@@ -641,11 +1282,7 @@ def snapshot_delete(**kwargs):
     snapshot_name = common.get_backupname(kwargs)
 
     libvirt_auth, template_params = common.get_libvirt_params(**kwargs)
-    conn = libvirt.open(libvirt_auth)
-    if conn is None:
-        raise cfy_exc.NonRecoverableError(
-            'Failed to open connection to the hypervisor'
-        )
+    conn = common.get_connection(libvirt_auth)
 
     try:
         try:
@@ -670,15 +1307,18 @@ def snapshot_delete(**kwargs):
             snapshot.delete()
         else:
             _backup_delete(
-                dom, resource_id, snapshot_name,
-                template_params.get('full_dump', False), kwargs)
+                dom, resource_id, snapshot_name, template_params, kwargs)
         ctx.logger.info("Backup deleted: {}".format(snapshot_name))
     finally:
-        conn.close()
+        common.release_connection(conn)
 
 
-def _backup_apply(conn, dom, resource_id, snapshot_name, full_dump, kwargs):
-    if full_dump:
+def _backup_apply(conn, dom, resource_id, snapshot_name, template_params,
+                  kwargs):
+    if template_params.get('block_backup', False):
+        ctx.logger.info("Used block backup")
+        _block_backup_apply(resource_id, snapshot_name, kwargs)
+    elif template_params.get('full_dump', False):
         ctx.logger.info("Used full raw dump")
         # restore domain with memory and recreate domain
         # all snapshots will be removed
@@ -688,11 +1328,24 @@ def _backup_apply(conn, dom, resource_id, snapshot_name, full_dump, kwargs):
                 "No backups found with name: {snapshot_name}."
                 .format(snapshot_name=snapshot_name,))
 
+        overlays = None
+        if template_params.get('live_dump'):
+            # restored memory expects base files without later changes
+            overlays = _live_dump_check(dom, snapshot_name)
         # old domain will be removed
         _delete_force(dom)
+        if overlays:
+            _live_dump_remove_overlays(conn, overlays)
+            # base files will be changed by restored domain
+            ctx.instance.runtime_properties['live_dump_overlays'] = None
         # and new created
-        conn.restore(common.get_binary_place(common.get_backupdir(kwargs),
-                                             resource_id))
+        started = time.time()
+        _dump_restore(conn,
+                      common.get_binary_place(common.get_backupdir(kwargs),
+                                              resource_id),
+                      template_params)
+        ctx.logger.info("Domain is restored in {:.1f}s"
+                        .format(time.time() - started))
     else:
         # light version of backup
         dom_backup = common.read_node_state(common.get_backupdir(kwargs),
@@ -724,11 +1377,7 @@ def snapshot_apply(**kwargs):
     snapshot_name = common.get_backupname(kwargs)
 
     libvirt_auth, template_params = common.get_libvirt_params(**kwargs)
-    conn = libvirt.open(libvirt_auth)
-    if conn is None:
-        raise cfy_exc.NonRecoverableError(
-            'Failed to open connection to the hypervisor'
-        )
+    conn = common.get_connection(libvirt_auth)
 
     try:
         try:
@@ -745,11 +1394,11 @@ def snapshot_apply(**kwargs):
             ctx.logger.info("Reverted to: {}".format(snapshot.getName()))
         else:
             _backup_apply(
-                conn, dom, resource_id, snapshot_name,
-                template_params.get('full_dump', False), kwargs)
+                conn, dom, resource_id, snapshot_name, template_params,
+                kwargs)
             ctx.logger.info("Restored to: {}".format(snapshot_name))
     finally:
-        conn.close()
+        common.release_connection(conn)
 
 
 def _current_use(dom):
@@ -764,6 +1413,53 @@ def _current_use(dom):
     ) / 1000000000.0
 
 
+def _get_bulk_stats(conn, dom):
+    # all statistics of domain by one call
+    records = conn.domainListGetStats([dom], BULK_STATS_FLAGS, 0)
+    if not records:
+        raise cfy_exc.NonRecoverableError(
+            'Failed to get statistics for the domain: {}'.format(dom.name())
+        )
+    return time.time(), records[0][1]
+
+
+def _device_stats(record, prefix, fields):
+    devices = []
+    for i in range(record.get('{}.count'.format(prefix), 0)):
+        device = {
+            'name': record.get('{}.{}.name'.format(prefix, i))
+        }
+        for field in fields:
+            device[field.replace('.', '_')] = record.get(
+                '{}.{}.{}'.format(prefix, i, field), 0)
+        devices.append(device)
+    return devices
+
+
+def _bulk_statistics(statistics, record, timestamp):
+    cpu_time = record.get('cpu.time', 0) / 1000000000.0
+    # usage generated by compare cpu_time with previous sample
+    if statistics.get('timestamp') and timestamp > statistics['timestamp']:
+        statistics['cpu'] = round(
+            100 * (cpu_time - statistics.get('cpu_time', 0)) /
+            (timestamp - statistics['timestamp']), 2)
+    statistics['cpu_time'] = cpu_time
+    statistics['timestamp'] = timestamp
+    statistics['memory'] = record.get('balloon.current', 0) / 1024.0
+    statistics['vcpu'] = [{
+        'state': record.get('vcpu.{}.state'.format(i), 0),
+        'time': record.get('vcpu.{}.time'.format(i), 0) / 1000000000.0
+    } for i in range(record.get('vcpu.current', 0))]
+    statistics['network'] = _device_stats(
+        record, 'net', ['rx.bytes', 'rx.pkts', 'rx.errs', 'rx.drop',
+                        'tx.bytes', 'tx.pkts', 'tx.errs', 'tx.drop'])
+    statistics['block'] = _device_stats(
+        record, 'block', ['rd.reqs', 'rd.bytes', 'rd.times',
+                          'wr.reqs', 'wr.bytes', 'wr.times',
+                          'allocation', 'capacity', 'physical'])
+    return statistics
+
+
 @operation
 def perfomance(**kwargs):
     ctx.logger.info("update statistics")
@@ -774,13 +1470,11 @@ def perfomance(**kwargs):
         raise cfy_exc.NonRecoverableError("No servers for statistics.")
 
     libvirt_auth, template_params = common.get_libvirt_params(**kwargs)
-    conn = libvirt.open(libvirt_auth)
-    if conn is None:
-        raise cfy_exc.NonRecoverableError(
-            'Failed to open connection to the hypervisor'
-        )
+    conn = common.get_connection(libvirt_auth)
 
     try:
+        statistics = ctx.instance.runtime_properties.get('stat', {})
+
         try:
             dom = conn.lookupByName(resource_id)
         except libvirt.libvirtError as e:
@@ -788,7 +1482,12 @@ def perfomance(**kwargs):
                 'Failed to find the domain: {}'.format(repr(e))
             )
 
-        statistics = ctx.instance.runtime_properties.get('stat', {})
+        if kwargs.get('bulk_stats'):
+            timestamp, record = _get_bulk_stats(conn, dom)
+            ctx.instance.runtime_properties['stat'] = _bulk_statistics(
+                statistics, record, timestamp)
+            ctx.logger.info("Statistics: {}".format(repr(statistics)))
+            return
 
         before_usage = _current_use(dom)
 
@@ -804,7 +1503,155 @@ def perfomance(**kwargs):
 
         ctx.logger.info("Statistics: {}".format(repr(statistics)))
     finally:
-        conn.close()
+        common.release_connection(conn)
+
+
+def _device_fragments(xmlconfig):
+    """split devices list to separate device descriptions"""
+    xmlconfig = xmlconfig.strip()
+    if xmlconfig.startswith("<?xml"):
+        xmlconfig = xmlconfig[xmlconfig.index("?>") + 2:]
+    root = ET.fromstring("<devices>{}</devices>".format(xmlconfig))
+    devices = list(root)
+    if len(devices) == 1 and devices[0].tag == "devices":
+        devices = list(devices[0])
+    fragments = []
+    for device in devices:
+        device.tail = None
+        fragments.append(ET.tostring(device).decode("utf-8"))
+    return fragments
+
+
+def _device_alias(devices, fragment):
+    """alias of domain device described by fragment"""
+    device = ET.fromstring(fragment)
+    alias = device.find('alias')
+    if alias is not None:
+        return alias.get('name')
+    # devices are identified by target or mac address
+    keys = [
+        (path, attr, device.find(path).get(attr))
+        for path, attr in (('target', 'dev'), ('mac', 'address'))
+        if device.find(path) is not None
+    ]
+    if not keys:
+        return None
+    for candidate in devices.findall(device.tag):
+        if all(candidate.find(path) is not None and
+               candidate.find(path).get(attr) == value
+               for path, attr, value in keys):
+            alias = candidate.find('alias')
+            return alias.get('name') if alias is not None else None
+    return None
+
+
+def _device_aliases(dom, fragments):
+    devices = ET.fromstring(dom.XMLDesc()).find('devices')
+    if devices is None:
+        return [None for _ in fragments]
+    return [_device_alias(devices, fragment) for fragment in fragments]
+
+
+def _revert_devices(rollback, applied, flags):
+    """revert already applied devices, return not reverted"""
+    not_reverted = []
+    for xmlconfig in reversed(applied):
+        if rollback is None:
+            not_reverted.append(xmlconfig)
+            continue
+        try:
+            if rollback(xmlconfig, flags) < 0:
+                not_reverted.append(xmlconfig)
+        except libvirt.libvirtError as e:
+            ctx.logger.info("Can not revert device {}: {}"
+                            .format(xmlconfig, repr(e)))
+            not_reverted.append(xmlconfig)
+    return not_reverted
+
+
+def _change_devices(conn, dom, fragments, change, event_id, timeout,
+                    rollback=None):
+    """call change for each device, on running domain change is applied
+    to live and persistent config and confirmed by device events, on
+    error already applied devices are reverted by rollback"""
+    state, _ = dom.state()
+    flags = libvirt.VIR_DOMAIN_AFFECT_CONFIG
+    if state == libvirt.VIR_DOMAIN_RUNNING:
+        flags |= libvirt.VIR_DOMAIN_AFFECT_LIVE
+    else:
+        event_id = None
+
+    event = None
+    callback_id = None
+    aliases = []
+    if event_id is not None and common.start_event_loop():
+        event = threading.Event()
+
+        def _device_changed(_conn, _dom, alias, _opaque):
+            aliases.append(alias)
+            event.set()
+
+        try:
+            callback_id = conn.domainEventRegisterAny(
+                dom, event_id, _device_changed, None)
+        except libvirt.libvirtError as e:
+            ctx.logger.debug("Device events are unsupported: {}"
+                             .format(repr(e)))
+
+    try:
+        expected = []
+        if (
+            callback_id is not None and
+            event_id == libvirt.VIR_DOMAIN_EVENT_ID_DEVICE_REMOVED
+        ):
+            # aliases are available only before detach
+            expected = _device_aliases(dom, fragments)
+        applied = []
+        for xmlconfig in fragments:
+            try:
+                failed = change(xmlconfig, flags) < 0
+            except libvirt.libvirtError as e:
+                ctx.logger.info("Can not update device {}: {}"
+                                .format(xmlconfig, repr(e)))
+                failed = True
+            if failed:
+                not_reverted = _revert_devices(rollback, applied, flags)
+                if not_reverted:
+                    raise cfy_exc.NonRecoverableError(
+                        "Can not update device: {}, devices {} are still "
+                        "changed, operation is not idempotent."
+                        .format(xmlconfig, repr(not_reverted)))
+                raise cfy_exc.NonRecoverableError(
+                    "Can not update device: {}".format(xmlconfig))
+            applied.append(xmlconfig)
+        if callback_id is None:
+            return
+        if not expected:
+            # aliases are assigned by libvirt on attach
+            expected = _device_aliases(dom, fragments)
+        known = [alias for alias in expected if alias]
+
+        def _confirmed():
+            if [alias for alias in known if alias not in aliases]:
+                return False
+            # devices without known alias are confirmed by other events
+            return len([
+                alias for alias in aliases if alias not in known
+            ]) >= len(fragments) - len(known)
+
+        # detach is finished only after guest has released device
+        if not common.wait_for(_confirmed, timeout, event):
+            raise cfy_exc.NonRecoverableError(
+                "Devices change is not confirmed in {}s, changed: {}"
+                .format(timeout, repr(aliases)))
+        ctx.logger.info("Devices changed: {}".format(repr(aliases)))
+    finally:
+        if callback_id is not None:
+            try:
+                conn.domainEventDeregisterAny(callback_id)
+            except libvirt.libvirtError as e:
+                ctx.logger.debug("Failed to deregister events: {}"
+                                 .format(repr(e)))
 
 
 @operation
@@ -819,11 +1666,7 @@ def update_domain_flags(**kwargs):
         raise cfy_exc.NonRecoverableError("No servers for update")
 
     libvirt_auth, _ = common.get_libvirt_params(**kwargs)
-    conn = libvirt.open(libvirt_auth)
-    if conn is None:
-        raise cfy_exc.NonRecoverableError(
-            'Failed to open connection to the hypervisor'
-        )
+    conn = common.get_connection(libvirt_auth)
 
     try:
         try:
@@ -833,15 +1676,14 @@ def update_domain_flags(**kwargs):
                 'Failed to find the domain: {}'.format(repr(e))
             )
 
-        state, _ = dom.state()
-        if state == libvirt.VIR_DOMAIN_RUNNING:
-            ctx.logger.info("Looks as running. Stop before updating")
-            return
         xmlconfig = common.gen_xml_template(kwargs, template_params, 'domain')
-        dom.updateDeviceFlags(xmlconfig)
+        _change_devices(conn, dom, _device_fragments(xmlconfig),
+                        dom.updateDeviceFlags,
+                        None,
+                        _get_wait_timeout(template_params))
         ctx.logger.info('Domain {0} updated.'.format(resource_id))
     finally:
-        conn.close()
+        common.release_connection(conn)
 
 
 @operation
@@ -856,11 +1698,7 @@ def detach_device_flags(**kwargs):
         raise cfy_exc.NonRecoverableError("No servers for update")
 
     libvirt_auth, _ = common.get_libvirt_params(**kwargs)
-    conn = libvirt.open(libvirt_auth)
-    if conn is None:
-        raise cfy_exc.NonRecoverableError(
-            'Failed to open connection to the hypervisor'
-        )
+    conn = common.get_connection(libvirt_auth)
 
     try:
         try:
@@ -870,15 +1708,15 @@ def detach_device_flags(**kwargs):
                 'Failed to find the domain: {}'.format(repr(e))
             )
 
-        state, _ = dom.state()
-        if state == libvirt.VIR_DOMAIN_RUNNING:
-            ctx.logger.info("Looks as running. Stop before updating")
-            return
         xmlconfig = common.gen_xml_template(kwargs, template_params, 'domain')
-        dom.detachDeviceFlags(xmlconfig)
+        _change_devices(conn, dom, _device_fragments(xmlconfig),
+                        dom.detachDeviceFlags,
+                        libvirt.VIR_DOMAIN_EVENT_ID_DEVICE_REMOVED,
+                        _get_wait_timeout(template_params),
+                        dom.attachDeviceFlags)
         ctx.logger.info('Domain {0} updated.'.format(resource_id))
     finally:
-        conn.close()
+        common.release_connection(conn)
 
 
 @operation
@@ -893,11 +1731,7 @@ def attach_device_flags(**kwargs):
         raise cfy_exc.NonRecoverableError("No servers for update")
 
     libvirt_auth, _ = common.get_libvirt_params(**kwargs)
-    conn = libvirt.open(libvirt_auth)
-    if conn is None:
-        raise cfy_exc.NonRecoverableError(
-            'Failed to open connection to the hypervisor'
-        )
+    conn = common.get_connection(libvirt_auth)
 
     try:
         try:
@@ -907,12 +1741,12 @@ def attach_device_flags(**kwargs):
                 'Failed to find the domain: {}'.format(repr(e))
             )
 
-        state, _ = dom.state()
-        if state == libvirt.VIR_DOMAIN_RUNNING:
-            ctx.logger.info("Looks as running. Stop before updating")
-            return
         xmlconfig = common.gen_xml_template(kwargs, template_params, 'domain')
-        dom.attachDeviceFlags(xmlconfig)
+        _change_devices(conn, dom, _device_fragments(xmlconfig),
+                        dom.attachDeviceFlags,
+                        libvirt.VIR_DOMAIN_EVENT_ID_DEVICE_ADDED,
+                        _get_wait_timeout(template_params),
+                        dom.detachDeviceFlags)
         ctx.logger.info('Domain {0} updated.'.format(resource_id))
     finally:
-        conn.close()
+        common.release_connection(conn)
@@ -12,27 +12,168 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
 import libvirt
 import os
+import pycdlib
+import re
+import tempfile
+from io import BytesIO
 
 from cloudify import ctx
 from cloudify.decorators import operation
 from cloudify import exceptions as cfy_exc
-import cloudify_common_sdk.iso9660 as iso9660
 
 import cloudify_libvirt.common as common
 
+# keep iso image in memory up to 16 MiB, bigger images go to disk
+ISO_SPOOL_SIZE = 1024 * 1024 * 16
+# default size limit of images in cache_dir, in MiB
+ISO_CACHE_LIMIT = 1024
+
+
+# Names in image are generated same way as in create_iso from
+# cloudify-utilities-plugins-sdk 0.0.130, keep in sync on sdk upgrade.
+def _joliet_name(name):
+    if name[0] == "/":
+        name = name[1:]
+    return "/{name}".format(name=name[:64])
+
+
+def _name_cleanup(name):
+    return re.sub('[^A-Z0-9_/]{1}', r'_', name.upper())
+
+
+def _iso_name(name):
+    if name[0] == "/":
+        name = name[1:]
+
+    name_splited = name.split('.')
+    if len(name_splited[-1]) <= 3 and len(name_splited) > 1:
+        return "/{name}.{ext};3".format(
+            name=_name_cleanup("_".join(name_splited[:-1])),
+            ext=_name_cleanup(name_splited[-1]))
+    else:
+        return "/{name}.;3".format(name=_name_cleanup(name))
+
+
+def _write_iso(outiso, vol_ident, sys_ident, files):
+    """iso9660.create_iso with write to file instead of memory"""
+    iso = pycdlib.PyCdlib()
+    iso.new(interchange_level=3, joliet=3,
+            vol_ident=vol_ident, sys_ident=sys_ident)
+
+    # existed directories
+    dirs = set()
+
+    # write file contents to cdrom image
+    for name in files:
+        content = files[name]
+        if not isinstance(content, bytes):
+            content = content.encode()
+        dir_path_spited = name.split("/")
+        initial_path = ""
+        for sub_name in dir_path_spited[:-1]:
+            initial_path = initial_path + "/" + sub_name
+            if initial_path not in dirs:
+                iso.add_directory(
+                    _name_cleanup(initial_path),
+                    joliet_path=_joliet_name(initial_path))
+                dirs.add(initial_path)
+        iso.add_fp(BytesIO(content), len(content),
+                   _iso_name(name),
+                   joliet_path=_joliet_name(name))
+
+    # finalize iso
+    iso.write_fp(outiso)
+    iso.close()
+
+
+def _iso_hash(vol_ident, sys_ident, files):
+    key = hashlib.sha256()
+    for value in [vol_ident, sys_ident] + [
+        item for name in sorted(files) for item in (name, files[name])
+    ]:
+        if not isinstance(value, bytes):
+            value = value.encode()
+        # length prefix, so values can't be merged
+        key.update("{}:".format(len(value)).encode())
+        key.update(value)
+    return key.hexdigest()
+
+
+def _cache_evict(cache_dir, limit, keep):
+    """remove least recently used images while cache is bigger than
+    limit in bytes"""
+    images = []
+    for name in os.listdir(cache_dir):
+        if not name.endswith(".iso"):
+            continue
+        path = os.path.join(cache_dir, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            # removed by other instance
+            continue
+        images.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in images)
+    for _, size, path in sorted(images):
+        if total <= limit:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+            ctx.logger.info("Image is removed from cache: {}".format(path))
+        except OSError:
+            pass
+        total -= size
+
+
+def _cached_iso(cache_dir, iso_params, limit):
+    """return image with such params from cache dir, build image
+    if there is no such"""
+    iso_path = os.path.join(
+        cache_dir, "{}.iso".format(_iso_hash(**iso_params)))
+    outiso = None
+    try:
+        outiso = open(iso_path, 'rb')
+        # last use time for eviction
+        os.utime(iso_path, None)
+    except (IOError, OSError):
+        # no such image or it is removed right now
+        pass
+    if outiso:
+        ctx.logger.info("Use cached image: {}".format(iso_path))
+        return outiso
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    outiso = tempfile.NamedTemporaryFile(dir=cache_dir, suffix=".tmp",
+                                         delete=False)
+    try:
+        _write_iso(outiso, **iso_params)
+        outiso.flush()
+        # image is visible for other instances only when ready
+        os.rename(outiso.name, iso_path)
+    except BaseException:
+        outiso.close()
+        os.remove(outiso.name)
+        raise
+    ctx.logger.info("Image is saved to cache: {}".format(iso_path))
+    _cache_evict(cache_dir, limit, iso_path)
+    return outiso
+
+
+def _read_chunk(stream, size, outiso):
+    return outiso.read(size)
+
 
 @operation
 def create(**kwargs):
     ctx.logger.info("Creating new iso image.")
 
     libvirt_auth, template_params = common.get_libvirt_params(**kwargs)
-    conn = libvirt.open(libvirt_auth)
-    if conn is None:
-        raise cfy_exc.NonRecoverableError(
-            'Failed to open connection to the hypervisor'
-        )
+    conn = common.get_connection(libvirt_auth)
 
     try:
         # lookup the default volume by name
@@ -44,29 +185,38 @@ def create(**kwargs):
                 'Failed to find the volume: {}'.format(repr(e))
             )
 
-        outiso = iso9660.create_iso(
-            vol_ident=template_params.get('vol_ident', 'cidata'),
-            sys_ident=template_params.get('sys_ident', ""),
-            get_resource=ctx.get_resource,
-            files=template_params.get('files', {}),
-            files_raw=template_params.get('files_raw', {}))
+        files = dict(template_params.get('files') or {})
+        # apply raw files over files content
+        files_raw = template_params.get('files_raw') or {}
+        for name in files_raw:
+            files[name] = ctx.get_resource(files_raw[name])
 
-        outiso.seek(0, os.SEEK_END)
-        iso_size = outiso.tell()
-        outiso.seek(0, os.SEEK_SET)
+        iso_params = {
+            'vol_ident': template_params.get('vol_ident', 'cidata'),
+            'sys_ident': template_params.get('sys_ident', ""),
+            'files': files
+        }
+        if template_params.get('cache_dir'):
+            outiso = _cached_iso(
+                template_params['cache_dir'], iso_params,
+                int(template_params.get('cache_limit', ISO_CACHE_LIMIT)) *
+                1024 * 1024)
+        else:
+            outiso = tempfile.SpooledTemporaryFile(max_size=ISO_SPOOL_SIZE)
+            _write_iso(outiso, **iso_params)
 
-        ctx.logger.info("ISO size: {}".format(repr(iso_size)))
+        with outiso:
+            outiso.seek(0, os.SEEK_END)
+            iso_size = outiso.tell()
+            outiso.seek(0, os.SEEK_SET)
 
-        stream = conn.newStream(0)
-        volume.upload(stream, 0, iso_size, 0)
-        outiso.seek(0, os.SEEK_SET)
+            ctx.logger.info("ISO size: {}".format(repr(iso_size)))
 
-        read_size = iso_size
-        while read_size > 0:
-            buffer = outiso.read(read_size)
-            read_size -= len(buffer)
-            stream.send(buffer)
-        stream.finish()
+            stream = conn.newStream(0)
+            volume.upload(stream, 0, iso_size, 0)
+            # send by chunks, without read whole image to memory
+            stream.sendAll(_read_chunk, outiso)
+            stream.finish()
 
     finally:
-        conn.close()
+        common.release_connection(conn)
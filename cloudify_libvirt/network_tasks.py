@@ -13,24 +13,24 @@
 # limitations under the License.
 
 import libvirt
-import time
 
 from cloudify import ctx
 from cloudify.decorators import operation
 from cloudify import exceptions as cfy_exc
 import cloudify_libvirt.common as common
 
+# time limit for ip discovery on link, in seconds
+LINK_WAIT_TIMEOUT = 600
+# libvirt has no events for dhcp leases, so poll leases often
+LEASE_MAX_DELAY = 5
+
 
 @operation
 def create(**kwargs):
     ctx.logger.info("Creating new network.")
 
     libvirt_auth, template_params = common.get_libvirt_params(**kwargs)
-    conn = libvirt.open(libvirt_auth)
-    if conn is None:
-        raise cfy_exc.NonRecoverableError(
-            'Failed to open connection to the hypervisor'
-        )
+    conn = common.get_connection(libvirt_auth)
 
     try:
         if ctx.instance.runtime_properties.get("use_external_resource"):
@@ -79,7 +79,7 @@ def create(**kwargs):
         else:
             ctx.logger.info('The new persistent virtual network is not active')
     finally:
-        conn.close()
+        common.release_connection(conn)
 
 
 @operation
@@ -97,11 +97,7 @@ def delete(**kwargs):
         return
 
     libvirt_auth, _ = common.get_libvirt_params(**kwargs)
-    conn = libvirt.open(libvirt_auth)
-    if conn is None:
-        raise cfy_exc.NonRecoverableError(
-            'Failed to open connection to the hypervisor'
-        )
+    conn = common.get_connection(libvirt_auth)
 
     try:
         # lookup the default network by name
@@ -118,9 +114,9 @@ def delete(**kwargs):
             )
 
         ctx.instance.runtime_properties['resource_id'] = None
-        ctx.instance.runtime_properties['backups'] = {}
+        common.delete_backups()
     finally:
-        conn.close()
+        common.release_connection(conn)
 
 
 @operation
@@ -133,11 +129,7 @@ def snapshot_create(**kwargs):
         raise cfy_exc.NonRecoverableError("No network for backup")
 
     libvirt_auth, _ = common.get_libvirt_params(**kwargs)
-    conn = libvirt.open(libvirt_auth)
-    if conn is None:
-        raise cfy_exc.NonRecoverableError(
-            'Failed to open connection to the hypervisor'
-        )
+    conn = common.get_connection(libvirt_auth)
 
     try:
         # lookup the default network by name
@@ -150,7 +142,7 @@ def snapshot_create(**kwargs):
 
         common.xml_snapshot_create(kwargs, resource_id, network.XMLDesc())
     finally:
-        conn.close()
+        common.release_connection(conn)
 
 
 @operation
@@ -163,11 +155,7 @@ def snapshot_apply(**kwargs):
         raise cfy_exc.NonRecoverableError("No network for restore")
 
     libvirt_auth, _ = common.get_libvirt_params(**kwargs)
-    conn = libvirt.open(libvirt_auth)
-    if conn is None:
-        raise cfy_exc.NonRecoverableError(
-            'Failed to open connection to the hypervisor'
-        )
+    conn = common.get_connection(libvirt_auth)
 
     try:
         # lookup the default network by name
@@ -180,7 +168,7 @@ def snapshot_apply(**kwargs):
 
         common.xml_snapshot_apply(kwargs, resource_id, network.XMLDesc())
     finally:
-        conn.close()
+        common.release_connection(conn)
 
 
 @operation
@@ -203,11 +191,7 @@ def link(**kwargs):
                     .format(repr(resource_id), repr(vm_id)))
 
     libvirt_auth = ctx.target.instance.runtime_properties.get('libvirt_auth')
-    conn = libvirt.open(libvirt_auth)
-    if conn is None:
-        raise cfy_exc.NonRecoverableError(
-            'Failed to open connection to the hypervisor'
-        )
+    conn = common.get_connection(libvirt_auth)
 
     try:
         # lookup the default network by name
@@ -218,28 +202,34 @@ def link(**kwargs):
                 'Failed to find the network: {}'.format(repr(e))
             )
 
-        MAX_RETRY = 10
-        for i in range(MAX_RETRY):
-            ctx.logger.info("{}: Tring to get vm ip: {}/{}"
-                            .format(vm_id, i, MAX_RETRY))
+        source_properties = ctx.source.instance.runtime_properties
+        vm_macs = [
+            vm_network.get('mac')
+            for vm_network in source_properties.get(
+                'params', {}).get("networks", [])
+            if vm_network.get('mac')
+        ]
+
+        def _check_leases():
             for lease in network.DHCPLeases():
-                source_properties = ctx.source.instance.runtime_properties
-                vm_params = source_properties.get(
-                    'params', {})
-                for vm_network in vm_params.get("networks", []):
-                    if vm_network.get('mac') == lease.get('mac'):
-                        source_properties['ip'] = lease.get('ipaddr')
-                        ctx.logger.info("{}:Found: {}"
-                                        .format(vm_id, lease.get('ipaddr')))
-                        return
-            # we have never get ip before 60 sec, so wait 60 as minimum
-            time.sleep(60)
-
-        raise cfy_exc.RecoverableError(
-            'No ip for now, try later'
-        )
+                if lease.get('mac') in vm_macs:
+                    source_properties['ip'] = lease.get('ipaddr')
+                    ctx.logger.info("{}:Found: {}"
+                                    .format(vm_id, lease.get('ipaddr')))
+                    return True
+            return False
+
+        ctx.logger.info("{}: Tring to get vm ip.".format(vm_id))
+        if not common.wait_for(
+            _check_leases,
+            int(kwargs.get('wait_timeout', LINK_WAIT_TIMEOUT)),
+            max_delay=LEASE_MAX_DELAY
+        ):
+            raise cfy_exc.RecoverableError(
+                'No ip for now, try later'
+            )
     finally:
-        conn.close()
+        common.release_connection(conn)
 
 
 @operation
@@ -33,11 +33,7 @@ def create(**kwargs):
     ctx.logger.info("Creating new pool.")
 
     libvirt_auth, template_params = common.get_libvirt_params(**kwargs)
-    conn = libvirt.open(libvirt_auth)
-    if conn is None:
-        raise cfy_exc.NonRecoverableError(
-            'Failed to open connection to the hypervisor'
-        )
+    conn = common.get_connection(libvirt_auth)
 
     _update_template_params(template_params)
     try:
@@ -71,7 +67,7 @@ def create(**kwargs):
         ctx.instance.runtime_properties['resource_id'] = pool.name()
         ctx.instance.runtime_properties['use_external_resource'] = False
     finally:
-        conn.close()
+        common.release_connection(conn)
 
 
 @operation
@@ -89,11 +85,7 @@ def configure(**kwargs):
         return
 
     libvirt_auth, _ = common.get_libvirt_params(**kwargs)
-    conn = libvirt.open(libvirt_auth)
-    if conn is None:
-        raise cfy_exc.NonRecoverableError(
-            'Failed to open connection to the hypervisor'
-        )
+    conn = common.get_connection(libvirt_auth)
 
     try:
         try:
@@ -117,7 +109,7 @@ def configure(**kwargs):
                     'Can not build guest pool.'
                 )
     finally:
-        conn.close()
+        common.release_connection(conn)
 
 
 @operation
@@ -135,11 +127,7 @@ def start(**kwargs):
         return
 
     libvirt_auth, _ = common.get_libvirt_params(**kwargs)
-    conn = libvirt.open(libvirt_auth)
-    if conn is None:
-        raise cfy_exc.NonRecoverableError(
-            'Failed to open connection to the hypervisor'
-        )
+    conn = common.get_connection(libvirt_auth)
 
     try:
         try:
@@ -166,7 +154,7 @@ def start(**kwargs):
                 'Can not start pool.'
             )
     finally:
-        conn.close()
+        common.release_connection(conn)
 
 
 @operation
@@ -185,11 +173,7 @@ def stop(**kwargs):
         return
 
     libvirt_auth, _ = common.get_libvirt_params(**kwargs)
-    conn = libvirt.open(libvirt_auth)
-    if conn is None:
-        raise cfy_exc.NonRecoverableError(
-            'Failed to open connection to the hypervisor'
-        )
+    conn = common.get_connection(libvirt_auth)
 
     try:
         try:
@@ -225,7 +209,7 @@ def stop(**kwargs):
                     'Can not delete guest pool.'
                 )
     finally:
-        conn.close()
+        common.release_connection(conn)
 
 
 @operation
@@ -243,11 +227,7 @@ def delete(**kwargs):
         return
 
     libvirt_auth, _ = common.get_libvirt_params(**kwargs)
-    conn = libvirt.open(libvirt_auth)
-    if conn is None:
-        raise cfy_exc.NonRecoverableError(
-            'Failed to open connection to the hypervisor'
-        )
+    conn = common.get_connection(libvirt_auth)
 
     try:
         # lookup the default pool by name
@@ -269,9 +249,9 @@ def delete(**kwargs):
             )
 
         ctx.instance.runtime_properties['resource_id'] = None
-        ctx.instance.runtime_properties['backups'] = {}
+        common.delete_backups()
     finally:
-        conn.close()
+        common.release_connection(conn)
 
 
 @operation
@@ -284,11 +264,7 @@ def snapshot_create(**kwargs):
         raise cfy_exc.NonRecoverableError("No pool for backup")
 
     libvirt_auth, _ = common.get_libvirt_params(**kwargs)
-    conn = libvirt.open(libvirt_auth)
-    if conn is None:
-        raise cfy_exc.NonRecoverableError(
-            'Failed to open connection to the hypervisor'
-        )
+    conn = common.get_connection(libvirt_auth)
 
     try:
         # lookup the default pool by name
@@ -301,7 +277,7 @@ def snapshot_create(**kwargs):
 
         common.xml_snapshot_create(kwargs, resource_id, pool.XMLDesc())
     finally:
-        conn.close()
+        common.release_connection(conn)
 
 
 @operation
@@ -314,11 +290,7 @@ def snapshot_apply(**kwargs):
         raise cfy_exc.NonRecoverableError("No pool for restore")
 
     libvirt_auth, _ = common.get_libvirt_params(**kwargs)
-    conn = libvirt.open(libvirt_auth)
-    if conn is None:
-        raise cfy_exc.NonRecoverableError(
-            'Failed to open connection to the hypervisor'
-        )
+    conn = common.get_connection(libvirt_auth)
 
     try:
         # lookup the default pool by name
@@ -331,7 +303,7 @@ def snapshot_apply(**kwargs):
 
         common.xml_snapshot_apply(kwargs, resource_id, pool.XMLDesc())
     finally:
-        conn.close()
+        common.release_connection(conn)
 
 
 @operation
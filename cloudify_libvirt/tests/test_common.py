@@ -11,9 +11,15 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
 import unittest
 import mock
 
+from cloudify.exceptions import NonRecoverableError
 from cloudify.state import current_ctx
 from cloudify.mocks import MockCloudifyContext
 
@@ -91,23 +97,48 @@ class TestCommon(LibVirtCommonTest):
                 'a': 'b', 'c': 'd', 'e': 'g', 'z': 'y'}})
 
     def test_save_node_state(self):
-        isdir = mock.Mock(return_value=False)
-        with mock.patch(
-            "os.path.isdir",
-            isdir
-        ):
-            makedirs = mock.Mock()
-            with mock.patch(
-                "os.makedirs",
-                makedirs
-            ):
-                fake_file = mock.mock_open()
-                with mock.patch(builtins_open, fake_file):
-                    common.save_node_state("a", "b", "c")
-                fake_file.assert_called_with('a/b.xml', 'w')
-                fake_file().write.assert_called_with("c")
-            makedirs.assert_called_with("a")
-            isdir.assert_called_with("a")
+        backup_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, backup_dir)
+
+        # same content is saved once
+        common.save_node_state(backup_dir + "/a", "b", "<c/>")
+        common.save_node_state(backup_dir + "/d", "b", "<c/>")
+        common.save_node_state(backup_dir + "/d", "e", "<f/>")
+        self.assertEqual(len(os.listdir(backup_dir + "/.objects")), 2)
+        self.assertEqual(os.stat(backup_dir + "/a/b.xml").st_nlink, 3)
+        self.assertEqual(sorted(os.listdir(backup_dir + "/d")),
+                         ["b.xml", "e.xml"])
+        self.assertEqual(common.read_node_state(backup_dir + "/d", "b"),
+                         "<c/>")
+
+        # replace content
+        common.save_node_state(backup_dir + "/d", "e", "<g/>")
+        self.assertEqual(common.read_node_state(backup_dir + "/d", "e"),
+                         "<g/>")
+
+        # without hard links support
+        with mock.patch("os.link", mock.Mock(side_effect=OSError("link"))):
+            common.save_node_state(backup_dir + "/h", "b", "<c/>")
+        self.assertEqual(os.stat(backup_dir + "/h/b.xml").st_nlink, 1)
+        self.assertEqual(common.read_node_state(backup_dir + "/h", "b"),
+                         "<c/>")
+
+    def test_write_atomic(self):
+        backup_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, backup_dir)
+
+        common._write_atomic(backup_dir + "/a.xml", "<a/>")
+        common._write_atomic(backup_dir + "/b.gz", b"\x1f\x8b")
+        self.assertEqual(sorted(os.listdir(backup_dir)), ["a.xml", "b.gz"])
+        with open(backup_dir + "/b.gz", 'rb') as file:
+            self.assertEqual(file.read(), b"\x1f\x8b")
+
+        # temporary file is removed on error, old content is kept
+        with mock.patch("os.rename", mock.Mock(side_effect=OSError("mv"))):
+            with self.assertRaises(OSError):
+                common._write_atomic(backup_dir + "/a.xml", "<b/>")
+        self.assertEqual(sorted(os.listdir(backup_dir)), ["a.xml", "b.gz"])
+        self.assertEqual(common.read_node_state(backup_dir, "a"), "<a/>")
 
     def test_create_binary_place(self):
         isdir = mock.Mock(return_value=False)
@@ -149,6 +180,23 @@ class TestCommon(LibVirtCommonTest):
         isfile.assert_called_with('a/b.xml')
 
     def test_delete_node_state(self):
+        backup_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, backup_dir)
+
+        # no such file
+        common.delete_node_state(backup_dir + "/a", "b")
+
+        # content is removed with last backup
+        common.save_node_state(backup_dir + "/a", "b", "<c/>")
+        common.save_node_state(backup_dir + "/d", "b", "<c/>")
+        common.delete_node_state(backup_dir + "/a", "b")
+        self.assertEqual(os.listdir(backup_dir + "/a"), [])
+        self.assertEqual(len(os.listdir(backup_dir + "/.objects")), 1)
+        common.delete_node_state(backup_dir + "/d", "b")
+        self.assertEqual(os.listdir(backup_dir + "/d"), [])
+        self.assertEqual(os.listdir(backup_dir + "/.objects"), [])
+
+    def test_delete_binary_place(self):
         # no such file
         isfile = mock.Mock(return_value=False)
         with mock.patch(
@@ -160,9 +208,9 @@ class TestCommon(LibVirtCommonTest):
                 "os.remove",
                 remove
             ):
-                common.delete_node_state("a", "b")
+                common.delete_binary_place("a", "b")
             remove.assert_not_called()
-        isfile.assert_called_with('a/b.xml')
+        isfile.assert_called_with('a/b_raw')
 
         # remove file
         isfile = mock.Mock(return_value=True)
@@ -175,40 +223,263 @@ class TestCommon(LibVirtCommonTest):
                 "os.remove",
                 remove
             ):
-                common.delete_node_state("a", "b")
-            remove.assert_called_with('a/b.xml')
-        isfile.assert_called_with('a/b.xml')
+                common.delete_binary_place("a", "b")
+            remove.assert_called_with('a/b_raw')
+        isfile.assert_called_with('a/b_raw')
 
-    def test_delete_binary_place(self):
-        # no such file
-        isfile = mock.Mock(return_value=False)
+    def test_connection_pool(self):
+        self._create_ctx()
+        pool = common.ConnectionPool(idle_timeout=60)
+
+        connect = self._create_fake_connection()
+        connect.isAlive = mock.Mock(return_value=1)
+        libvirt_open = mock.Mock(return_value=connect)
         with mock.patch(
-            "os.path.isfile",
-            isfile
+            "cloudify_libvirt.common.libvirt.open", libvirt_open
         ):
-            remove = mock.Mock()
             with mock.patch(
-                "os.remove",
-                remove
+                "cloudify_libvirt.common.start_event_loop",
+                mock.Mock(return_value=True)
             ):
-                common.delete_binary_place("a", "b")
-            remove.assert_not_called()
-        isfile.assert_called_with('a/b_raw')
+                # new connection with keepalive
+                self.assertEqual(pool.acquire("qemu:///system"), connect)
+                connect.setKeepAlive.assert_called_with(
+                    common.KEEPALIVE_INTERVAL, common.KEEPALIVE_COUNT)
+                pool.release(connect)
+                connect.close.assert_not_called()
 
-        # remove file
-        isfile = mock.Mock(return_value=True)
+                # reuse alive connection
+                self.assertEqual(pool.acquire("qemu:///system"), connect)
+                libvirt_open.assert_called_once_with("qemu:///system")
+                pool.release(connect)
+
+                # broken connection, reconnect
+                connect.isAlive = mock.Mock(return_value=0)
+                new_connect = self._create_fake_connection()
+                libvirt_open.return_value = new_connect
+                self.assertEqual(pool.acquire("qemu:///system"), new_connect)
+                connect.close.assert_called_with()
+
+                # failed to connect
+                libvirt_open.return_value = None
+                self.assertIsNone(pool.acquire("qemu+ssh://host/system"))
+
+        # idle connection removed
+        connect = self._create_fake_connection()
+        connect.isAlive = mock.Mock(return_value=1)
+        pool._used[connect] = pool._key("qemu:///system")
+        pool.release(connect)
+        self.assertEqual(pool._pop_expired(common.time.time() + 120),
+                         [connect])
+        self.assertEqual(pool._idle, {})
+
+        # clear all
+        connect = self._create_fake_connection()
+        connect.isAlive = mock.Mock(return_value=1)
+        pool._used[connect] = pool._key("qemu:///system")
+        pool.release(connect)
+        pool.clear()
+        connect.close.assert_called_with()
+
+    def test_get_connection(self):
+        self._create_ctx()
+        connect = self._create_fake_connection()
         with mock.patch(
-            "os.path.isfile",
-            isfile
+            "cloudify_libvirt.common.connection_pool.acquire",
+            mock.Mock(return_value=connect)
         ):
-            remove = mock.Mock()
+            self.assertEqual(common.get_connection("uri"), connect)
+        self._check_correct_connect(
+            "cloudify_libvirt.common.libvirt.open",
+            common.get_connection, ["uri"], {})
+
+    def test_wait_for(self):
+        # ready on first check
+        sleep = mock.Mock()
+        with mock.patch("cloudify_libvirt.common.time.sleep", sleep):
+            self.assertTrue(common.wait_for(lambda: True, 10))
+        sleep.assert_not_called()
+
+        # exponential backoff until timeout
+        sleep = mock.Mock()
+        with mock.patch("cloudify_libvirt.common.time.sleep", sleep):
+            self.assertFalse(common.wait_for(lambda: False, 10))
+        self.assertEqual(
+            [call[0][0] for call in sleep.call_args_list], [1, 2, 4, 3])
+
+        # ready after several checks
+        results = [True, False, False]
+        sleep = mock.Mock()
+        with mock.patch("cloudify_libvirt.common.time.sleep", sleep):
+            self.assertTrue(common.wait_for(results.pop, 10))
+        self.assertEqual(sleep.call_count, 2)
+
+        # wait for event instead of sleep
+        event = mock.Mock()
+        results = [True, False]
+        sleep = mock.Mock()
+        with mock.patch("cloudify_libvirt.common.time.sleep", sleep):
+            self.assertTrue(common.wait_for(results.pop, 10, event))
+        sleep.assert_not_called()
+        event.wait.assert_called_once()
+        self.assertEqual(event.clear.call_count, 2)
+
+    def test_backup_store(self):
+        backup_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, backup_dir)
+        _ctx = self._create_ctx()
+        _ctx.node.properties['backup_dir'] = backup_dir
+        _ctx.instance.runtime_properties['backups'] = {
+            "node_name-old": "<old/>"}
+
+        # unknown store
+        _ctx.node.properties['backup_store'] = "cloud"
+        with self.assertRaisesRegexp(
+            NonRecoverableError,
+            "Unknown backup store: cloud."
+        ):
+            common.get_backup_store()
+
+        # move old backups to local store on first use
+        _ctx.node.properties['backup_store'] = ""
+        common.xml_snapshot_create({"snapshot_name": "new",
+                                    "snapshot_incremental": True},
+                                   "resource", "<new/>")
+        backups = _ctx.instance.runtime_properties['backups']
+        self.assertEqual(backups["node_name-old"], {
+            "store": "local",
+            "path": backup_dir + "/incremental/node_name-old.xml.gz"})
+        self.assertEqual(sorted(os.listdir(backup_dir + "/incremental")),
+                         ["node_name-new.xml.gz", "node_name-old.xml.gz"])
+        self.assertEqual(self._read_backups(_ctx), {
+            "node_name-old": "<old/>", "node_name-new": "<new/>"})
+
+        # relative backup_dir is saved as absolute path
+        cwd = os.getcwd()
+        self.addCleanup(os.chdir, cwd)
+        os.chdir(backup_dir)
+        _ctx.node.properties['backup_dir'] = "relative"
+        common.xml_snapshot_create({"snapshot_name": "relative",
+                                    "snapshot_incremental": True},
+                                   "resource", "<relative/>")
+        os.chdir(cwd)
+        self.assertEqual(backups["node_name-relative"]["path"],
+                         os.path.realpath(backup_dir) +
+                         "/relative/incremental/node_name-relative.xml.gz")
+        self.assertEqual(
+            os.listdir(backup_dir + "/relative/incremental"),
+            ["node_name-relative.xml.gz"])
+        _ctx.node.properties['backup_dir'] = backup_dir
+
+        # backups from both stores are readable
+        _ctx.node.properties['backup_store'] = "runtime"
+        common.xml_snapshot_create({"snapshot_name": "runtime",
+                                    "snapshot_incremental": True},
+                                   "resource", "<runtime/>")
+        self.assertEqual(
+            backups["node_name-runtime"]["store"], "runtime")
+        common.xml_snapshot_apply({"snapshot_name": "old",
+                                   "snapshot_incremental": True},
+                                  "resource", "<old/>")
+        common.xml_snapshot_apply({"snapshot_name": "runtime",
+                                   "snapshot_incremental": True},
+                                  "resource", "<runtime/>")
+
+        # delete single backup and all backups
+        common.xml_snapshot_delete({"snapshot_name": "new",
+                                    "snapshot_incremental": True},
+                                   "resource")
+        self.assertEqual(os.listdir(backup_dir + "/incremental"),
+                         ["node_name-old.xml.gz"])
+        common.delete_backups()
+        self.assertEqual(os.listdir(backup_dir + "/incremental"), [])
+        self.assertEqual(_ctx.instance.runtime_properties['backups'], {})
+
+    def test_gen_xml_template(self):
+        _ctx = self._create_ctx()
+        common._templates.clear()
+        read_template = mock.Mock(wraps=common._read_template)
+        with mock.patch(
+            "cloudify_libvirt.common._read_template", read_template
+        ):
+            # internal template is read and compiled only once
+            for _ in range(3):
+                self.assertIn(
+                    "<name>volume</name>",
+                    common.gen_xml_template(
+                        {}, {'name': 'volume'}, 'volume'))
+            self.assertEqual(read_template.call_count, 1)
+
+            # template is changed on disk
             with mock.patch(
-                "os.remove",
-                remove
+                "cloudify_libvirt.common.os.path.getmtime",
+                mock.Mock(return_value=1)
             ):
-                common.delete_binary_place("a", "b")
-            remove.assert_called_with('a/b_raw')
-        isfile.assert_called_with('a/b_raw')
+                common.gen_xml_template({}, {'name': 'volume'}, 'volume')
+            self.assertEqual(read_template.call_count, 2)
+
+        # template from content, compiled once by content hash
+        with mock.patch.object(
+            common._templates_env, "from_string",
+            mock.Mock(wraps=common._templates_env.from_string)
+        ) as from_string:
+            for name in ["a", "b"]:
+                self.assertEqual(
+                    common.gen_xml_template(
+                        {'template_content': "<a>{{ name }}</a>"},
+                        {'name': name}, 'volume'),
+                    "<a>{}</a>".format(name))
+            _ctx.get_resource = mock.Mock(return_value=b"<a>{{ name }}</a>")
+            self.assertEqual(
+                common.gen_xml_template(
+                    {'template_resource': "a.xml"}, {'name': "c"}, 'volume'),
+                "<a>c</a>")
+            self.assertEqual(from_string.call_count, 1)
+
+            # cache size is limited
+            with mock.patch(
+                "cloudify_libvirt.common.TEMPLATES_CACHE_SIZE", 2
+            ):
+                common.gen_xml_template(
+                    {'template_content': "<b/>"}, {}, 'volume')
+                self.assertEqual(len(common._templates), 2)
+                common.gen_xml_template(
+                    {'template_content': "<b/>"}, {}, 'volume')
+                self.assertEqual(from_string.call_count, 2)
+
+    def test_toxml(self):
+        self._create_ctx()
+        value = {'disk': {'@type': 'file', 'target': {'@dev': 'vdb'}},
+                 'interface': {'@type': 'network'}}
+        expected = ('<disk type="file"><target dev="vdb"></target></disk>'
+                    '<interface type="network"></interface>')
+        self.assertEqual(common._toxml(value), expected)
+        # filter is available in templates
+        self.assertEqual(
+            common.gen_xml_template(
+                {'template_content': "{{ extra|toxml }}"},
+                {'extra': value}, 'volume'),
+            expected)
+
+    @unittest.skipIf(sys.version_info < (3, 7),
+                     "-X importtime is supported from python 3.7")
+    def test_import_time(self):
+        # heavy modules must be imported only on first use
+        for module in ['common', 'domain_tasks', 'iso9660_tasks',
+                       'network_tasks', 'pool_tasks', 'volume_tasks']:
+            output = subprocess.check_output(
+                [sys.executable, "-X", "importtime", "-c",
+                 "import cloudify_libvirt.{}".format(module)],
+                stderr=subprocess.STDOUT).decode()
+            # import time: self [us] | cumulative | imported package
+            imported = set(
+                line.split("|")[-1].strip() for line in output.splitlines()
+                if line.startswith("import time:")
+            )
+            self.assertIn("cloudify_libvirt.{}".format(module), imported)
+            for heavy in ['jinja2', 'pkg_resources']:
+                self.assertNotIn(heavy, imported,
+                                 "{} imports {}".format(module, heavy))
 
 
 if __name__ == '__main__':
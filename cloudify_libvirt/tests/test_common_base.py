@@ -19,13 +19,42 @@ from cloudify.exceptions import NonRecoverableError
 from cloudify.state import current_ctx
 from cloudify.mocks import MockCloudifyContext
 
+import cloudify_libvirt.common as common
+
 
 class LibVirtCommonTest(unittest.TestCase):
 
     def tearDown(self):
         current_ctx.clear()
+        common.connection_pool.clear()
         super(LibVirtCommonTest, self).tearDown()
 
+    def _create_backup_saved(self, fake_file, func, kwargs):
+        # call backup create with mocked atomic write of xml state
+        with mock.patch(
+            "os.path.isfile",
+            mock.Mock(return_value=False)
+        ), mock.patch(
+            "os.fsync", mock.Mock()
+        ), mock.patch(
+            "os.link", mock.Mock()
+        ), mock.patch(
+            "tempfile.mkstemp", mock.Mock(return_value=(7, "./blob.xml.tmp"))
+        ), mock.patch(
+            "os.fdopen", fake_file
+        ), mock.patch(
+            "os.rename", mock.Mock()
+        ) as rename:
+            func(**kwargs)
+        return rename
+
+    def _check_backup_saved(self, fake_file, rename, path, content):
+        # check that state is written and linked by unique temporary name
+        fake_file().write.assert_called_with(content)
+        tmp_path, saved_path = rename.call_args[0]
+        self.assertTrue(tmp_path.startswith(path + "."))
+        self.assertEqual(saved_path, path)
+
     def _check_correct_connect(self, libvirt_open, func, args, kwargs):
         # check that we correctly raise exception without connection
 
@@ -167,8 +196,21 @@ class LibVirtCommonTest(unittest.TestCase):
         connect.storagePoolDefineXML = mock.Mock(return_value=None)
         connect.close = mock.Mock(return_value=None)
         connect.newStream = mock.Mock(return_value=mock.Mock())
+        # use polling instead of events
+        connect.domainEventRegisterAny = mock.Mock(
+            side_effect=libvirt.libvirtError("domainEventRegisterAny"))
         return connect
 
+    def _read_backups(self, _ctx):
+        # content of incremental backups
+        backups = _ctx.instance.runtime_properties["backups"]
+        return {
+            snapshot_name: common.get_backup_store(
+                backups[snapshot_name]["store"]
+            ).read(backups[snapshot_name])
+            for snapshot_name in backups
+        }
+
     def _create_ctx(self):
         _ctx = MockCloudifyContext(
             'node_name',
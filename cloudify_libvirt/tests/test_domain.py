@@ -11,7 +11,10 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import os
 import mock
+import shutil
+import tempfile
 import unittest
 import libvirt
 
@@ -168,6 +171,150 @@ class TestDomainTasks(LibVirtCommonTest):
             _ctx.instance.runtime_properties['params']['memory_size'],
             1024)
 
+    def test_update_template_params_iothreads(self):
+        disks = [
+            {'dev': 'vda', 'bus': 'virtio'},
+            {'dev': 'sda', 'bus': 'scsi'},
+            {'dev': 'vdb', 'bus': 'virtio', 'iothread': 2},
+            {'dev': 'vdc', 'bus': 'virtio'},
+            {'dev': 'vdd', 'bus': 'virtio'},
+        ]
+        params = {'iothreads': 2, 'disks': disks}
+        domain_tasks._update_template_params(params)
+        self.assertEqual(
+            [disk.get('iothread') for disk in params['disks']],
+            [1, None, 2, 1, 2])
+        # original list is not changed
+        self.assertNotIn('iothread', disks[0])
+
+        # without iothreads
+        params = {'disks': [{'dev': 'vda', 'bus': 'virtio'}]}
+        domain_tasks._update_template_params(params)
+        self.assertNotIn('iothread', params['disks'][0])
+
+    def test_parse_cpuset(self):
+        self.assertEqual(domain_tasks._parse_cpuset("0-3,^2,6"),
+                         set([0, 1, 3, 6]))
+        self.assertEqual(domain_tasks._parse_cpuset(""), set())
+
+    def test_cpu_placement(self):
+        self._create_ctx()
+        # two cells with 2 cores and 2 threads on each
+        caps = (
+            "<capabilities><host><topology><cells num='2'>"
+            "<cell id='0'><cpus num='4'>"
+            "<cpu id='0' socket_id='0' core_id='0' siblings='0,4'/>"
+            "<cpu id='1' socket_id='0' core_id='1' siblings='1,5'/>"
+            "<cpu id='4' socket_id='0' core_id='0' siblings='0,4'/>"
+            "<cpu id='5' socket_id='0' core_id='1' siblings='1,5'/>"
+            "</cpus></cell>"
+            "<cell id='2'><cpus num='4'>"
+            "<cpu id='2' socket_id='1' core_id='0' siblings='2,6'/>"
+            "<cpu id='3' socket_id='1' core_id='1' siblings='3,7'/>"
+            "<cpu id='6' socket_id='1' core_id='0' siblings='2,6'/>"
+            "<cpu id='7' socket_id='1' core_id='1' siblings='3,7'/>"
+            "</cpus></cell>"
+            "</cells></topology></host></capabilities>")
+        other = mock.Mock()
+        other.XMLDesc = mock.Mock(return_value=(
+            "<domain><cputune><vcpupin vcpu='0' cpuset='2'/>"
+            "<emulatorpin cpuset='2-3'/></cputune></domain>"))
+        unpinned = mock.Mock()
+        unpinned.XMLDesc = mock.Mock(return_value="<domain/>")
+        connect = self._create_fake_connection()
+        connect.getCapabilities = mock.Mock(return_value=caps)
+        connect.listAllDomains = mock.Mock(return_value=[other, unpinned])
+        # cell ids are not sequential
+        free_memory = {0: 1024 * 1024, 2: 4096 * 1024}
+        connect.getCellsFreeMemory = mock.Mock(
+            side_effect=lambda start, count: [free_memory[start]])
+
+        # more free memory on second cell, core with used thread is last
+        params = {'vcpu': 2, 'memory_maxsize': 1024}
+        domain_tasks._cpu_placement(connect, params)
+        self.assertEqual(params['numa_node'], 2)
+        self.assertEqual(params['vcpu_pins'], [3, 7])
+        self.assertEqual(params['emulator_pin'], "3,7")
+        connect.getCellsFreeMemory.assert_called_with(2, 1)
+
+        # no free cpus on second cell
+        params = {'vcpu': 4, 'memory_maxsize': 1024}
+        domain_tasks._cpu_placement(connect, params)
+        self.assertEqual(params['numa_node'], 0)
+        self.assertEqual(params['vcpu_pins'], [0, 4, 1, 5])
+
+        # no place
+        with self.assertRaisesRegexp(
+            NonRecoverableError,
+            "No NUMA cell with 4 free cpus and 2048 KiB free memory."
+        ):
+            domain_tasks._cpu_placement(
+                connect, {'vcpu': 4, 'memory_maxsize': 2048})
+
+        # memory is in hugepages pool, selected by free hugepages
+        connect.getCellsFreeMemory = mock.Mock(return_value=[0])
+        connect.getFreePages = mock.Mock(
+            side_effect=lambda sizes, start, count: {
+                start: {2048: {0: 1024, 2: 512}[start]}})
+        params = {'vcpu': 2, 'memory_maxsize': 1048576, 'hugepages': True}
+        domain_tasks._cpu_placement(connect, params)
+        self.assertEqual(params['numa_node'], 0)
+        connect.getCellsFreeMemory.assert_not_called()
+
+    def test_check_hugepages(self):
+        self._create_ctx()
+        connect = self._create_fake_connection()
+        connect.getCapabilities = mock.Mock(return_value=(
+            "<capabilities><host><topology><cells num='2'>"
+            "<cell id='0'/><cell id='2'/>"
+            "</cells></topology></host></capabilities>"))
+        connect.getFreePages = mock.Mock(
+            side_effect=lambda sizes, start, count: {start: {2048: 256}})
+
+        # all cells, ids are not sequential
+        domain_tasks._check_hugepages(connect, {'hugepages': True,
+                                                'memory_maxsize': 1048576})
+        self.assertEqual(connect.getFreePages.call_args_list, [
+            mock.call([2048], 0, 1), mock.call([2048], 2, 1)])
+
+        # selected cell
+        connect.getFreePages = mock.Mock(return_value={1: {2048: 256}})
+        with self.assertRaisesRegexp(
+            NonRecoverableError,
+            "Not enough free hugepages of 2048 KiB: 256 free, 512 required."
+        ):
+            domain_tasks._check_hugepages(connect, {
+                'hugepages': True, 'memory_maxsize': 1048576,
+                'numa_node': 1})
+        connect.getFreePages.assert_called_with([2048], 1, 1)
+
+        # other page size
+        connect.getFreePages = mock.Mock(return_value={1: {1048576: 1}})
+        domain_tasks._check_hugepages(connect, {
+            'hugepages': True, 'memory_maxsize': 1048576, 'numa_node': 1,
+            'hugepages_size': 1048576})
+
+        # only one guest numa node
+        with self.assertRaisesRegexp(
+            NonRecoverableError,
+            "Domain has only guest NUMA node 0, hugepages_nodeset 0-1 is "
+            "unsupported."
+        ):
+            domain_tasks._check_hugepages(connect, {
+                'hugepages': True, 'memory_maxsize': 1048576,
+                'hugepages_nodeset': "0-1"})
+        domain_tasks._check_hugepages(connect, {
+            'hugepages': True, 'memory_maxsize': 1048576, 'numa_node': 1,
+            'hugepages_size': 1048576, 'hugepages_nodeset': 0})
+
+        # guest numa node is defined for nodeset
+        xmlconfig = domain_tasks.common.gen_xml_template({}, {
+            'name': 'domain', 'vcpu': 2, 'memory_maxsize': 1048576,
+            'hugepages': True, 'hugepages_nodeset': "0"}, 'domain')
+        self.assertIn('<page size="2048" unit="KiB" nodeset="0"/>', xmlconfig)
+        self.assertIn('<cell id="0" cpus="0-1" memory="1048576" unit="KiB"/>',
+                      xmlconfig)
+
     def test_update(self):
         self._test_no_resource_id(domain_tasks.update,
                                   "No servers for update")
@@ -194,6 +341,230 @@ class TestDomainTasks(LibVirtCommonTest):
             'Can not change cpu count.',
             params_update={'vcpu': 1024})
 
+    def test_update_live(self):
+        _ctx = self._create_ctx()
+        _ctx.instance.runtime_properties['resource_id'] = 'check'
+        _ctx.instance.runtime_properties['params'].update({
+            'vcpu': 4, 'memory_size': 4096, 'memory_maxsize': 6144,
+            'memory_hotplug_maxsize': 16384})
+        domain = mock.Mock()
+        # limit is from defined domain, not from params
+        domain.XMLDesc = mock.Mock(return_value=(
+            "<domain><maxMemory slots='16' unit='KiB'>8192</maxMemory>"
+            "<cpu><numa><cell id='0' cpus='0-7' memory='2048'/></numa></cpu>"
+            "</domain>"))
+        domain.state = mock.Mock(
+            return_value=(libvirt.VIR_DOMAIN_RUNNING, ""))
+        domain.maxVcpus = mock.Mock(return_value=8)
+        domain.maxMemory = mock.Mock(return_value=2048)
+        domain.setMemory = mock.Mock(return_value=0)
+        domain.setVcpusFlags = mock.Mock(return_value=0)
+        domain.attachDeviceFlags = mock.Mock(return_value=0)
+        connect = self._create_fake_connection()
+        connect.lookupByName = mock.Mock(return_value=domain)
+        with mock.patch(
+            "cloudify_libvirt.domain_tasks.libvirt.open",
+            mock.Mock(return_value=connect)
+        ):
+            domain_tasks.update(ctx=_ctx)
+        flags = (libvirt.VIR_DOMAIN_AFFECT_LIVE |
+                 libvirt.VIR_DOMAIN_AFFECT_CONFIG)
+        domain.setVcpusFlags.assert_called_with(4, flags)
+        domain.attachDeviceFlags.assert_called_with(
+            "<memory model='dimm'><target><size unit='KiB'>4096</size>"
+            "<node>0</node></target></memory>", flags)
+        domain.setMemory.assert_called_with(4096)
+        domain.setMaxMemory.assert_not_called()
+
+        # memory is enough
+        domain.maxMemory = mock.Mock(return_value=6144)
+        domain.attachDeviceFlags = mock.Mock(return_value=0)
+        with mock.patch(
+            "cloudify_libvirt.domain_tasks.libvirt.open",
+            mock.Mock(return_value=connect)
+        ):
+            domain_tasks.update(ctx=_ctx)
+        domain.attachDeviceFlags.assert_not_called()
+
+        # more than maximum
+        _ctx.instance.runtime_properties['params']['memory_maxsize'] = 16384
+        with mock.patch(
+            "cloudify_libvirt.domain_tasks.libvirt.open",
+            mock.Mock(return_value=connect)
+        ):
+            with self.assertRaisesRegexp(
+                NonRecoverableError,
+                "Can not change memory amount to 16384 on running vm, "
+                "maximum is 8192."
+            ):
+                domain_tasks.update(ctx=_ctx)
+
+        # defined without hotplug support
+        domain.XMLDesc = mock.Mock(return_value="<domain/>")
+        with mock.patch(
+            "cloudify_libvirt.domain_tasks.libvirt.open",
+            mock.Mock(return_value=connect)
+        ):
+            with self.assertRaisesRegexp(
+                NonRecoverableError,
+                "Domain is defined without maxMemory and guest NUMA node, "
+                "memory hotplug is unavailable."
+            ):
+                domain_tasks.update(ctx=_ctx)
+        domain.attachDeviceFlags.assert_not_called()
+        _ctx.instance.runtime_properties['params']['memory_maxsize'] = 6144
+        _ctx.instance.runtime_properties['params']['vcpu'] = 16
+        with mock.patch(
+            "cloudify_libvirt.domain_tasks.libvirt.open",
+            mock.Mock(return_value=connect)
+        ):
+            with self.assertRaisesRegexp(
+                NonRecoverableError,
+                "Can not change cpu count to 16 on running vm, maximum is 8."
+            ):
+                domain_tasks.update(ctx=_ctx)
+
+    def test_device_fragments(self):
+        self.assertEqual(domain_tasks._device_fragments(
+            '<?xml version="1.0"?>\n<disk type="file"><target dev="vdb"/>'
+            '</disk>'), ['<disk type="file"><target dev="vdb" /></disk>'])
+        self.assertEqual(domain_tasks._device_fragments(
+            '<devices>\n  <disk/>\n  <interface/>\n</devices>'),
+            ['<disk />', '<interface />'])
+        self.assertEqual(domain_tasks._device_fragments(
+            '<disk/><interface/>'), ['<disk />', '<interface />'])
+
+    def test_attach_device_flags(self):
+        _ctx = self._create_ctx()
+        _ctx.instance.runtime_properties['resource_id'] = 'check'
+        _ctx.get_resource = mock.Mock(return_value=(
+            "<disk><target dev='vdb'/></disk>"
+            "<interface><mac address='52:54:00:00:00:01'/></interface>"))
+        disk = '<disk><target dev="vdb" /></disk>'
+        interface = ('<interface><mac address="52:54:00:00:00:01" />'
+                     '</interface>')
+        domain = mock.Mock()
+        domain.attachDeviceFlags = mock.Mock(return_value=0)
+        domain.detachDeviceFlags = mock.Mock(return_value=0)
+        domain.XMLDesc = mock.Mock(return_value=(
+            "<domain><devices>"
+            "<disk><target dev='vda'/><alias name='virtio-disk0'/></disk>"
+            "<disk><target dev='vdb'/><alias name='virtio-disk1'/></disk>"
+            "<interface><mac address='52:54:00:00:00:01'/>"
+            "<alias name='net1'/></interface>"
+            "</devices></domain>"))
+        connect = self._create_fake_connection()
+        connect.lookupByName = mock.Mock(return_value=domain)
+
+        # stopped domain, config only
+        domain.state = mock.Mock(
+            return_value=(libvirt.VIR_DOMAIN_SHUTOFF, ""))
+        with mock.patch(
+            "cloudify_libvirt.domain_tasks.libvirt.open",
+            mock.Mock(return_value=connect)
+        ):
+            domain_tasks.attach_device_flags(
+                ctx=_ctx, template_resource="template_resource")
+        domain.attachDeviceFlags.assert_has_calls([
+            mock.call(disk, libvirt.VIR_DOMAIN_AFFECT_CONFIG),
+            mock.call(interface, libvirt.VIR_DOMAIN_AFFECT_CONFIG)])
+        connect.domainEventRegisterAny.assert_not_called()
+
+        # running domain, wait for events of changed devices
+        flags = (libvirt.VIR_DOMAIN_AFFECT_CONFIG |
+                 libvirt.VIR_DOMAIN_AFFECT_LIVE)
+        domain.state = mock.Mock(
+            return_value=(libvirt.VIR_DOMAIN_RUNNING, ""))
+        device_aliases = {disk: 'virtio-disk1', interface: 'net1'}
+
+        def _register(dom, event_id, callback, opaque):
+            # guest has released devices, other device is also removed
+            callback(connect, dom, 'virtio-disk0', opaque)
+            domain.detachDeviceFlags.side_effect = (
+                lambda xml, flags: callback(
+                    connect, dom, device_aliases[xml], opaque) or 0)
+            return 7
+
+        connect.domainEventRegisterAny = mock.Mock(side_effect=_register)
+        with mock.patch(
+            "cloudify_libvirt.common.start_event_loop",
+            mock.Mock(return_value=True)
+        ):
+            with mock.patch(
+                "cloudify_libvirt.domain_tasks.libvirt.open",
+                mock.Mock(return_value=connect)
+            ):
+                domain_tasks.detach_device_flags(
+                    ctx=_ctx, template_resource="template_resource")
+        domain.detachDeviceFlags.assert_has_calls([
+            mock.call(disk, flags), mock.call(interface, flags)])
+        connect.domainEventRegisterAny.assert_called_with(
+            domain, libvirt.VIR_DOMAIN_EVENT_ID_DEVICE_REMOVED, mock.ANY,
+            None)
+        connect.domainEventDeregisterAny.assert_called_with(7)
+        domain.detachDeviceFlags.side_effect = None
+
+        # only events for other devices
+        def _register_other(dom, event_id, callback, opaque):
+            callback(connect, dom, 'virtio-disk0', opaque)
+            callback(connect, dom, 'net0', opaque)
+            return 8
+
+        connect.domainEventRegisterAny = mock.Mock(
+            side_effect=_register_other)
+        with mock.patch(
+            "cloudify_libvirt.common.start_event_loop",
+            mock.Mock(return_value=True)
+        ):
+            with mock.patch(
+                "cloudify_libvirt.domain_tasks.libvirt.open",
+                mock.Mock(return_value=connect)
+            ):
+                with mock.patch(
+                    "cloudify_libvirt.common.wait_for",
+                    mock.Mock(side_effect=lambda check, timeout, event:
+                              check())
+                ):
+                    with self.assertRaisesRegexp(
+                        NonRecoverableError,
+                        "Devices change is not confirmed"
+                    ):
+                        domain_tasks.attach_device_flags(
+                            ctx=_ctx, template_resource="template_resource")
+        connect.domainEventDeregisterAny.assert_called_with(8)
+
+        # failed attach, first device is detached back
+        connect.domainEventRegisterAny = mock.Mock(return_value=9)
+        domain.attachDeviceFlags = mock.Mock(side_effect=[
+            0, libvirt.libvirtError("busy")])
+        domain.detachDeviceFlags = mock.Mock(return_value=0)
+        with mock.patch(
+            "cloudify_libvirt.domain_tasks.libvirt.open",
+            mock.Mock(return_value=connect)
+        ):
+            with self.assertRaisesRegexp(
+                NonRecoverableError,
+                "Can not update device: <interface>"
+            ):
+                domain_tasks.attach_device_flags(
+                    ctx=_ctx, template_resource="template_resource")
+        domain.detachDeviceFlags.assert_called_once_with(disk, flags)
+
+        # failed change, changed devices can't be reverted
+        domain.updateDeviceFlags = mock.Mock(side_effect=[0, -1])
+        with mock.patch(
+            "cloudify_libvirt.domain_tasks.libvirt.open",
+            mock.Mock(return_value=connect)
+        ):
+            with self.assertRaisesRegexp(
+                NonRecoverableError,
+                "Can not update device: <interface>.*, devices "
+                "\\['<disk>.*'\\] are still changed, operation is not "
+                "idempotent."
+            ):
+                domain_tasks.update_domain_flags(
+                    ctx=_ctx, template_resource="template_resource")
+
     def test_reboot(self):
         self._test_no_resource_id(domain_tasks.reboot,
                                   "No servers for reboot")
@@ -232,6 +603,77 @@ class TestDomainTasks(LibVirtCommonTest):
             [libvirt.VIR_DOMAIN_RUNNING_UNKNOWN, libvirt.VIR_DOMAIN_RUNNING],
             'Can not shutdown guest domain.')
 
+    def test_wait_for_state(self):
+        self._create_ctx()
+        domain = mock.Mock()
+        states = [libvirt.VIR_DOMAIN_RUNNING, libvirt.VIR_DOMAIN_SHUTOFF]
+        domain.state = mock.Mock(side_effect=lambda: (states.pop(), ""))
+
+        # lifecycle events
+        connect = self._create_fake_connection()
+        connect.domainEventRegisterAny = mock.Mock(return_value=7)
+        with mock.patch(
+            "cloudify_libvirt.common.start_event_loop",
+            mock.Mock(return_value=True)
+        ):
+            with mock.patch(
+                "cloudify_libvirt.domain_tasks.threading.Event"
+            ) as fake_event:
+                self.assertTrue(domain_tasks._wait_for_state(
+                    connect, domain,
+                    lambda state: state == libvirt.VIR_DOMAIN_RUNNING, 10))
+        connect.domainEventRegisterAny.assert_called_with(
+            domain, libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE, mock.ANY, None)
+        connect.domainEventDeregisterAny.assert_called_with(7)
+        fake_event().wait.assert_called_once()
+
+        # no events, polling
+        states = [libvirt.VIR_DOMAIN_SHUTOFF] * 10
+        connect = self._create_fake_connection()
+        with mock.patch(
+            "cloudify_libvirt.common.start_event_loop",
+            mock.Mock(return_value=False)
+        ):
+            with mock.patch(
+                "time.sleep",
+                mock.Mock(return_value=None)
+            ):
+                self.assertFalse(domain_tasks._wait_for_state(
+                    connect, domain,
+                    lambda state: state == libvirt.VIR_DOMAIN_RUNNING, 3))
+        connect.domainEventRegisterAny.assert_not_called()
+
+    def test_request_state(self):
+        self._create_ctx()
+        domain = mock.Mock()
+        domain.shutdown = mock.Mock(return_value=0)
+        connect = self._create_fake_connection()
+        check = mock.Mock()
+
+        # guest has missed first request
+        with mock.patch(
+            "cloudify_libvirt.domain_tasks._wait_for_state",
+            mock.Mock(side_effect=[False, True])
+        ) as wait_for_state:
+            self.assertTrue(domain_tasks._request_state(
+                connect, domain, domain.shutdown, check, 300, "error"))
+        self.assertEqual(domain.shutdown.call_count, 2)
+        wait_for_state.assert_called_with(connect, domain, check, 30)
+
+        # timeout
+        domain.shutdown = mock.Mock(return_value=0)
+        with mock.patch(
+            "cloudify_libvirt.domain_tasks._wait_for_state",
+            mock.Mock(return_value=False)
+        ):
+            with mock.patch(
+                "cloudify_libvirt.domain_tasks.time.time",
+                mock.Mock(side_effect=[0, 0, 30, 60])
+            ):
+                self.assertFalse(domain_tasks._request_state(
+                    connect, domain, domain.shutdown, check, 60, "error"))
+        self.assertEqual(domain.shutdown.call_count, 2)
+
     def test_resume(self):
         self._test_no_resource_id(domain_tasks.resume,
                                   "No servers for resume")
@@ -300,7 +742,7 @@ class TestDomainTasks(LibVirtCommonTest):
             # removed snaphsots, can't stop
             list_snapshots_results = [[], [snapshot]]
 
-            def _snapshot_list():
+            def _snapshot_list(flags=0):
                 return list_snapshots_results.pop()
 
             domain.listAllSnapshots = _snapshot_list
@@ -345,12 +787,74 @@ class TestDomainTasks(LibVirtCommonTest):
             # use undefine
             domain.undefineFlags = mock.Mock(return_value=0)
             domain.undefine = mock.Mock(return_value=0)
+            _ctx.instance.runtime_properties['block_checkpoint'] = {
+                'name': 'backup', 'manifest': 'backup_blocks.json'}
 
-            domain_tasks.delete(ctx=_ctx,
-                                snapshot_name='snapshot_name',
-                                snapshot_incremental=True)
+            with mock.patch(
+                "cloudify_libvirt.domain_tasks.libvirt.VIR_DOMAIN_UNDEFINE_"
+                "CHECKPOINTS_METADATA", 64, create=True
+            ):
+                domain_tasks.delete(ctx=_ctx,
+                                    snapshot_name='snapshot_name',
+                                    snapshot_incremental=True)
+            domain.undefineFlags.assert_called_with(
+                libvirt.VIR_DOMAIN_UNDEFINE_NVRAM | 64)
             self.assertFalse(
                 _ctx.instance.runtime_properties.get('resource_id'))
+            self.assertFalse(
+                _ctx.instance.runtime_properties.get('block_checkpoint'))
+
+    def test_cleanup_snapshots(self):
+        _ctx = self._create_ctx()
+
+        # tree: root -> (child -> grandchild, second)
+        deleted = []
+
+        def _fake_delete(name, flags=0):
+            if flags:
+                raise libvirt.libvirtError("delete children")
+            deleted.append(name)
+            return 0
+
+        snapshots = {}
+        for name in ["grandchild", "root", "second", "child"]:
+            snapshot = mock.Mock()
+            snapshot.getName = mock.Mock(return_value=name)
+            snapshot.getParent = mock.Mock(
+                side_effect=libvirt.libvirtError("no parent"))
+            snapshot.delete = mock.Mock(
+                side_effect=lambda flags=0, name=name: _fake_delete(
+                    name, flags))
+            snapshots[name] = snapshot
+        for name, parent in [("grandchild", "child"), ("second", "root"),
+                             ("child", "root")]:
+            snapshots[name].getParent = mock.Mock(
+                return_value=snapshots[parent])
+
+        self.assertEqual(
+            [snapshot.getName() for snapshot in
+             domain_tasks._snapshots_leaves_first(
+                 list(snapshots.values()))],
+            ["grandchild", "second", "child", "root"])
+
+        # delete with children is unsupported, remove leaves first
+        domain = mock.Mock()
+        domain.listAllSnapshots = mock.Mock(
+            side_effect=lambda flags=0: (
+                [snapshots["root"]] if flags else list(snapshots.values())))
+        domain.snapshotNum = mock.Mock(return_value=0)
+        domain_tasks._cleanup_snapshots(_ctx, domain)
+        self.assertEqual(deleted, ["grandchild", "second", "child", "root"])
+        self.assertEqual(domain.listAllSnapshots.call_count, 2)
+
+        # remove tree by roots
+        root = mock.Mock()
+        domain.listAllSnapshots = mock.Mock(return_value=[root])
+        domain_tasks._cleanup_snapshots(_ctx, domain)
+        domain.listAllSnapshots.assert_called_once_with(
+            libvirt.VIR_DOMAIN_SNAPSHOT_LIST_ROOTS)
+        root.delete.assert_called_once_with(
+            libvirt.VIR_DOMAIN_SNAPSHOT_DELETE_CHILDREN)
 
     def test_perfomance(self):
         self._test_no_resource_id(domain_tasks.perfomance,
@@ -392,6 +896,63 @@ class TestDomainTasks(LibVirtCommonTest):
             {'cpu': 20.0, 'memory': 1.0}
         )
 
+        # bulk statistics
+        _ctx = self._create_ctx()
+        _ctx.instance.runtime_properties['resource_id'] = 'domain_name'
+        connect = self._create_fake_connection()
+        connect.lookupByName = mock.Mock(return_value=domain)
+        connect.domainListGetStats = mock.Mock(return_value=[(domain, {
+            'cpu.time': 2000000000,
+            'balloon.current': 2048,
+            'vcpu.current': 1,
+            'vcpu.0.state': 1,
+            'vcpu.0.time': 1000000000,
+            'net.count': 1,
+            'net.0.name': 'vnet0',
+            'net.0.rx.bytes': 10,
+            'block.count': 1,
+            'block.0.name': 'vda',
+            'block.0.wr.bytes': 20,
+        })])
+        with mock.patch(
+            "cloudify_libvirt.domain_tasks.libvirt.open",
+            mock.Mock(return_value=connect)
+        ):
+            with mock.patch(
+                "cloudify_libvirt.domain_tasks.time.time",
+                mock.Mock(return_value=100.0)
+            ):
+                domain_tasks.perfomance(ctx=_ctx, bulk_stats=True)
+        # only statistics of current domain
+        connect.domainListGetStats.assert_called_once_with(
+            [domain], domain_tasks.BULK_STATS_FLAGS, 0)
+        connect.getAllDomainStats.assert_not_called()
+        statistics = _ctx.instance.runtime_properties['stat']
+        self.assertNotIn('cpu', statistics)
+        self.assertEqual(statistics['memory'], 2.0)
+        self.assertEqual(statistics['vcpu'], [{'state': 1, 'time': 1.0}])
+        self.assertEqual(statistics['network'][0]['name'], 'vnet0')
+        self.assertEqual(statistics['network'][0]['rx_bytes'], 10)
+        self.assertEqual(statistics['block'][0]['wr_bytes'], 20)
+
+        # cpu usage from previous sample
+        statistics['timestamp'] = 90.0
+        statistics['cpu_time'] = 1.5
+        self.assertEqual(domain_tasks._bulk_statistics(
+            statistics, {'cpu.time': 2000000000}, 100.0)['cpu'], 5.0)
+
+        # no statistics for domain
+        connect.domainListGetStats = mock.Mock(return_value=[])
+        with mock.patch(
+            "cloudify_libvirt.domain_tasks.libvirt.open",
+            mock.Mock(return_value=connect)
+        ):
+            with self.assertRaisesRegexp(
+                NonRecoverableError,
+                'Failed to get statistics for the domain'
+            ):
+                domain_tasks.perfomance(ctx=_ctx, bulk_stats=True)
+
     def test_update_network_list(self):
         _ctx = self._create_ctx()
         domain = mock.Mock()
@@ -618,15 +1179,12 @@ class TestDomainTasks(LibVirtCommonTest):
                                 snapshot_name='snapshot_name',
                                 snapshot_incremental=False)
                     # without error
-                    with mock.patch(
-                        "os.path.isfile",
-                        mock.Mock(return_value=False)
-                    ):
-                        domain_tasks.snapshot_create(
-                            ctx=_ctx,
-                            template_resource="template_resource",
-                            snapshot_name='snapshot_name',
-                            snapshot_incremental=False)
+                    rename = self._create_backup_saved(
+                        fake_file, domain_tasks.snapshot_create, {
+                            'ctx': _ctx,
+                            'template_resource': "template_resource",
+                            'snapshot_name': 'snapshot_name',
+                            'snapshot_incremental': False})
                 if raw_case:
                     fake_file.assert_not_called()
                     domain.save.assert_called_with(
@@ -634,7 +1192,391 @@ class TestDomainTasks(LibVirtCommonTest):
                     connect.restore.assert_called_with(
                         './snapshot_name/check_raw')
                 else:
-                    fake_file().write.assert_called_with("<domain/>")
+                    self._check_backup_saved(
+                        fake_file, rename, './snapshot_name/check.xml',
+                        "<domain/>")
+
+    def test_dump_save_restore(self):
+        self._create_ctx()
+        fake_libvirt = mock.Mock(spec=[
+            'VIR_DOMAIN_SAVE_BYPASS_CACHE', 'VIR_DOMAIN_SAVE_PARALLEL',
+            'VIR_DOMAIN_SAVE_PARAM_PARALLEL_CHANNELS',
+            'VIR_DOMAIN_SAVE_PARAM_IMAGE_FORMAT',
+            'VIR_DOMAIN_SAVE_PARAM_FILE'])
+        fake_libvirt.VIR_DOMAIN_SAVE_BYPASS_CACHE = 1
+        fake_libvirt.VIR_DOMAIN_SAVE_PARALLEL = 8
+        fake_libvirt.VIR_DOMAIN_SAVE_PARAM_PARALLEL_CHANNELS = "channels"
+        fake_libvirt.VIR_DOMAIN_SAVE_PARAM_IMAGE_FORMAT = "format"
+        fake_libvirt.VIR_DOMAIN_SAVE_PARAM_FILE = "file"
+        dom = mock.Mock()
+        conn = mock.Mock()
+        with mock.patch(
+            "cloudify_libvirt.domain_tasks.libvirt", fake_libvirt
+        ):
+            # default save
+            domain_tasks._dump_save(dom, "dump", {})
+            dom.save.assert_called_with("dump")
+            domain_tasks._dump_restore(conn, "dump", {})
+            conn.restore.assert_called_with("dump")
+
+            # bypass cache only
+            params = {'dump_bypass_cache': True}
+            domain_tasks._dump_save(dom, "dump", params)
+            dom.saveFlags.assert_called_with("dump", None, 1)
+            domain_tasks._dump_restore(conn, "dump", params)
+            conn.restoreFlags.assert_called_with("dump", None, 1)
+
+            # compressed and parallel
+            params = {'dump_bypass_cache': True, 'dump_parallel': "4",
+                      'dump_format': 'zstd'}
+            domain_tasks._dump_save(dom, "dump", params)
+            dom.saveParams.assert_called_with(
+                {"file": "dump", "channels": 4, "format": "zstd"}, 9)
+            domain_tasks._dump_restore(conn, "dump", params)
+            conn.restoreParams.assert_called_with(
+                {"file": "dump", "channels": 4}, 9)
+
+        # old libvirt without save params
+        fake_libvirt = mock.Mock(spec=['VIR_DOMAIN_SAVE_BYPASS_CACHE'])
+        fake_libvirt.VIR_DOMAIN_SAVE_BYPASS_CACHE = 1
+        dom = mock.Mock()
+        with mock.patch(
+            "cloudify_libvirt.domain_tasks.libvirt", fake_libvirt
+        ):
+            domain_tasks._dump_save(dom, "dump", {'dump_parallel': 4,
+                                                  'dump_format': 'zstd'})
+            dom.save.assert_called_with("dump")
+
+    def test_live_dump(self):
+        _ctx = self._create_ctx()
+        dom = mock.Mock()
+        # raw disks are not frozen by snapshot
+        with self.assertRaisesRegexp(
+            NonRecoverableError,
+            "Live dump requires qcow2 type for all disks."
+        ):
+            domain_tasks._live_dump(dom, "dump", "backup", {
+                'disks': [{'dev': 'vda', 'type': 'qcow2', 'file': '/a.qcow2'},
+                          {'dev': 'vdb', 'type': 'raw', 'file': '/b.raw'}]
+            }, {})
+        dom.snapshotCreateXML.assert_not_called()
+
+        with mock.patch(
+            "cloudify_libvirt.domain_tasks.libvirt.VIR_DOMAIN_SNAPSHOT_"
+            "CREATE_LIVE", 256, create=True
+        ):
+            with mock.patch(
+                "cloudify_libvirt.domain_tasks.libvirt.VIR_DOMAIN_SNAPSHOT_"
+                "CREATE_NO_METADATA", 4, create=True
+            ):
+                domain_tasks._live_dump(dom, "dump", "backup", {
+                    'disks': [{'dev': 'vda', 'type': 'qcow2',
+                               'file': '/a.qcow2'},
+                              {'dev': 'vdb', 'type': 'qcow2',
+                               'file': '/b.qcow2'}]
+                }, {})
+        xmlconfig, flags = dom.snapshotCreateXML.call_args[0]
+        self.assertEqual(flags, 260)
+        # libvirtd requires absolute path
+        self.assertIn('<memory snapshot="external" file="{}"/>'
+                      .format(os.path.abspath("dump")), xmlconfig)
+        self.assertIn('<source file="/a.qcow2.backup"/>', xmlconfig)
+        self.assertIn('<source file="/b.qcow2.backup"/>', xmlconfig)
+        self.assertEqual(
+            _ctx.instance.runtime_properties['live_dump_overlays'], {
+                'name': 'backup',
+                'disks': {'vda': '/a.qcow2.backup',
+                          'vdb': '/b.qcow2.backup'}})
+
+        # overlays of previous dump are not merged
+        dom.snapshotCreateXML.reset_mock()
+        with self.assertRaisesRegexp(
+            NonRecoverableError,
+            "Live dump backup should be removed or applied before new live "
+            "dump."
+        ):
+            domain_tasks._live_dump(dom, "dump", "next", {
+                'disks': [{'dev': 'vda', 'type': 'qcow2',
+                           'file': '/a.qcow2'}]
+            }, {})
+        dom.snapshotCreateXML.assert_not_called()
+
+    def test_live_dump_commit(self):
+        _ctx = self._create_ctx()
+        _ctx.instance.runtime_properties['live_dump_overlays'] = {
+            'name': 'backup', 'disks': {'vda': '/a.qcow2.backup'}}
+        dom = mock.Mock()
+        dom.isActive = mock.Mock(return_value=1)
+        dom.blockJobInfo = mock.Mock(return_value={'cur': 10, 'end': 10})
+
+        # overlay has children
+        dom.XMLDesc = mock.Mock(return_value=(
+            "<domain><devices><disk><source file='/a.qcow2.next'/>"
+            "<target dev='vda'/></disk></devices></domain>"))
+        with self.assertRaisesRegexp(
+            NonRecoverableError,
+            "Disk vda is switched from /a.qcow2.backup to /a.qcow2.next "
+            "after live dump backup, base file has children."
+        ):
+            domain_tasks._live_dump_commit(dom, "backup", {})
+        dom.blockCommit.assert_not_called()
+
+        # merged to base
+        dom.XMLDesc = mock.Mock(return_value=(
+            "<domain><devices><disk><source file='/a.qcow2.backup'/>"
+            "<target dev='vda'/></disk></devices></domain>"))
+        with mock.patch(
+            "cloudify_libvirt.domain_tasks.libvirt.VIR_DOMAIN_BLOCK_COMMIT_"
+            "ACTIVE", 4, create=True
+        ):
+            with mock.patch(
+                "cloudify_libvirt.domain_tasks.libvirt.VIR_DOMAIN_BLOCK_"
+                "COMMIT_SHALLOW", 1, create=True
+            ):
+                with mock.patch(
+                    "cloudify_libvirt.domain_tasks.libvirt.VIR_DOMAIN_BLOCK_"
+                    "JOB_ABORT_PIVOT", 2, create=True
+                ):
+                    with mock.patch("os.path.isfile",
+                                    mock.Mock(return_value=True)):
+                        with mock.patch("os.remove") as remove:
+                            domain_tasks._live_dump_commit(dom, "backup", {})
+        dom.blockCommit.assert_called_with('vda', None, None, 0, 5)
+        dom.blockJobAbort.assert_called_with('vda', 2)
+        remove.assert_called_with('/a.qcow2.backup')
+        self.assertIsNone(
+            _ctx.instance.runtime_properties['live_dump_overlays'])
+
+        # already applied, nothing to merge
+        dom.blockCommit.reset_mock()
+        domain_tasks._live_dump_commit(dom, "backup", {})
+        dom.blockCommit.assert_not_called()
+
+        # overlays belong to other dump
+        _ctx.instance.runtime_properties['live_dump_overlays'] = {
+            'name': 'next', 'disks': {'vda': '/a.qcow2.next'}}
+        domain_tasks._live_dump_commit(dom, "backup", {})
+        dom.blockCommit.assert_not_called()
+
+        # not merged in time
+        _ctx.instance.runtime_properties['live_dump_overlays'] = {
+            'name': 'backup', 'disks': {'vda': '/a.qcow2.backup'}}
+        dom.blockJobInfo = mock.Mock(return_value={})
+        with mock.patch(
+            "cloudify_libvirt.domain_tasks.libvirt.VIR_DOMAIN_BLOCK_COMMIT_"
+            "ACTIVE", 4, create=True
+        ):
+            with mock.patch(
+                "cloudify_libvirt.domain_tasks.libvirt.VIR_DOMAIN_BLOCK_"
+                "COMMIT_SHALLOW", 1, create=True
+            ):
+                with mock.patch(
+                    "cloudify_libvirt.common.wait_for",
+                    mock.Mock(return_value=False)
+                ):
+                    with self.assertRaisesRegexp(
+                        RecoverableError,
+                        "Disk vda is not merged in 10s, aborted."
+                    ):
+                        domain_tasks._live_dump_commit(
+                            dom, "backup", {'block_backup_timeout': 10})
+        dom.blockJobAbort.assert_called_with('vda', 0)
+
+    def test_live_dump_remove_overlays(self):
+        self._create_ctx()
+        connect = self._create_fake_connection()
+        volume = mock.Mock()
+        connect.storageVolLookupByPath = mock.Mock(side_effect=[
+            volume, libvirt.libvirtError("remote")])
+        # remote hypervisor files
+        with mock.patch("os.path.isfile", mock.Mock(return_value=False)):
+            domain_tasks._live_dump_remove_overlays(
+                connect, {'vda': '/a.qcow2.backup', 'vdb': '/b.qcow2.backup'})
+        volume.delete.assert_called_with(0)
+        connect.storageVolLookupByPath.assert_called_with('/b.qcow2.backup')
+
+    def test_live_dump_apply(self):
+        _ctx = self._create_ctx()
+        _ctx.instance.runtime_properties['live_dump_overlays'] = {
+            'name': 'backup', 'disks': {'vda': '/a.qcow2.backup'}}
+        connect = self._create_fake_connection()
+        dom = mock.Mock()
+        dom.snapshotNum = mock.Mock(return_value=0)
+        dom.state = mock.Mock(return_value=(libvirt.VIR_DOMAIN_SHUTOFF, ""))
+        dom.undefineFlags = mock.Mock(return_value=0)
+        dom.XMLDesc = mock.Mock(return_value=(
+            "<domain><devices><disk><source file='/a.qcow2.backup'/>"
+            "<target dev='vda'/></disk></devices></domain>"))
+        params = {'full_dump': True, 'live_dump': True}
+        with mock.patch("os.path.isfile", mock.Mock(return_value=True)):
+            with mock.patch("os.remove") as remove:
+                domain_tasks._backup_apply(connect, dom, "resource",
+                                           "backup", params,
+                                           {"snapshot_name": "backup"})
+        remove.assert_called_with('/a.qcow2.backup')
+        connect.restore.assert_called_with('./backup/resource_raw')
+        self.assertIsNone(
+            _ctx.instance.runtime_properties['live_dump_overlays'])
+
+        # restored domain has changed base files
+        dom.undefineFlags.reset_mock()
+        with mock.patch("os.path.isfile", mock.Mock(return_value=True)):
+            with self.assertRaisesRegexp(
+                NonRecoverableError,
+                "Disks of live dump backup are already changed."
+            ):
+                domain_tasks._backup_apply(connect, dom, "resource",
+                                           "backup", params,
+                                           {"snapshot_name": "backup"})
+        dom.undefineFlags.assert_not_called()
+
+    def test_block_backup(self):
+        _ctx = self._create_ctx()
+        backup_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, backup_dir)
+        _ctx.node.properties['backup_dir'] = backup_dir
+        params = {
+            'disks': [{'dev': 'vda', 'type': 'qcow2', 'file': '/a.qcow2'},
+                      {'dev': 'vdb', 'type': 'raw', 'file': '/b.raw'}]
+        }
+        checkpoint = mock.Mock()
+        checkpoint.listAllChildren = mock.Mock(return_value=[])
+        dom = mock.Mock()
+        dom.jobInfo = mock.Mock(return_value=[0])
+        dom.jobStats = mock.Mock(return_value={'type': 3,
+                                               'data_processed': 1024})
+        dom.checkpointLookupByName = mock.Mock(return_value=checkpoint)
+
+        with mock.patch(
+            "cloudify_libvirt.domain_tasks.libvirt.VIR_DOMAIN_JOB_NONE",
+            0, create=True
+        ):
+            with mock.patch(
+                "cloudify_libvirt.domain_tasks.libvirt.VIR_DOMAIN_JOB_FAILED",
+                4, create=True
+            ):
+                # no qcow2 disks
+                with self.assertRaisesRegexp(
+                    NonRecoverableError,
+                    "No qcow2 disks for block backup."
+                ):
+                    domain_tasks._block_backup_create(
+                        dom, "domain", "first", {'disks': [
+                            {'dev': 'vdb', 'type': 'raw', 'file': '/b.raw'}
+                        ]}, {'snapshot_name': "first"})
+
+                # full backup
+                domain_tasks._block_backup_create(
+                    dom, "domain", "first", params,
+                    {'snapshot_name': "first"})
+                backup_xml, checkpoint_xml = dom.backupBegin.call_args[0]
+                self.assertNotIn('<incremental>', backup_xml)
+                self.assertIn(
+                    '<target file="{}/first/domain_vda.qcow2"/>'
+                    .format(backup_dir), backup_xml)
+                self.assertIn('<disk name="vdb" backup="no"/>', backup_xml)
+                self.assertIn('<name>first</name>', checkpoint_xml)
+                self.assertIn('<disk name="vda" checkpoint="bitmap"/>',
+                              checkpoint_xml)
+
+                # already exists
+                with self.assertRaisesRegexp(
+                    NonRecoverableError,
+                    "Backup first already exists."
+                ):
+                    domain_tasks._block_backup_create(
+                        dom, "domain", "first", params,
+                        {'snapshot_name': "first"})
+
+                # incremental backup
+                domain_tasks._block_backup_create(
+                    dom, "domain", "second", params,
+                    {'snapshot_name': "second"})
+                backup_xml, _ = dom.backupBegin.call_args[0]
+                self.assertIn('<incremental>first</incremental>', backup_xml)
+                self.assertEqual(
+                    _ctx.instance.runtime_properties['block_checkpoint'][
+                        'name'], "second")
+                manifest = domain_tasks.common.read_manifest(
+                    "{}/second/domain_blocks.json".format(backup_dir))
+                self.assertEqual(manifest['disks'], {'vda': [
+                    "{}/first/domain_vda.qcow2".format(backup_dir),
+                    "{}/second/domain_vda.qcow2".format(backup_dir)]})
+
+                # failed job
+                dom.jobStats = mock.Mock(return_value={'type': 4,
+                                                       'errmsg': 'no space'})
+                with self.assertRaisesRegexp(
+                    NonRecoverableError,
+                    "Block backup is failed: no space"
+                ):
+                    domain_tasks._block_backup_create(
+                        dom, "domain", "third", params,
+                        {'snapshot_name': "third"})
+                # checkpoint of failed backup is removed
+                dom.checkpointLookupByName.assert_called_with("third")
+                checkpoint.delete.assert_called_with()
+                checkpoint.delete.reset_mock()
+
+                # relative backup_dir is passed to libvirt as absolute
+                dom.jobStats = mock.Mock(return_value={'type': 3})
+                cwd = os.getcwd()
+                self.addCleanup(os.chdir, cwd)
+                os.chdir(backup_dir)
+                _ctx.node.properties['backup_dir'] = "relative"
+                domain_tasks._block_backup_create(
+                    dom, "domain", "fourth", params,
+                    {'snapshot_name': "fourth"})
+                os.chdir(cwd)
+                _ctx.node.properties['backup_dir'] = backup_dir
+                backup_xml, _ = dom.backupBegin.call_args[0]
+                self.assertIn(
+                    '<target file="{}/relative/fourth/domain_vda.qcow2"/>'
+                    .format(os.path.realpath(backup_dir)), backup_xml)
+                self.assertEqual(
+                    _ctx.instance.runtime_properties['block_checkpoint'][
+                        'manifest'],
+                    "{}/relative/fourth/domain_blocks.json"
+                    .format(os.path.realpath(backup_dir)))
+                _ctx.instance.runtime_properties['block_checkpoint'] = {
+                    'name': "second",
+                    'manifest': "{}/second/domain_blocks.json"
+                    .format(backup_dir)}
+
+        # apply can't replace disks
+        with self.assertRaisesRegexp(
+            NonRecoverableError,
+            "Block backup second can't be applied to existing domain, "
+            "restore disks offline from: vda: \\["
+        ):
+            domain_tasks._block_backup_apply("domain", "second",
+                                             {'snapshot_name': "second"})
+
+        # can't remove with children
+        checkpoint.listAllChildren = mock.Mock(return_value=[checkpoint])
+        checkpoint.getName = mock.Mock(return_value="second")
+        with self.assertRaisesRegexp(
+            NonRecoverableError,
+            "Incremental backups \\['second'\\] found for first."
+        ):
+            domain_tasks._block_backup_delete(dom, "domain", "first",
+                                              {'snapshot_name': "first"})
+
+        # remove last
+        checkpoint.listAllChildren = mock.Mock(return_value=[])
+        domain_tasks._block_backup_delete(dom, "domain", "second",
+                                          {'snapshot_name': "second"})
+        checkpoint.delete.assert_called_with()
+        self.assertFalse(os.path.isfile(
+            "{}/second/domain_blocks.json".format(backup_dir)))
+        self.assertIsNone(
+            _ctx.instance.runtime_properties['block_checkpoint'])
+        with self.assertRaisesRegexp(
+            NonRecoverableError,
+            "No backups found with name: second."
+        ):
+            domain_tasks._block_backup_apply("domain", "second",
+                                             {'snapshot_name': "second"})
 
     def test_snapshot_create(self):
         self._test_common_backups(domain_tasks.snapshot_create,
@@ -11,15 +11,32 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import os
+import shutil
+import tempfile
 import unittest
 import mock
+import pycdlib
+from io import BytesIO
 
+import cloudify_common_sdk.iso9660 as iso9660
 from cloudify_libvirt.tests.test_common_base import LibVirtCommonTest
 import cloudify_libvirt.iso9660_tasks as iso9660_tasks
 
 
 class TestIso9660Task(LibVirtCommonTest):
 
+    def test_names(self):
+        # same names as in sdk create_iso
+        for name in ["meta-data", "/openstack/latest/user_data",
+                     "a.json", "dir.name/file.yaml", "x" * 80]:
+            self.assertEqual(iso9660_tasks._iso_name(name),
+                             iso9660._iso_name(name))
+            self.assertEqual(iso9660_tasks._joliet_name(name),
+                             iso9660._joliet_name(name))
+            self.assertEqual(iso9660_tasks._name_cleanup(name),
+                             iso9660._name_cleanup(name))
+
     def test_create(self):
         # check correct handle exception with empty connection
         self._check_correct_connect(
@@ -57,6 +74,147 @@ class TestIso9660Task(LibVirtCommonTest):
         connect.storagePoolLookupByName.assert_called_with("_+pool")
         pool.storageVolLookupByName.assert_called_with("_+volume")
 
+    def test_create_stream(self):
+        volume = mock.Mock()
+        pool = mock.Mock()
+        pool.storageVolLookupByName = mock.Mock(return_value=volume)
+        uploaded = BytesIO()
+
+        def _fake_send_all(handler, opaque):
+            while True:
+                chunk = handler(stream, 1024, opaque)
+                if not chunk:
+                    break
+                self.assertLessEqual(len(chunk), 1024)
+                uploaded.write(chunk)
+
+        stream = mock.Mock()
+        stream.sendAll = _fake_send_all
+        connect = self._create_fake_connection()
+        connect.storagePoolLookupByName = mock.Mock(return_value=pool)
+        connect.newStream = mock.Mock(return_value=stream)
+
+        _ctx = self._create_ctx()
+        _ctx.instance.runtime_properties['params'] = {}
+        _ctx.node.properties['params'] = {}
+        _ctx.get_resource = mock.Mock(return_value=b"#cloud-config\n")
+        with mock.patch(
+            "cloudify_libvirt.iso9660_tasks.libvirt.open",
+            mock.Mock(return_value=connect)
+        ):
+            # spool image to disk
+            with mock.patch(
+                "cloudify_libvirt.iso9660_tasks.ISO_SPOOL_SIZE", 1024
+            ):
+                iso9660_tasks.create(ctx=_ctx, params={
+                    "pool": "pool",
+                    "volume": "volume",
+                    "files": {
+                        "meta-data": "instance-id: localhost",
+                        "openstack/latest/meta_data.json": "{}"
+                    },
+                    "files_raw": {
+                        "user-data": "cloud_init.yaml"
+                    }
+                })
+        _ctx.get_resource.assert_called_with("cloud_init.yaml")
+        volume.upload.assert_called_with(
+            stream, 0, len(uploaded.getvalue()), 0)
+        stream.finish.assert_called_with()
+
+        iso = pycdlib.PyCdlib()
+        iso.open_fp(uploaded)
+        content = BytesIO()
+        iso.get_file_from_iso_fp(content, joliet_path="/user-data")
+        self.assertEqual(content.getvalue(), b"#cloud-config\n")
+        content = BytesIO()
+        iso.get_file_from_iso_fp(
+            content, joliet_path="/openstack/latest/meta_data.json")
+        self.assertEqual(content.getvalue(), b"{}")
+        iso.close()
+
+    def test_create_cached(self):
+        volume = mock.Mock()
+        pool = mock.Mock()
+        pool.storageVolLookupByName = mock.Mock(return_value=volume)
+        uploads = []
+
+        def _fake_send_all(handler, opaque):
+            uploads.append(opaque.read())
+
+        stream = mock.Mock()
+        stream.sendAll = _fake_send_all
+        connect = self._create_fake_connection()
+        connect.storagePoolLookupByName = mock.Mock(return_value=pool)
+        connect.newStream = mock.Mock(return_value=stream)
+
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        _ctx = self._create_ctx()
+        params = {
+            "pool": "pool",
+            "volume": "volume",
+            "cache_dir": cache_dir + "/iso",
+            "files": {
+                "meta-data": "instance-id: localhost"
+            }
+        }
+        with mock.patch(
+            "cloudify_libvirt.iso9660_tasks.libvirt.open",
+            mock.Mock(return_value=connect)
+        ):
+            with mock.patch(
+                "cloudify_libvirt.iso9660_tasks._write_iso",
+                mock.Mock(wraps=iso9660_tasks._write_iso)
+            ) as write_iso:
+                # build and save image
+                iso9660_tasks.create(ctx=_ctx, params=params)
+                self.assertEqual(write_iso.call_count, 1)
+                # same content, image from cache
+                iso9660_tasks.create(ctx=_ctx, params=params)
+                self.assertEqual(write_iso.call_count, 1)
+                # other content
+                params['files'] = {"meta-data": "instance-id: other"}
+                iso9660_tasks.create(ctx=_ctx, params=params)
+                self.assertEqual(write_iso.call_count, 2)
+
+        self.assertEqual(len(uploads), 3)
+        self.assertEqual(uploads[0], uploads[1])
+        self.assertNotEqual(uploads[0], uploads[2])
+        self.assertEqual(
+            sorted(os.listdir(cache_dir + "/iso")),
+            sorted([
+                iso9660_tasks._iso_hash(
+                    "cidata", "", {"meta-data": "instance-id: localhost"}
+                ) + ".iso",
+                iso9660_tasks._iso_hash(
+                    "cidata", "", {"meta-data": "instance-id: other"}
+                ) + ".iso"
+            ]))
+
+    def test_cache_evict(self):
+        self._create_ctx()
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        for pos, name in enumerate(["old.iso", "used.iso", "new.iso",
+                                    "other.tmp"]):
+            with open(os.path.join(cache_dir, name), 'wb') as image:
+                image.write(b"\0" * 100)
+            os.utime(os.path.join(cache_dir, name), (pos, pos))
+        # recently used
+        os.utime(os.path.join(cache_dir, "used.iso"), (10, 10))
+
+        iso9660_tasks._cache_evict(cache_dir, 200,
+                                   os.path.join(cache_dir, "new.iso"))
+        self.assertEqual(sorted(os.listdir(cache_dir)),
+                         ["new.iso", "other.tmp", "used.iso"])
+
+        # new image is kept even if it is bigger than limit
+        iso9660_tasks._cache_evict(cache_dir, 50,
+                                   os.path.join(cache_dir, "new.iso"))
+        self.assertEqual(sorted(os.listdir(cache_dir)),
+                         ["new.iso", "other.tmp"])
+
 
 if __name__ == '__main__':
     unittest.main()
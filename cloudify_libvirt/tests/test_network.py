@@ -124,6 +124,32 @@ class TestNetworkTasks(LibVirtCommonTest):
                 ):
                     network_tasks.link(ctx=_ctx)
 
+        # no wait at all
+        network.DHCPLeases = mock.Mock(return_value=[])
+        with mock.patch(
+            "cloudify_libvirt.network_tasks.libvirt.open",
+            mock.Mock(return_value=connect)
+        ):
+            with self.assertRaisesRegexp(
+                RecoverableError,
+                'No ip for now, try later'
+            ):
+                network_tasks.link(ctx=_ctx, wait_timeout=0)
+        network.DHCPLeases.assert_called_once_with()
+
+        # timeout from blueprint inputs as string
+        network.DHCPLeases = mock.Mock(return_value=[])
+        with mock.patch(
+            "cloudify_libvirt.network_tasks.libvirt.open",
+            mock.Mock(return_value=connect)
+        ):
+            with self.assertRaisesRegexp(
+                RecoverableError,
+                'No ip for now, try later'
+            ):
+                network_tasks.link(ctx=_ctx, wait_timeout="0")
+        network.DHCPLeases.assert_called_once_with()
+
         # lease
         network.DHCPLeases = mock.Mock(return_value=[{
             'mac': "ab:cd:ef",
@@ -224,6 +250,7 @@ class TestNetworkTasks(LibVirtCommonTest):
         _ctx.node.properties['params'] = {}
         _ctx.instance.runtime_properties["backups"] = {
             "node_name-backup": "<xml/>"}
+        _ctx.node.properties['backup_store'] = "runtime"
         return _ctx, connect, network
 
     def test_snapshot_apply(self):
@@ -331,8 +358,7 @@ class TestNetworkTasks(LibVirtCommonTest):
             network_tasks.snapshot_create(ctx=_ctx, snapshot_name="backup",
                                           snapshot_incremental=True)
         self.assertEqual(
-            _ctx.instance.runtime_properties["backups"],
-            {"node_name-backup": "<network/>"})
+            self._read_backups(_ctx), {"node_name-backup": "<network/>"})
 
         # check create snapshot
         with mock.patch(
@@ -361,14 +387,13 @@ class TestNetworkTasks(LibVirtCommonTest):
                                 ctx=_ctx, snapshot_name="backup",
                                 snapshot_incremental=False)
                     # without error
-                    with mock.patch(
-                        "os.path.isfile",
-                        mock.Mock(return_value=False)
-                    ):
-                        network_tasks.snapshot_create(
-                            ctx=_ctx, snapshot_name="backup",
-                            snapshot_incremental=False)
-                    fake_file().write.assert_called_with("<network/>")
+                    rename = self._create_backup_saved(
+                        fake_file, network_tasks.snapshot_create, {
+                            'ctx': _ctx, 'snapshot_name': "backup",
+                            'snapshot_incremental': False})
+                    self._check_backup_saved(
+                        fake_file, rename, './backup/resource.xml',
+                        "<network/>")
 
     def test_snapshot_delete(self):
         self._test_no_resource_id(network_tasks.snapshot_delete,
@@ -392,8 +417,7 @@ class TestNetworkTasks(LibVirtCommonTest):
                     ctx=_ctx, snapshot_name="backup!",
                     snapshot_incremental=True)
         self.assertEqual(
-            _ctx.instance.runtime_properties["backups"],
-            {'node_name-backup': "<xml/>"})
+            self._read_backups(_ctx), {"node_name-backup": "<xml/>"})
 
         # remove snapshot
         _ctx, connect, network = self._create_fake_network_backup()
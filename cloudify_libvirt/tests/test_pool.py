@@ -79,6 +79,7 @@ class TestPoolTasks(LibVirtCommonTest):
         _ctx.node.properties['params'] = {}
         _ctx.instance.runtime_properties["backups"] = {
             "node_name-backup": "<xml/>"}
+        _ctx.node.properties['backup_store'] = "runtime"
         return _ctx, connect, pool
 
     def test_snapshot_apply(self):
@@ -186,8 +187,7 @@ class TestPoolTasks(LibVirtCommonTest):
             pool_tasks.snapshot_create(ctx=_ctx, snapshot_name="backup",
                                        snapshot_incremental=True)
         self.assertEqual(
-            _ctx.instance.runtime_properties["backups"],
-            {"node_name-backup": "<pool/>"})
+            self._read_backups(_ctx), {"node_name-backup": "<pool/>"})
 
         # check create snapshot
         with mock.patch(
@@ -216,14 +216,13 @@ class TestPoolTasks(LibVirtCommonTest):
                                 ctx=_ctx, snapshot_name="backup",
                                 snapshot_incremental=False)
                     # without error
-                    with mock.patch(
-                        "os.path.isfile",
-                        mock.Mock(return_value=False)
-                    ):
-                        pool_tasks.snapshot_create(
-                            ctx=_ctx, snapshot_name="backup",
-                            snapshot_incremental=False)
-                    fake_file().write.assert_called_with("<pool/>")
+                    rename = self._create_backup_saved(
+                        fake_file, pool_tasks.snapshot_create, {
+                            'ctx': _ctx, 'snapshot_name': "backup",
+                            'snapshot_incremental': False})
+                    self._check_backup_saved(
+                        fake_file, rename, './backup/resource.xml',
+                        "<pool/>")
 
     def test_snapshot_delete(self):
         self._test_no_resource_id(pool_tasks.snapshot_delete,
@@ -247,8 +246,7 @@ class TestPoolTasks(LibVirtCommonTest):
                     ctx=_ctx, snapshot_name="backup!",
                     snapshot_incremental=True)
         self.assertEqual(
-            _ctx.instance.runtime_properties["backups"],
-            {'node_name-backup': "<xml/>"})
+            self._read_backups(_ctx), {"node_name-backup": "<xml/>"})
 
         # remove snapshot
         _ctx, connect, pool = self._create_fake_pool_backup()
@@ -12,11 +12,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import mock
+import libvirt
 import unittest
 
 from cloudify.state import current_ctx
 from cloudify.mocks import MockCloudifyContext
-from cloudify.exceptions import NonRecoverableError
+from cloudify.exceptions import NonRecoverableError, RecoverableError
 
 from cloudify_common_sdk._compat import builtins_open
 
@@ -86,6 +87,7 @@ class TestVolumeTasks(LibVirtCommonTest):
         _ctx.node.properties['params'] = {}
         _ctx.instance.runtime_properties["backups"] = {
             "node_name-backup": "<xml/>"}
+        _ctx.node.properties['backup_store'] = "runtime"
         return _ctx, connect, pool, volume
 
     def test_snapshot_apply(self):
@@ -194,8 +196,7 @@ class TestVolumeTasks(LibVirtCommonTest):
             volume_tasks.snapshot_create(ctx=_ctx, snapshot_name="backup",
                                          snapshot_incremental=True)
         self.assertEqual(
-            _ctx.instance.runtime_properties["backups"],
-            {"node_name-backup": "<volume/>"})
+            self._read_backups(_ctx), {"node_name-backup": "<volume/>"})
 
         # check create snapshot
         with mock.patch(
@@ -224,14 +225,13 @@ class TestVolumeTasks(LibVirtCommonTest):
                                 ctx=_ctx, snapshot_name="backup",
                                 snapshot_incremental=False)
                     # without error
-                    with mock.patch(
-                        "os.path.isfile",
-                        mock.Mock(return_value=False)
-                    ):
-                        volume_tasks.snapshot_create(
-                            ctx=_ctx, snapshot_name="backup",
-                            snapshot_incremental=False)
-                    fake_file().write.assert_called_with("<volume/>")
+                    rename = self._create_backup_saved(
+                        fake_file, volume_tasks.snapshot_create, {
+                            'ctx': _ctx, 'snapshot_name': "backup",
+                            'snapshot_incremental': False})
+                    self._check_backup_saved(
+                        fake_file, rename, './backup/resource.xml',
+                        "<volume/>")
 
     def test_snapshot_delete(self):
         self._test_no_resource_id(volume_tasks.snapshot_delete,
@@ -255,8 +255,7 @@ class TestVolumeTasks(LibVirtCommonTest):
                     ctx=_ctx, snapshot_name="backup!",
                     snapshot_incremental=True)
         self.assertEqual(
-            _ctx.instance.runtime_properties["backups"],
-            {'node_name-backup': "<xml/>"})
+            self._read_backups(_ctx), {"node_name-backup": "<xml/>"})
 
         # remove snapshot
         _ctx, connect, pool, volume = self._create_fake_volume_backup()
@@ -480,6 +479,7 @@ class TestVolumeTasks(LibVirtCommonTest):
         volume = mock.Mock()
         volume.name = mock.Mock(return_value="volume")
         volume.upload = mock.Mock()
+        volume.wipePattern = mock.Mock(return_value=0)
         pool = mock.Mock()
         pool.name = mock.Mock(return_value="pool")
         pool.storageVolLookupByName = mock.Mock(return_value=volume)
@@ -496,6 +496,74 @@ class TestVolumeTasks(LibVirtCommonTest):
                                     'zero_wipe': True,
                                     'allocation': 1
                                 })
+        volume.wipePattern.assert_called_with(
+            volume_tasks.libvirt.VIR_STORAGE_VOL_WIPE_ALG_ZERO, 0)
+        volume.upload.assert_not_called()
+
+        # server side wipe failed, stream by large buffers
+        volume.wipePattern = mock.Mock(return_value=-1)
+        stream = mock.Mock()
+        connect.newStream = mock.Mock(return_value=stream)
+        with mock.patch(
+            "cloudify_libvirt.volume_tasks.libvirt.open",
+            mock.Mock(return_value=connect)
+        ):
+            with mock.patch(
+                "cloudify_libvirt.volume_tasks.WIPE_BUFFER",
+                1024 * 1024 * 2
+            ):
+                volume_tasks.start(ctx=_ctx,
+                                   params={
+                                        'zero_wipe': True,
+                                        'allocation': 5
+                                    })
+        volume.upload.assert_called_with(stream, 0, 5 * 1024 * 1024, 0)
+        self.assertEqual(
+            [len(call[0][0]) for call in stream.send.call_args_list],
+            [2 * 1024 * 1024, 2 * 1024 * 1024, 1024 * 1024])
+        stream.finish.assert_called_with()
+
+    def test_send_sparse(self):
+        stream = mock.Mock()
+        with mock.patch(
+            "cloudify_libvirt.volume_tasks.SPARSE_BLOCK", 4
+        ):
+            self.assertEqual(volume_tasks._send_sparse(
+                stream, b"ab\0\0" + b"\0" * 8 + b"xyz\0" + b"\0\0"), 10)
+        stream.send.assert_has_calls([
+            mock.call(b"ab\0\0"), mock.call(b"xyz\0")])
+        stream.sendHole.assert_has_calls([
+            mock.call(8, 0), mock.call(2, 0)])
+
+    def test_start_sparse_wipe(self):
+        _ctx = self._create_ctx()
+        _ctx.instance.runtime_properties['resource_id'] = 'volume'
+        _ctx.instance.runtime_properties['params'] = {'pool': 'pool_name'}
+
+        volume = mock.Mock()
+        volume.wipePattern = mock.Mock(
+            side_effect=volume_tasks.libvirt.libvirtError("wipePattern"))
+        pool = mock.Mock()
+        pool.storageVolLookupByName = mock.Mock(return_value=volume)
+        stream = mock.Mock()
+        connect = self._create_fake_connection()
+        connect.newStream = mock.Mock(return_value=stream)
+        connect.storagePoolLookupByName = mock.Mock(return_value=pool)
+        with mock.patch(
+            "cloudify_libvirt.volume_tasks.libvirt.open",
+            mock.Mock(return_value=connect)
+        ):
+            volume_tasks.start(ctx=_ctx,
+                               params={
+                                    'zero_wipe': True,
+                                    'sparse': True,
+                                    'allocation': 1
+                                })
+        volume.upload.assert_called_with(
+            stream, 0, 1024 * 1024,
+            volume_tasks.libvirt.VIR_STORAGE_VOL_UPLOAD_SPARSE_STREAM)
+        stream.sendHole.assert_called_with(1024 * 1024, 0)
+        stream.send.assert_not_called()
 
     def test_start_download(self):
         # download
@@ -520,9 +588,11 @@ class TestVolumeTasks(LibVirtCommonTest):
             # empty
             head_response = mock.Mock()
             head_response.headers = {'Content-Length': 0}
+            session = mock.Mock()
+            session.head = mock.Mock(return_value=head_response)
             with mock.patch(
-                "cloudify_libvirt.volume_tasks.requests.head",
-                mock.Mock(return_value=head_response)
+                "cloudify_libvirt.volume_tasks.requests.Session",
+                mock.Mock(return_value=session)
             ):
                 with self.assertRaisesRegexp(
                     NonRecoverableError,
@@ -532,24 +602,122 @@ class TestVolumeTasks(LibVirtCommonTest):
                         ctx=_ctx,
                         params={
                             'url': "https://fake.org/centos.iso"})
+            session.close.assert_called_with()
 
-            # 512 for download
+            # 3 ranges for download
             head_response = mock.Mock()
-            head_response.headers = {'Content-Length': 512,
+            head_response.headers = {'Content-Length': 40,
                                      'Accept-Ranges': 'bytes'}
-            head_response.iter_content = mock.Mock(return_value=["\0" * 256])
+            session = mock.Mock()
+            session.head = mock.Mock(return_value=head_response)
+
+            def _fake_get(url, headers, allow_redirects):
+                start, stop = headers['Range'][len('bytes='):].split('-')
+                response = mock.Mock()
+                # first digit of range start as content
+                response.content = start.encode()[:1] * (
+                    int(stop) - int(start) + 1)
+                return response
+
+            session.get = _fake_get
+            stream = mock.Mock()
+            connect.newStream = mock.Mock(return_value=stream)
             with mock.patch(
-                "cloudify_libvirt.volume_tasks.requests.head",
-                mock.Mock(return_value=head_response)
+                "cloudify_libvirt.volume_tasks.requests.Session",
+                mock.Mock(return_value=session)
             ):
                 with mock.patch(
-                    "cloudify_libvirt.volume_tasks.requests.get",
-                    mock.Mock(return_value=head_response)
+                    "cloudify_libvirt.volume_tasks.STEP_DOWNLOAD", 16
+                ):
+                    volume_tasks.start(
+                        ctx=_ctx,
+                        params={
+                            'url': "https://fake.org/centos.iso",
+                            'download_workers': 2})
+            volume.upload.assert_called_with(stream, 0, 40, 0)
+            self.assertEqual(
+                [call[0][0] for call in stream.send.call_args_list],
+                [b"0" * 16, b"1" * 16, b"3" * 8])
+            stream.finish.assert_called_with()
+            self.assertEqual(
+                _ctx.instance.runtime_properties['download']['offset'], 40)
+
+            # already downloaded
+            connect.newStream = mock.Mock()
+            with mock.patch(
+                "cloudify_libvirt.volume_tasks.requests.Session",
+                mock.Mock(return_value=session)
+            ):
+                volume_tasks.start(
+                    ctx=_ctx,
+                    params={
+                        'url': "https://fake.org/centos.iso"})
+            connect.newStream.assert_not_called()
+
+            # resume from checkpoint
+            _ctx.instance.runtime_properties['download']['offset'] = 16
+            stream = mock.Mock()
+            connect.newStream = mock.Mock(return_value=stream)
+            with mock.patch(
+                "cloudify_libvirt.volume_tasks.requests.Session",
+                mock.Mock(return_value=session)
+            ):
+                with mock.patch(
+                    "cloudify_libvirt.volume_tasks.STEP_DOWNLOAD", 16
                 ):
                     volume_tasks.start(
                         ctx=_ctx,
                         params={
                             'url': "https://fake.org/centos.iso"})
+            volume.upload.assert_called_with(stream, 16, 24, 0)
+            self.assertEqual(
+                [call[0][0] for call in stream.send.call_args_list],
+                [b"1" * 16, b"3" * 8])
+
+            # image changed, download from start
+            head_response.headers['ETag'] = '"new"'
+            _ctx.instance.runtime_properties['download']['offset'] = 16
+            stream = mock.Mock()
+            connect.newStream = mock.Mock(return_value=stream)
+            with mock.patch(
+                "cloudify_libvirt.volume_tasks.requests.Session",
+                mock.Mock(return_value=session)
+            ):
+                volume_tasks.start(
+                    ctx=_ctx,
+                    params={
+                        'url': "https://fake.org/centos.iso"})
+            volume.upload.assert_called_with(stream, 0, 40, 0)
+
+            # failed range
+            _ctx.instance.runtime_properties['download'] = {}
+            head_response = mock.Mock()
+            head_response.headers = {'Content-Length': 40,
+                                     'Accept-Ranges': 'bytes'}
+            session = mock.Mock()
+            session.head = mock.Mock(return_value=head_response)
+            session.get = mock.Mock(side_effect=IOError("broken"))
+            stream = mock.Mock()
+            connect.newStream = mock.Mock(return_value=stream)
+            with mock.patch(
+                "cloudify_libvirt.volume_tasks.requests.Session",
+                mock.Mock(return_value=session)
+            ):
+                with mock.patch(
+                    "cloudify_libvirt.volume_tasks.time.sleep",
+                    mock.Mock()
+                ):
+                    with self.assertRaisesRegexp(
+                        RecoverableError,
+                        "Failed to download range 0..39"
+                    ):
+                        volume_tasks.start(
+                            ctx=_ctx,
+                            params={
+                                'url': "https://fake.org/centos.iso"})
+            self.assertEqual(session.get.call_count,
+                             volume_tasks.DOWNLOAD_RETRIES)
+            stream.abort.assert_called_with()
 
     def test_stop(self):
         # check correct handle exception with empty connection
@@ -652,12 +820,209 @@ class TestVolumeTasks(LibVirtCommonTest):
             _ctx.instance.runtime_properties,
             {
                 'backups': {},
+                'download': {},
                 'libvirt_auth': {'a': 'd'},
                 'params': {},
                 'resource_id': None
             }
         )
 
+    def test_create_backing(self):
+        _ctx = self._create_ctx()
+
+        volume = mock.Mock()
+        volume.name = mock.Mock(return_value="volume_name")
+        backing = mock.Mock()
+        backing.path = mock.Mock(return_value="/var/lib/libvirt/base.qcow2")
+        backing.info = mock.Mock(return_value=[0, 10 * 1024 * 1024 + 1, 0])
+        backing.XMLDesc = mock.Mock(
+            return_value="<volume><target><format type='qcow2'/>"
+                         "</target></volume>")
+        pool = mock.Mock()
+        pool.createXML = mock.Mock(return_value=volume)
+        pool.storageVolLookupByName = mock.Mock(return_value=backing)
+        connect = self._create_fake_connection()
+        connect.storagePoolLookupByName = mock.Mock(return_value=pool)
+        connect.storageVolLookupByPath = mock.Mock(return_value=backing)
+
+        # overlay over volume from same pool
+        with mock.patch(
+            "cloudify_libvirt.volume_tasks.libvirt.open",
+            mock.Mock(return_value=connect)
+        ):
+            volume_tasks.create(ctx=_ctx,
+                                params={'pool': 'empty',
+                                        'backing_volume': 'base.qcow2'})
+        pool.storageVolLookupByName.assert_called_with('base.qcow2')
+        xmlconfig = pool.createXML.call_args[0][0]
+        self.assertIn("<format type='qcow2'/>", xmlconfig)
+        self.assertIn("<path>/var/lib/libvirt/base.qcow2</path>", xmlconfig)
+        self.assertIn("<capacity unit='MiB'>11</capacity>", xmlconfig)
+        self.assertIn("<allocation unit='MiB'>0</allocation>", xmlconfig)
+
+        # overlay by path, with own capacity and raw backing
+        _ctx.instance.runtime_properties['params'] = {}
+        backing.XMLDesc = mock.Mock(return_value="<volume/>")
+        with mock.patch(
+            "cloudify_libvirt.volume_tasks.libvirt.open",
+            mock.Mock(return_value=connect)
+        ):
+            volume_tasks.create(
+                ctx=_ctx,
+                params={'pool': 'empty',
+                        'capacity': 20,
+                        'backing_volume': '/var/lib/libvirt/base.qcow2'})
+        connect.storageVolLookupByPath.assert_called_with(
+            '/var/lib/libvirt/base.qcow2')
+        xmlconfig = pool.createXML.call_args[0][0]
+        self.assertIn("<format type='raw'/>", xmlconfig)
+        self.assertIn("<capacity unit='MiB'>20</capacity>", xmlconfig)
+
+        # no such backing volume
+        _ctx.instance.runtime_properties['params'] = {}
+        pool.storageVolLookupByName = mock.Mock(
+            side_effect=volume_tasks.libvirt.libvirtError("no such"))
+        with mock.patch(
+            "cloudify_libvirt.volume_tasks.libvirt.open",
+            mock.Mock(return_value=connect)
+        ):
+            with self.assertRaisesRegexp(
+                NonRecoverableError,
+                'Failed to find the backing volume'
+            ):
+                volume_tasks.create(ctx=_ctx,
+                                    params={'pool': 'empty',
+                                            'backing_volume': 'base.qcow2'})
+
+            # download to overlay
+            _ctx.instance.runtime_properties['params'] = {}
+            with self.assertRaisesRegexp(
+                NonRecoverableError,
+                'Volume with backing volume can not be downloaded.'
+            ):
+                volume_tasks.create(
+                    ctx=_ctx,
+                    params={'pool': 'empty',
+                            'url': "https://fake.org/centos.iso",
+                            'backing_volume': 'base.qcow2'})
+
+    def test_image_cache(self):
+        # create volume from cached image
+        _ctx = self._create_ctx()
+        _ctx.get_resource = mock.Mock(return_value='<somexml/>')
+
+        volume = mock.Mock()
+        volume.name = mock.Mock(return_value="volume_name")
+        cache_volume = mock.Mock()
+        pool = mock.Mock()
+        pool.createXMLFrom = mock.Mock(return_value=volume)
+        pool.storageVolLookupByName = mock.Mock(return_value=cache_volume)
+        connect = self._create_fake_connection()
+        connect.storagePoolLookupByName = mock.Mock(return_value=pool)
+        head_response = mock.Mock()
+        head_response.headers = {'Content-Length': 512,
+                                 'Accept-Ranges': 'bytes',
+                                 'ETag': '"image"'}
+        with mock.patch(
+            "cloudify_libvirt.volume_tasks.libvirt.open",
+            mock.Mock(return_value=connect)
+        ):
+            with mock.patch(
+                "cloudify_libvirt.volume_tasks.requests.head",
+                mock.Mock(return_value=head_response)
+            ):
+                volume_tasks.create(
+                    ctx=_ctx,
+                    template_resource="template_resource",
+                    params={
+                        'pool': 'empty',
+                        'image_cache': True,
+                        'url': "https://fake.org/centos.iso"})
+        pool.createXMLFrom.assert_called_with('<somexml/>', cache_volume, 0)
+        pool.createXML.assert_not_called()
+        self.assertEqual(
+            _ctx.instance.runtime_properties['download'], {
+                'url': "https://fake.org/centos.iso",
+                'allocation': 512,
+                'etag': '"image"',
+                'last_modified': None,
+                'offset': 512})
+        pool.storageVolLookupByName.assert_called_with(
+            volume_tasks._cache_name(
+                _ctx.instance.runtime_properties['download']))
+
+        # cached image is removed by other install
+        fallback_ctx = self._create_ctx()
+        fallback_ctx.get_resource = mock.Mock(return_value='<somexml/>')
+        pool.createXMLFrom = mock.Mock(
+            side_effect=libvirt.libvirtError("createXMLFrom"))
+        pool.createXML = mock.Mock(return_value=volume)
+        with mock.patch(
+            "cloudify_libvirt.volume_tasks.libvirt.open",
+            mock.Mock(return_value=connect)
+        ):
+            with mock.patch(
+                "cloudify_libvirt.volume_tasks.requests.head",
+                mock.Mock(return_value=head_response)
+            ):
+                volume_tasks.create(
+                    ctx=fallback_ctx,
+                    template_resource="template_resource",
+                    params={
+                        'pool': 'empty',
+                        'image_cache': True,
+                        'url': "https://fake.org/centos.iso"})
+        pool.createXML.assert_called_with('<somexml/>')
+        # will be downloaded on start
+        self.assertNotIn('download',
+                         fallback_ctx.instance.runtime_properties)
+
+        # no cache for images without ETag/Last-Modified
+        self.assertIsNone(volume_tasks._cache_name({
+            'url': "https://fake.org/centos.iso", 'allocation': 512}))
+
+        # save image to cache with remove least recently used
+        old_image = mock.Mock()
+        old_image.name = mock.Mock(
+            return_value=volume_tasks.CACHE_PREFIX + "old")
+        old_image.info = mock.Mock(return_value=[0, 300, 300])
+        old_image.XMLDesc = mock.Mock(
+            return_value="<volume><target><timestamps>"
+                         "<atime>1.5</atime></timestamps></target></volume>")
+        new_image = mock.Mock()
+        new_image.name = mock.Mock(
+            return_value=volume_tasks.CACHE_PREFIX + "new")
+        new_image.info = mock.Mock(return_value=[0, 100, 100])
+        new_image.XMLDesc = mock.Mock(
+            return_value="<volume><target><timestamps>"
+                         "<atime>2.5</atime></timestamps></target></volume>")
+        other = mock.Mock()
+        other.name = mock.Mock(return_value="other")
+        pool = mock.Mock()
+        pool.storageVolLookupByName = mock.Mock(
+            side_effect=volume_tasks.libvirt.libvirtError("no such"))
+        pool.info = mock.Mock(return_value=[0, 1600, 500, 1100])
+        pool.listAllVolumes = mock.Mock(
+            return_value=[new_image, other, old_image])
+        volume_tasks._cache_store(
+            ctx=_ctx, pool=pool, volume=volume,
+            checkpoint=_ctx.instance.runtime_properties['download'],
+            capacity=1, limit=50)
+        old_image.delete.assert_called_with(0)
+        new_image.delete.assert_not_called()
+        other.delete.assert_not_called()
+        pool.createXMLFrom.assert_called_with(mock.ANY, volume, 0)
+
+        # image is bigger than cache
+        pool.createXMLFrom = mock.Mock()
+        volume_tasks._cache_store(
+            ctx=_ctx, pool=pool, volume=volume,
+            checkpoint=dict(_ctx.instance.runtime_properties['download'],
+                            allocation=2000),
+            capacity=2, limit=50)
+        pool.createXMLFrom.assert_not_called()
+        new_image.delete.assert_not_called()
+
 
 if __name__ == '__main__':
     unittest.main()
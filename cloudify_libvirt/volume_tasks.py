@@ -12,9 +12,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
+import hashlib
+import itertools
 import requests
 import libvirt
 import time
+import uuid
+import xml.etree.ElementTree as ET
 
 from cloudify import ctx
 from cloudify.decorators import operation
@@ -22,6 +27,19 @@ from cloudify import exceptions as cfy_exc
 import cloudify_libvirt.common as common
 
 STEP_DOWNLOAD = 1024 * 1024 * 16
+# parallel range downloads
+DOWNLOAD_WORKERS = 4
+DOWNLOAD_RETRIES = 3
+# save download offset to manager each 16 ranges (256 MiB)
+CHECKPOINT_RANGES = 16
+# hole detection block for sparse upload
+SPARSE_BLOCK = 1024 * 64
+# zero buffer for stream wipe
+WIPE_BUFFER = 1024 * 1024 * 8
+# image cache volumes in pool
+CACHE_PREFIX = "cloudify-cache-"
+# image cache size limit, percent of pool capacity
+CACHE_LIMIT = 50
 
 
 @operation
@@ -29,11 +47,7 @@ def create(**kwargs):
     ctx.logger.info("Creating new volume.")
 
     libvirt_auth, template_params = common.get_libvirt_params(**kwargs)
-    conn = libvirt.open(libvirt_auth)
-    if conn is None:
-        raise cfy_exc.NonRecoverableError(
-            'Failed to open connection to the hypervisor'
-        )
+    conn = common.get_connection(libvirt_auth)
 
     try:
         try:
@@ -59,27 +73,51 @@ def create(**kwargs):
             ctx.instance.runtime_properties['use_external_resource'] = True
             return
 
+        cache_volume = None
+        if template_params.get('backing_volume'):
+            if template_params.get('url'):
+                raise cfy_exc.NonRecoverableError(
+                    'Volume with backing volume can not be downloaded.'
+                )
+            _backing_params(conn, pool, template_params)
+
         if (
             template_params.get('url')
         ):
-            res = requests.head(template_params.get('url'))
+            res = requests.head(template_params.get('url'),
+                                allow_redirects=True)
             res.raise_for_status()
-            allocation = int(res.headers.get('Content-Length', 0))
-            if allocation <= 0 or res.headers.get('Accept-Ranges') != 'bytes':
-                raise cfy_exc.NonRecoverableError(
-                    'Failed to download volume.'
-                )
+            checkpoint = _download_checkpoint(template_params.get('url'),
+                                              res.headers)
+            allocation = checkpoint['allocation']
             capacity = allocation // (1024 * 1024)
             if allocation % (1024 * 1024):
                 # we need one more MiB
                 capacity += 1
             template_params['allocation'] = capacity
             template_params['capacity'] = capacity
+            if template_params.get('image_cache'):
+                cache_volume = _cache_lookup(ctx, pool, checkpoint)
 
         xmlconfig = common.gen_xml_template(kwargs, template_params, 'volume')
 
         # create a persistent virtual volume
-        volume = pool.createXML(xmlconfig)
+        volume = None
+        if cache_volume:
+            try:
+                volume = pool.createXMLFrom(xmlconfig, cache_volume, 0)
+            except libvirt.libvirtError as e:
+                # cache volume can be removed by other install
+                ctx.logger.info("Failed to copy from image cache: {}"
+                                .format(repr(e)))
+                cache_volume = None
+            if volume is not None:
+                ctx.logger.info("Volume is copied from image cache.")
+                # nothing to download on start
+                checkpoint['offset'] = checkpoint['allocation']
+                ctx.instance.runtime_properties['download'] = checkpoint
+        if not cache_volume:
+            volume = pool.createXML(xmlconfig)
         if volume is None:
             raise cfy_exc.NonRecoverableError(
                 'Failed to create a virtual volume')
@@ -91,60 +129,335 @@ def create(**kwargs):
         ctx.instance.runtime_properties['resource_id'] = volume.name()
         ctx.instance.runtime_properties['use_external_resource'] = False
     finally:
-        conn.close()
+        common.release_connection(conn)
 
 
-def _stream_wipe(ctx, conn, volume, allocation):
-    allocation *= 1024  # KB
-    stream = conn.newStream(0)
-    volume.upload(stream, 0, allocation * 1024, 0)
-    zero_buff = "\0" * 1024
-    for _ in range(allocation):
-        stream.send(zero_buff)
-    stream.finish()
-
-
-def _stream_download(ctx, conn, volume, url):
-    res = requests.head(url, allow_redirects=True)
-    res.raise_for_status()
-    allocation = int(res.headers.get('Content-Length', 0))
-    if allocation <= 0 or res.headers.get('Accept-Ranges') != 'bytes':
+def _backing_params(conn, pool, template_params):
+    """set params for copy-on-write overlay over backing volume"""
+    backing_volume = template_params['backing_volume']
+    try:
+        if backing_volume.startswith('/'):
+            backing = conn.storageVolLookupByPath(backing_volume)
+        else:
+            backing = pool.storageVolLookupByName(backing_volume)
+    except libvirt.libvirtError as e:
         raise cfy_exc.NonRecoverableError(
-            'Failed to download volume.'
+            'Failed to find the backing volume: {}'.format(repr(e))
         )
-    ctx.logger.info("Download: {allocation}"
-                    .format(allocation=allocation))
-
-    stream = conn.newStream(0)
-    volume.upload(stream, 0, allocation, 0)
-    start_range = 0
-    while start_range < allocation:
-        stop_range = start_range + STEP_DOWNLOAD
-        if stop_range > (allocation - 1):
-            stop_range = allocation - 1
-        ctx.logger.info(
-            "Range: {start}..{stop}/{allocation}: {place}%"
-            .format(
-                start=start_range,
-                stop=stop_range,
-                allocation=allocation,
-                place=(100 * stop_range) // allocation)
+    backing_format = ET.fromstring(backing.XMLDesc(0)).find('target/format')
+    if backing_format is not None:
+        template_params['backing_format'] = backing_format.get('type')
+    else:
+        template_params['backing_format'] = 'raw'
+    template_params['backing_path'] = backing.path()
+    if not template_params.get('capacity'):
+        # same size as backing volume
+        capacity = backing.info()[1]
+        template_params['capacity'] = capacity // (1024 * 1024)
+        if capacity % (1024 * 1024):
+            template_params['capacity'] += 1
+    # only changes are stored in overlay
+    if not template_params.get('allocation'):
+        template_params['allocation'] = 0
+    if not template_params.get('format'):
+        template_params['format'] = 'qcow2'
+
+
+def _download_checkpoint(url, headers):
+    allocation = int(headers.get('Content-Length', 0))
+    if allocation <= 0 or headers.get('Accept-Ranges') != 'bytes':
+        raise cfy_exc.NonRecoverableError(
+            'Failed to download volume.'
         )
-        res = requests.get(
-            url,
-            headers={
-                "Range": "bytes={start}-{stop}".format(
-                    start=start_range,
-                    stop=stop_range)
-            },
-            allow_redirects=True,
-            stream=True)
+    return {
+        'url': url,
+        'allocation': allocation,
+        'etag': headers.get('ETag'),
+        'last_modified': headers.get('Last-Modified'),
+        'offset': 0
+    }
+
+
+def _cache_name(checkpoint):
+    if not (checkpoint.get('etag') or checkpoint.get('last_modified')):
+        # we can't check that image is not changed
+        return None
+    key = hashlib.sha256()
+    for field in ['url', 'allocation', 'etag', 'last_modified']:
+        key.update(repr(checkpoint.get(field)).encode("utf-8"))
+    return CACHE_PREFIX + key.hexdigest()[:32]
+
+
+def _cache_lookup(ctx, pool, checkpoint):
+    name = _cache_name(checkpoint)
+    if not name:
+        ctx.logger.info("Image has no ETag or Last-Modified, skip cache.")
+        return None
+    try:
+        return pool.storageVolLookupByName(name)
+    except libvirt.libvirtError:
+        ctx.logger.info("No image in cache: {}".format(name))
+        return None
+
+
+def _cache_last_used(volume):
+    # atime is updated on each copy from cache volume
+    target = ET.fromstring(volume.XMLDesc(0)).find('target')
+    if target is None:
+        return 0
+    for field in ['timestamps/atime', 'timestamps/mtime']:
+        value = target.findtext(field)
+        if value:
+            return float(value)
+    return 0
+
+
+def _cache_evict(ctx, pool, size, limit):
+    """remove least recently used images while there is no space
+    for new one, return False if image is too big for cache"""
+    limit = pool.info()[1] * limit // 100
+    if size > limit:
+        return False
+    cached = []
+    used = 0
+    for volume in pool.listAllVolumes(0):
+        if volume.name().startswith(CACHE_PREFIX):
+            allocation = volume.info()[2]
+            cached.append((_cache_last_used(volume), allocation, volume))
+            used += allocation
+    cached.sort(key=lambda item: item[0])
+    for _, allocation, volume in cached:
+        if used + size <= limit:
+            break
+        ctx.logger.info("Remove from image cache: {}".format(volume.name()))
+        volume.delete(0)
+        used -= allocation
+    return used + size <= limit
+
+
+def _cache_store(ctx, pool, volume, checkpoint, capacity, limit):
+    name = _cache_name(checkpoint)
+    if not name:
+        return
+    try:
+        pool.storageVolLookupByName(name)
+        return
+    except libvirt.libvirtError:
+        pass
+    if not _cache_evict(ctx, pool, checkpoint['allocation'], limit):
+        ctx.logger.info("Image is too big for cache.")
+        return
+    xmlconfig = common.gen_xml_template({}, {
+        'name': name,
+        'instance_uuid': str(uuid.uuid4()),
+        'allocation': capacity,
+        'capacity': capacity
+    }, 'volume')
+    try:
+        pool.createXMLFrom(xmlconfig, volume, 0)
+        ctx.logger.info("Image is saved to cache: {}".format(name))
+    except libvirt.libvirtError as e:
+        # could be created by other instance in same time
+        ctx.logger.info("Failed to save image to cache: {}".format(repr(e)))
+
+
+def _upload_flags(sparse):
+    if sparse:
+        return libvirt.VIR_STORAGE_VOL_UPLOAD_SPARSE_STREAM
+    return 0
+
+
+def _send_sparse(stream, data):
+    """send data to sparse stream with zero blocks as holes,
+    return size of holes"""
+    zero_block = bytes(SPARSE_BLOCK)
+    view = memoryview(data)
+    holes = 0
+    # current segment: start position and type
+    segment_start = 0
+    segment_hole = None
+    for position in range(0, len(data), SPARSE_BLOCK):
+        block = view[position:position + SPARSE_BLOCK]
+        is_hole = block == zero_block[:len(block)]
+        if segment_hole is None:
+            segment_hole = is_hole
+        elif is_hole != segment_hole:
+            holes += _send_segment(
+                stream, data, segment_start, position, segment_hole)
+            segment_start = position
+            segment_hole = is_hole
+    if segment_hole is not None:
+        holes += _send_segment(
+            stream, data, segment_start, len(data), segment_hole)
+    return holes
+
+
+def _send_segment(stream, data, start, stop, is_hole):
+    if is_hole:
+        stream.sendHole(stop - start, 0)
+        return stop - start
+    stream.send(data[start:stop])
+    return 0
+
+
+def _stream_wipe(ctx, conn, volume, allocation, sparse=False):
+    allocation *= 1024 * 1024  # MiB
+    started = time.time()
+    try:
+        # zero volume on hypervisor side without any data transfer
+        if volume.wipePattern(libvirt.VIR_STORAGE_VOL_WIPE_ALG_ZERO, 0) < 0:
+            raise libvirt.libvirtError("Can not wipe volume.")
+        method = "wipe"
+    except libvirt.libvirtError as e:
+        ctx.logger.info("Server side wipe failed: {}, use stream."
+                        .format(repr(e)))
+        stream = conn.newStream(0)
+        volume.upload(stream, 0, allocation, _upload_flags(sparse))
+        if sparse:
+            # whole volume is hole
+            stream.sendHole(allocation, 0)
+            method = "sparse stream"
+        else:
+            zero_buff = bytes(min(WIPE_BUFFER, allocation))
+            sent = 0
+            while sent < allocation:
+                size = min(len(zero_buff), allocation - sent)
+                if size == len(zero_buff):
+                    stream.send(zero_buff)
+                else:
+                    stream.send(zero_buff[:size])
+                sent += size
+            method = "stream"
+        stream.finish()
+    duration = max(time.time() - started, 0.001)
+    ctx.logger.info(
+        "Wiped {size} by {method} in {duration:.1f}s: {speed:.1f} MB/s"
+        .format(size=allocation, method=method, duration=duration,
+                speed=allocation / duration / 1000000))
+
+
+def _download_range(session, url, start_range, stop_range):
+    # called in worker thread, so without ctx usage
+    for attempt in range(DOWNLOAD_RETRIES):
+        try:
+            res = session.get(
+                url,
+                headers={
+                    "Range": "bytes={start}-{stop}".format(
+                        start=start_range,
+                        stop=stop_range)
+                },
+                allow_redirects=True)
+            res.raise_for_status()
+            if len(res.content) != stop_range - start_range + 1:
+                raise IOError("Unexpected size of range.")
+            return res.content
+        except IOError as e:
+            error = e
+            if attempt + 1 < DOWNLOAD_RETRIES:
+                time.sleep(2 ** attempt)
+    raise cfy_exc.RecoverableError(
+        "Failed to download range {start}..{stop}: {error}".format(
+            start=start_range, stop=stop_range, error=repr(error))
+    )
+
+
+def _stream_download(ctx, conn, volume, url, workers=DOWNLOAD_WORKERS,
+                     sparse=False):
+    from concurrent.futures import ThreadPoolExecutor
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=workers,
+                                            pool_maxsize=workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    try:
+        res = session.head(url, allow_redirects=True)
         res.raise_for_status()
-        for chunk in res.iter_content(chunk_size=None):
-            # mark as downloaded
-            start_range += len(chunk)
-            stream.send(chunk)
-    stream.finish()
+        # checkpoint for resume broken download
+        checkpoint = _download_checkpoint(url, res.headers)
+        allocation = checkpoint['allocation']
+        previous = ctx.instance.runtime_properties.get('download') or {}
+        offset = previous.get('offset', 0)
+        if offset and dict(previous, offset=0) == checkpoint:
+            checkpoint['offset'] = offset
+            ctx.logger.info("Resume download from {offset}"
+                            .format(offset=offset))
+        else:
+            offset = 0
+        ctx.instance.runtime_properties['download'] = checkpoint
+        if offset >= allocation:
+            ctx.logger.info("Image is already downloaded.")
+            return
+
+        ctx.logger.info("Download: {size}/{allocation} by {workers} workers"
+                        .format(size=allocation - offset,
+                                allocation=allocation, workers=workers))
+
+        ranges = (
+            (start_range,
+             min(start_range + STEP_DOWNLOAD, allocation) - 1)
+            for start_range in range(offset, allocation, STEP_DOWNLOAD)
+        )
+        stream = conn.newStream(0)
+        volume.upload(stream, offset, allocation - offset,
+                      _upload_flags(sparse))
+        executor = ThreadPoolExecutor(max_workers=workers)
+        # ranges in download, keep no more than two ranges per worker
+        pending = collections.deque()
+        started = time.time()
+        sent_ranges = 0
+        holes = 0
+        try:
+            for start_range, stop_range in itertools.islice(
+                ranges, workers * 2
+            ):
+                pending.append((stop_range, executor.submit(
+                    _download_range, session, url, start_range, stop_range)))
+            while pending:
+                stop_range, future = pending.popleft()
+                # libvirt stream requires data in order
+                if sparse:
+                    holes += _send_sparse(stream, future.result())
+                else:
+                    stream.send(future.result())
+                for start_range, next_stop in itertools.islice(ranges, 1):
+                    pending.append((next_stop, executor.submit(
+                        _download_range, session, url,
+                        start_range, next_stop)))
+                ctx.logger.info(
+                    "Range: ..{stop}/{allocation}: {place}%"
+                    .format(
+                        stop=stop_range,
+                        allocation=allocation,
+                        place=(100 * (stop_range + 1)) // allocation)
+                )
+                checkpoint['offset'] = stop_range + 1
+                ctx.instance.runtime_properties['download'] = checkpoint
+                sent_ranges += 1
+                if not sent_ranges % CHECKPOINT_RANGES:
+                    ctx.instance.update()
+            stream.finish()
+        except BaseException:
+            for _, future in pending:
+                future.cancel()
+            stream.abort()
+            # last range could be lost on abort
+            checkpoint['offset'] = max(
+                checkpoint['offset'] - STEP_DOWNLOAD, offset)
+            ctx.instance.runtime_properties['download'] = checkpoint
+            ctx.instance.update()
+            raise
+        finally:
+            executor.shutdown(wait=False)
+        duration = max(time.time() - started, 0.001)
+        ctx.logger.info(
+            "Downloaded {size} in {duration:.1f}s: {speed:.1f} MB/s"
+            .format(size=allocation - offset, duration=duration,
+                    speed=(allocation - offset) / duration / 1000000))
+        if sparse:
+            ctx.logger.info("Skipped as holes: {holes}".format(holes=holes))
+    finally:
+        session.close()
 
 
 @operation
@@ -162,11 +475,7 @@ def start(**kwargs):
         return
 
     libvirt_auth, template_params = common.get_libvirt_params(**kwargs)
-    conn = libvirt.open(libvirt_auth)
-    if conn is None:
-        raise cfy_exc.NonRecoverableError(
-            'Failed to open connection to the hypervisor'
-        )
+    conn = common.get_connection(libvirt_auth)
 
     try:
         # lookup the default volume by name
@@ -180,21 +489,37 @@ def start(**kwargs):
 
         if (
             template_params.get('zero_wipe') and
-            template_params.get('allocation')
+            template_params.get('allocation') and
+            # zeros in overlay hide backing volume data
+            not template_params.get('backing_volume') and
+            # partially downloaded image
+            not ctx.instance.runtime_properties.get('download')
         ):
             _stream_wipe(
                 ctx=ctx, conn=conn, volume=volume,
-                allocation=int(template_params.get('allocation', 0))
+                allocation=int(template_params.get('allocation', 0)),
+                sparse=template_params.get('sparse', False)
             )
 
         if (template_params.get('url')):
             _stream_download(
                 ctx=ctx, conn=conn, volume=volume,
-                url=template_params.get('url')
+                url=template_params.get('url'),
+                workers=int(template_params.get('download_workers',
+                                                DOWNLOAD_WORKERS)),
+                sparse=template_params.get('sparse', False)
             )
+            if template_params.get('image_cache'):
+                _cache_store(
+                    ctx=ctx, pool=pool, volume=volume,
+                    checkpoint=ctx.instance.runtime_properties['download'],
+                    capacity=template_params.get('capacity'),
+                    limit=int(template_params.get('image_cache_limit',
+                                                  CACHE_LIMIT))
+                )
 
     finally:
-        conn.close()
+        common.release_connection(conn)
 
 
 @operation
@@ -213,11 +538,7 @@ def stop(**kwargs):
         return
 
     libvirt_auth, template_params = common.get_libvirt_params(**kwargs)
-    conn = libvirt.open(libvirt_auth)
-    if conn is None:
-        raise cfy_exc.NonRecoverableError(
-            'Failed to open connection to the hypervisor'
-        )
+    conn = common.get_connection(libvirt_auth)
 
     try:
         # lookup the default volume by name
@@ -237,7 +558,7 @@ def stop(**kwargs):
     except libvirt.libvirtError as e:
         ctx.logger.info('Failed to wipe the volume: {}'.format(repr(e)))
     finally:
-        conn.close()
+        common.release_connection(conn)
 
 
 @operation
@@ -255,11 +576,7 @@ def delete(**kwargs):
         return
 
     libvirt_auth, template_params = common.get_libvirt_params(**kwargs)
-    conn = libvirt.open(libvirt_auth)
-    if conn is None:
-        raise cfy_exc.NonRecoverableError(
-            'Failed to open connection to the hypervisor'
-        )
+    conn = common.get_connection(libvirt_auth)
 
     try:
         # lookup the default volume by name
@@ -277,10 +594,11 @@ def delete(**kwargs):
             )
 
         ctx.instance.runtime_properties['resource_id'] = None
-        ctx.instance.runtime_properties['backups'] = {}
+        common.delete_backups()
         ctx.instance.runtime_properties['params'] = {}
+        ctx.instance.runtime_properties['download'] = {}
     finally:
-        conn.close()
+        common.release_connection(conn)
 
 
 @operation
@@ -293,11 +611,7 @@ def snapshot_create(**kwargs):
         raise cfy_exc.NonRecoverableError("No volume for backup")
 
     libvirt_auth, template_params = common.get_libvirt_params(**kwargs)
-    conn = libvirt.open(libvirt_auth)
-    if conn is None:
-        raise cfy_exc.NonRecoverableError(
-            'Failed to open connection to the hypervisor'
-        )
+    conn = common.get_connection(libvirt_auth)
 
     try:
         # lookup the default volume by name
@@ -311,7 +625,7 @@ def snapshot_create(**kwargs):
 
         common.xml_snapshot_create(kwargs, resource_id, volume.XMLDesc())
     finally:
-        conn.close()
+        common.release_connection(conn)
 
 
 @operation
@@ -324,11 +638,7 @@ def snapshot_apply(**kwargs):
         raise cfy_exc.NonRecoverableError("No volume for restore")
 
     libvirt_auth, template_params = common.get_libvirt_params(**kwargs)
-    conn = libvirt.open(libvirt_auth)
-    if conn is None:
-        raise cfy_exc.NonRecoverableError(
-            'Failed to open connection to the hypervisor'
-        )
+    conn = common.get_connection(libvirt_auth)
 
     try:
         # lookup the default volume by name
@@ -342,7 +652,7 @@ def snapshot_apply(**kwargs):
 
         common.xml_snapshot_apply(kwargs, resource_id, volume.XMLDesc())
     finally:
-        conn.close()
+        common.release_connection(conn)
 
 
 @operation
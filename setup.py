@@ -58,6 +58,8 @@ setup(
             'templates/snapshot.xml',
             'templates/pool.xml',
             'templates/volume.xml',
+            'templates/backup.xml',
+            'templates/checkpoint.xml',
         ]
     },
     install_requires=install_requires,